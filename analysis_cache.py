@@ -0,0 +1,183 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Any, List
+
+import config
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Постоянный кэш результатов анализа OpenAI.
+# Ключ — хэш (модель, версия промпта, категории, текст диалога): повторный анализ того же текста
+# (повтор после ошибки экспорта, принудительное закрытие после обычного) не уходит в OpenAI.
+# Версия промпта — хэш самого шаблона, поэтому правка PROMPT_TEMPLATE автоматически делает старые записи недостижимыми.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analysis_cache (
+    cache_key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    result TEXT NOT NULL,
+    summary TEXT NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used_at REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_analysis_cache_last_used ON analysis_cache(last_used_at);
+"""
+
+# Счетчики кэша с момента запуска процесса
+CACHE_STATS: Dict[str, int] = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'errors': 0}
+_stats_lock = threading.Lock()
+
+_db_lock = threading.Lock()
+_initialized = False
+
+
+def _count(name: str, value: int = 1):
+    with _stats_lock:
+        CACHE_STATS[name] += value
+
+
+def get_cache_stats() -> Dict[str, Any]:
+    """Снимок счетчиков кэша с долей попаданий."""
+    with _stats_lock:
+        stats = dict(CACHE_STATS)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+
+def _connect() -> sqlite3.Connection:
+    db_dir = os.path.dirname(config.ANALYSIS_CACHE_DB_PATH)
+    if db_dir and not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+    conn = sqlite3.connect(config.ANALYSIS_CACHE_DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def init_cache():
+    global _initialized
+    with _db_lock:
+        if _initialized:
+            return
+        conn = _connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            conn.commit()
+        finally:
+            conn.close()
+        _initialized = True
+
+
+def prompt_version(prompt_template: str) -> str:
+    """Короткая версия шаблона промпта (хэш его текста)."""
+    return hashlib.sha256(prompt_template.encode('utf-8')).hexdigest()[:16]
+
+
+def make_key(model: str, prompt_template: str, categories: List[str], dialog_text: str) -> str:
+    payload = json.dumps(
+        [model, prompt_version(prompt_template), list(categories), dialog_text],
+        ensure_ascii=False, separators=(',', ':')
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def get(cache_key: str) -> tuple[dict, str] | None:
+    """Возвращает (json_data, summary) из кэша или None. Ошибки кэша не мешают анализу."""
+    if not config.ANALYSIS_CACHE_ENABLED:
+        return None
+    try:
+        init_cache()
+        with _db_lock:
+            conn = _connect()
+            try:
+                row = conn.execute(
+                    "SELECT result, summary FROM analysis_cache WHERE cache_key = ?", (cache_key,)
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE analysis_cache SET last_used_at = ?, hits = hits + 1 WHERE cache_key = ?",
+                        (time.time(), cache_key)
+                    )
+                    conn.commit()
+            finally:
+                conn.close()
+    except Exception as e:
+        _count('errors')
+        logger.error(f"❌ Ошибка чтения кэша анализа: {e}", exc_info=True)
+        return None
+
+    if row is None:
+        _count('misses')
+        return None
+    _count('hits')
+    return json.loads(row['result']), row['summary']
+
+
+def put(cache_key: str, model: str, json_data: dict, summary: str):
+    """Сохраняет успешный результат анализа и при необходимости вытесняет самые давно использованные записи."""
+    if not config.ANALYSIS_CACHE_ENABLED:
+        return
+    result = json.dumps(json_data, ensure_ascii=False)
+    size_bytes = len(result.encode('utf-8')) + len(summary.encode('utf-8'))
+    now = time.time()
+    try:
+        init_cache()
+        with _db_lock:
+            conn = _connect()
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO analysis_cache "
+                    "(cache_key, model, result, summary, size_bytes, created_at, last_used_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (cache_key, model, result, summary, size_bytes, now, now)
+                )
+                evicted = _evict(conn)
+                conn.commit()
+            finally:
+                conn.close()
+    except Exception as e:
+        _count('errors')
+        logger.error(f"❌ Ошибка записи в кэш анализа: {e}", exc_info=True)
+        return
+
+    _count('stores')
+    if evicted:
+        _count('evictions', evicted)
+        logger.info(f"Кэш анализа: вытеснено {evicted} записей.")
+
+
+def _evict(conn: sqlite3.Connection) -> int:
+    """Удерживает кэш в пределах ANALYSIS_CACHE_MAX_ENTRIES и ANALYSIS_CACHE_MAX_BYTES (LRU)."""
+    entries, total_bytes = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM analysis_cache"
+    ).fetchone()
+    evicted = 0
+    if entries > config.ANALYSIS_CACHE_MAX_ENTRIES:
+        evicted += conn.execute(
+            "DELETE FROM analysis_cache WHERE cache_key IN "
+            "(SELECT cache_key FROM analysis_cache ORDER BY last_used_at LIMIT ?)",
+            (entries - config.ANALYSIS_CACHE_MAX_ENTRIES,)
+        ).rowcount
+        total_bytes = conn.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM analysis_cache").fetchone()[0]
+
+    if total_bytes > config.ANALYSIS_CACHE_MAX_BYTES:
+        # Идем от самых давно использованных записей, пока не освободим лишнее
+        excess = total_bytes - config.ANALYSIS_CACHE_MAX_BYTES
+        keys = []
+        for row in conn.execute("SELECT cache_key, size_bytes FROM analysis_cache ORDER BY last_used_at"):
+            if excess <= 0:
+                break
+            keys.append((row['cache_key'],))
+            excess -= row['size_bytes']
+        conn.executemany("DELETE FROM analysis_cache WHERE cache_key = ?", keys)
+        evicted += len(keys)
+    return evicted
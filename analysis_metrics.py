@@ -0,0 +1,259 @@
+import bisect
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Dict, Any, List
+
+import pytz
+
+import config
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Метрики запросов к OpenAI.
+# Каждый запрос анализа (включая запросы на исправление ответа и ответы Batch API) записывается:
+#   - в реестр процесса: счетчики и гистограммы задержки и токенов (get_metrics);
+#   - в SQLite (ANALYSIS_METRICS_DB_PATH) построчно, чтобы ежедневный отчет мог посчитать
+#     итоги и стоимость за день независимо от перезапусков (daily_rollup / format_daily_rollup).
+
+# День записи — по Москве, как дата ежедневного отчета (иначе запросы с 00:00 до 03:00 МСК
+# попадали бы в итоги предыдущего дня)
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+# Исходы запроса
+OUTCOME_PARSED = 'parsed'  # ответ разобран
+OUTCOME_INVALID = 'invalid'  # ответ не прошел проверку (будет запрошено исправление или анализ провален)
+OUTCOME_UNAVAILABLE = 'unavailable'  # дедлайн / исчерпаны повторы
+OUTCOME_API_ERROR = 'api_error'  # постоянная ошибка API
+
+# Границы корзин гистограмм (последняя корзина — все, что больше)
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+TOKEN_BUCKETS = (250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analysis_requests (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    day TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    model TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    latency_seconds REAL,
+    prompt_tokens INTEGER NOT NULL,
+    cached_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    retries INTEGER NOT NULL,
+    outcome TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_analysis_requests_day ON analysis_requests(day);
+"""
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами: количество, сумма, максимум и оценка процентилей."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q: float) -> float | None:
+        """Верхняя граница корзины, в которую попадает q-й процентиль (для последней корзины — максимум)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'avg': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'buckets': {**{f"le_{bound:g}": count for bound, count in zip(self.buckets, self.counts)},
+                        'inf': self.counts[-1]},
+        }
+
+
+# Реестр процесса: счетчики по (модель, режим, исход) и гистограммы
+_registry_lock = threading.Lock()
+COUNTERS: Dict[str, int] = {}
+HISTOGRAMS: Dict[str, Histogram] = {
+    'latency_seconds': Histogram(LATENCY_BUCKETS),
+    'prompt_tokens': Histogram(TOKEN_BUCKETS),
+    'completion_tokens': Histogram(TOKEN_BUCKETS),
+    'cached_tokens': Histogram(TOKEN_BUCKETS),
+    'retries': Histogram((0, 1, 2, 3, 5)),
+}
+
+_db_lock = threading.Lock()
+_initialized = False
+
+
+def _connect() -> sqlite3.Connection:
+    db_dir = os.path.dirname(config.ANALYSIS_METRICS_DB_PATH)
+    if db_dir and not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+    conn = sqlite3.connect(config.ANALYSIS_METRICS_DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _today() -> date:
+    return datetime.now(MOSCOW_TZ).date()
+
+
+def init_metrics():
+    global _initialized
+    with _db_lock:
+        if _initialized:
+            return
+        conn = _connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            cutoff = (_today() - timedelta(days=config.ANALYSIS_METRICS_RETENTION_DAYS)).isoformat()
+            conn.execute("DELETE FROM analysis_requests WHERE day < ?", (cutoff,))
+            conn.commit()
+        finally:
+            conn.close()
+        _initialized = True
+
+
+def record_request(model: str, latency_seconds: float | None, tokens: dict | None, retries: int,
+                   outcome: str, mode: str = 'sync'):
+    """
+    Записывает один запрос к OpenAI. tokens — результат dialog_analyser.record_usage
+    (prompt_tokens, cached_tokens, completion_tokens). Ошибки записи не мешают анализу.
+    """
+    tokens = tokens or {}
+    prompt_tokens = tokens.get('prompt_tokens', 0)
+    cached_tokens = tokens.get('cached_tokens', 0)
+    completion_tokens = tokens.get('completion_tokens', 0)
+
+    with _registry_lock:
+        counter = f"{model}|{mode}|{outcome}"
+        COUNTERS[counter] = COUNTERS.get(counter, 0) + 1
+        if latency_seconds is not None:
+            HISTOGRAMS['latency_seconds'].observe(latency_seconds)
+        if tokens:
+            HISTOGRAMS['prompt_tokens'].observe(prompt_tokens)
+            HISTOGRAMS['completion_tokens'].observe(completion_tokens)
+            HISTOGRAMS['cached_tokens'].observe(cached_tokens)
+        HISTOGRAMS['retries'].observe(retries)
+
+    if not config.ANALYSIS_METRICS_ENABLED:
+        return
+    try:
+        init_metrics()
+        with _db_lock:
+            conn = _connect()
+            try:
+                conn.execute(
+                    "INSERT INTO analysis_requests (day, created_at, model, mode, latency_seconds, prompt_tokens, "
+                    "cached_tokens, completion_tokens, retries, outcome) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (_today().isoformat(), time.time(), model, mode, latency_seconds, prompt_tokens,
+                     cached_tokens, completion_tokens, retries, outcome)
+                )
+                conn.commit()
+            finally:
+                conn.close()
+    except Exception as e:
+        logger.error(f"❌ Ошибка записи метрик запроса OpenAI: {e}", exc_info=True)
+
+
+def get_metrics() -> Dict[str, Any]:
+    """Снимок реестра процесса: счетчики 'модель|режим|исход' и гистограммы."""
+    with _registry_lock:
+        return {
+            'counters': dict(COUNTERS),
+            'histograms': {name: histogram.snapshot() for name, histogram in HISTOGRAMS.items()},
+        }
+
+
+def request_cost(model: str, mode: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> float:
+    """Стоимость запроса в долларах по OPENAI_MODEL_PRICES (цены за 1 млн токенов)."""
+    # API возвращает версию модели ('gpt-5-mini-2025-08-07'): ищем самое длинное совпадающее имя
+    names = [name for name in config.OPENAI_MODEL_PRICES if model == name or model.startswith(f"{name}-")]
+    if not names:
+        return 0.0
+    prices = config.OPENAI_MODEL_PRICES[max(names, key=len)]
+    cost = ((prompt_tokens - cached_tokens) * prices['input'] + cached_tokens * prices['cached_input']
+            + completion_tokens * prices['output']) / 1_000_000
+    return cost * config.OPENAI_BATCH_PRICE_FACTOR if mode == 'batch' else cost
+
+
+def _percentile(sorted_values: List[float], q: float) -> float | None:
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def daily_rollup(day: date) -> Dict[str, Any]:
+    """Итоги запросов к OpenAI за день: количество, исходы, токены, задержка и стоимость."""
+    init_metrics()
+    with _db_lock:
+        conn = _connect()
+        try:
+            rows = conn.execute("SELECT * FROM analysis_requests WHERE day = ?", (day.isoformat(),)).fetchall()
+        finally:
+            conn.close()
+
+    rollup = {
+        'requests': len(rows), 'outcomes': {}, 'retries': 0, 'cost': 0.0,
+        'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0,
+    }
+    latencies = []
+    for row in rows:
+        rollup['outcomes'][row['outcome']] = rollup['outcomes'].get(row['outcome'], 0) + 1
+        rollup['retries'] += row['retries']
+        for key in ('prompt_tokens', 'cached_tokens', 'completion_tokens'):
+            rollup[key] += row[key]
+        rollup['cost'] += request_cost(row['model'], row['mode'], row['prompt_tokens'],
+                                       row['cached_tokens'], row['completion_tokens'])
+        if row['latency_seconds'] is not None:
+            latencies.append(row['latency_seconds'])
+    latencies.sort()
+    rollup['latency_p50'] = _percentile(latencies, 0.5)
+    rollup['latency_p95'] = _percentile(latencies, 0.95)
+    return rollup
+
+
+def format_daily_rollup(day: date) -> str:
+    """Блок ежедневного отчета (HTML для Telegram) с итогами и стоимостью анализа OpenAI за день."""
+    try:
+        rollup = daily_rollup(day)
+    except Exception as e:
+        logger.error(f"❌ Ошибка расчета итогов OpenAI за {day}: {e}", exc_info=True)
+        return ""
+    if not rollup['requests']:
+        return ""
+
+    failed = rollup['requests'] - rollup['outcomes'].get(OUTCOME_PARSED, 0)
+    cached_share = rollup['cached_tokens'] / rollup['prompt_tokens'] if rollup['prompt_tokens'] else 0.0
+    latency = (f"{rollup['latency_p50']:.1f} / {rollup['latency_p95']:.1f} с"
+               if rollup['latency_p50'] is not None else "Н/Д")
+    return (
+        f"\n\n🤖 Анализ OpenAI: запросов <b>{rollup['requests']}</b> (неудачных {failed}, повторов {rollup['retries']})\n"
+        f"   Токены: вход {rollup['prompt_tokens']:,} (из кэша {cached_share:.0%}), выход {rollup['completion_tokens']:,}\n"
+        f"   Задержка p50 / p95: {latency}\n"
+        f"   Стоимость: <b>${rollup['cost']:.3f}</b>"
+    )
@@ -0,0 +1,299 @@
+import argparse
+import glob
+import hashlib
+import logging
+import os
+import threading
+import uuid
+from datetime import datetime, date, timedelta
+from typing import Dict, Any, List
+
+import pytz
+
+import config
+from export_sinks import ExportSink, KIND_FULL
+
+# pyarrow нужен только для локального хранилища, основная система работает без него
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+# Файлы лежат в формате hive-партиций: <ANALYSIS_WAREHOUSE_DIR>/date=YYYY-MM-DD/part-*.parquet,
+# поэтому их можно читать и напрямую из DuckDB:
+#   SELECT * FROM read_parquet('dialogs/warehouse/*/*.parquet', hive_partitioning = true)
+# День партиции — московский, как в отчетах; сама отметка analyzed_at хранится как есть (время контейнера).
+PARTITION_PREFIX = 'date='
+
+# Запись идемпотентна: outbox повторяет пачку целиком (в том числе после частичной записи партиций),
+# а журнал обработки может экспортировать версию диалога повторно. Файл пачки называется по ключам
+# ее строк (повтор той же пачки перезаписывает файл), а при чтении и сжатии партиции дубли
+# отбрасываются по ключу строки: dialog_id + хэш версии диалога (для старых строк — dialog_id + analyzed_at).
+
+_write_lock = threading.Lock()
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise RuntimeError("Для локального хранилища анализа требуется пакет pyarrow (pip install pyarrow).")
+
+
+def _schema() -> 'pa.Schema':
+    fields = [
+        pa.field('analyzed_at', pa.timestamp('s')),
+        pa.field('dialog_id', pa.int64()),
+        pa.field('order_link', pa.string()),
+        pa.field('manager_name', pa.string()),
+        pa.field('customer_type', pa.string()),
+        pa.field('total_summ', pa.float64()),
+        pa.field('chat_category', pa.string()),
+        pa.field('summary', pa.string()),
+    ]
+    fields += [pa.field(criterion, pa.int8()) for criterion in config.ANALYSIS_CRITERIA]
+    # Хэш версии диалога из журнала обработки (в файлах до его появления — null)
+    fields.append(pa.field('content_hash', pa.string()))
+    return pa.schema(fields)
+
+
+def _row_key(record: Dict[str, Any]) -> tuple:
+    return record['dialog_id'], record['content_hash'] or str(record['analyzed_at'])
+
+
+def _deduplicate(table: 'pa.Table') -> 'pa.Table':
+    """Оставляет первую строку для каждого ключа (dialog_id, версия диалога); строки без dialog_id не трогает."""
+    if table.num_rows == 0:
+        return table
+    row_index = pa.array(range(table.num_rows), pa.int64())
+    version = pc.coalesce(table['content_hash'], pc.cast(table['analyzed_at'], pa.string()))
+    keyed = pa.table({'dialog_id': table['dialog_id'], 'version': version, 'row_index': row_index})
+    first_rows = keyed.filter(pc.is_valid(keyed['dialog_id'])) \
+        .group_by(['dialog_id', 'version']).aggregate([('row_index', 'min')])['row_index_min']
+    keep = pc.or_(pc.is_null(table['dialog_id']), pc.is_in(row_index, value_set=first_rows))
+    return table if pc.all(keep).as_py() else table.filter(keep)
+
+
+def _to_float(value) -> float | None:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_int(value) -> int | None:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_timestamp(value) -> datetime:
+    """Отметка времени строки экспорта имеет формат '%d.%m.%Y %H:%M:%S' (как в Google Forms)."""
+    if isinstance(value, str):
+        try:
+            return datetime.strptime(value, '%d.%m.%Y %H:%M:%S')
+        except ValueError:
+            pass
+    return datetime.now().replace(microsecond=0)
+
+
+def _partition_day(analyzed_at: datetime) -> date:
+    """Московский день для отметки времени контейнера (наивной, в локальном поясе процесса)."""
+    return analyzed_at.astimezone(MOSCOW_TZ).date()
+
+
+def _partition_dir(day: date) -> str:
+    return os.path.join(config.ANALYSIS_WAREHOUSE_DIR, f"{PARTITION_PREFIX}{day.isoformat()}")
+
+
+def append_analyses(rows: List[Dict[str, Any]]) -> int:
+    """
+    Дописывает результаты анализа в хранилище: одна пачка = один parquet-файл на каждый день,
+    названный по ключам строк пачки. Возвращает количество записанных строк.
+    """
+    _require_pyarrow()
+    rows_by_day: Dict[date, List[Dict[str, Any]]] = {}
+    for row in rows:
+        analyzed_at = _parse_timestamp(row.get('timestamp'))
+        record = {
+            'analyzed_at': analyzed_at,
+            'dialog_id': _to_int(row.get('dialog_id')),
+            'order_link': row.get('order_link'),
+            'manager_name': row.get('manager_name'),
+            'customer_type': row.get('customer_type'),
+            'total_summ': _to_float(row.get('total_summ')),
+            'chat_category': row.get('chat_category'),
+            'summary': row.get('summary'),
+        }
+        for criterion in config.ANALYSIS_CRITERIA:
+            record[criterion] = _to_int(row.get(criterion))
+        record['content_hash'] = row.get('content_hash')
+        rows_by_day.setdefault(_partition_day(analyzed_at), []).append(record)
+
+    schema = _schema()
+    with _write_lock:
+        for day, records in rows_by_day.items():
+            partition_dir = _partition_dir(day)
+            os.makedirs(partition_dir, exist_ok=True)
+            batch_key = "|".join(sorted(f"{dialog_id}:{version}" for dialog_id, version in map(_row_key, records)))
+            file_name = f"part-{hashlib.sha256(batch_key.encode('utf-8')).hexdigest()[:16]}.parquet"
+            table = pa.Table.from_pylist(records, schema=schema)
+            # Пишем во временный файл и переименовываем, чтобы читатели не видели недописанный файл
+            tmp_path = os.path.join(partition_dir, f".{file_name}.tmp")
+            pq.write_table(table, tmp_path)
+            os.replace(tmp_path, os.path.join(partition_dir, file_name))
+
+    logger.info(f"В хранилище анализа записано {len(rows)} строк ({len(rows_by_day)} партиций).")
+    return len(rows)
+
+
+def compact_partition(day: date) -> int:
+    """
+    Склеивает все мелкие файлы партиции в один, отбрасывая дубли строк. Возвращает количество строк
+    в партиции. Ночной прогон с приемником Google Forms пишет по файлу на строку, поэтому партиции
+    стоит периодически сжимать.
+    """
+    _require_pyarrow()
+    partition_dir = _partition_dir(day)
+    with _write_lock:
+        files = sorted(glob.glob(os.path.join(partition_dir, 'part-*.parquet')))
+        if len(files) <= 1:
+            return pq.read_metadata(files[0]).num_rows if files else 0
+        table = _deduplicate(ds.dataset(files, schema=_schema(), format='parquet').to_table())
+        compacted_name = f"part-compacted-{uuid.uuid4().hex[:8]}.parquet"
+        tmp_path = os.path.join(partition_dir, f".{compacted_name}.tmp")
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, os.path.join(partition_dir, compacted_name))
+        for path in files:
+            os.remove(path)
+
+    logger.info(f"Партиция {day} сжата: {len(files)} файлов -> 1 ({table.num_rows} строк).")
+    return table.num_rows
+
+
+class AnalysisWarehouseSink(ExportSink):
+    """Дополнительный приемник: складывает строки полного анализа в локальное хранилище."""
+    name = 'warehouse'
+
+    def __init__(self):
+        _require_pyarrow()
+        self.max_batch_size = config.EXPORT_BATCH_SIZE
+
+    def accepts(self, kind: str) -> bool:
+        # Базовый экспорт не содержит оценок, в хранилище он не нужен
+        return kind == KIND_FULL
+
+    def send_batch(self, kind: str, rows: List[Dict[str, Any]]):
+        append_analyses(rows)
+
+
+# --------------------------------------- #
+#            Запросы к хранилищу
+# --------------------------------------- #
+
+def load_analyses(date_from: date, date_to: date) -> 'pa.Table':
+    """Все результаты анализа за период [date_from, date_to] (читаются только нужные партиции)."""
+    _require_pyarrow()
+    paths = []
+    day = date_from
+    while day <= date_to:
+        paths += glob.glob(os.path.join(_partition_dir(day), 'part-*.parquet'))
+        day += timedelta(days=1)
+    if not paths:
+        return _schema().empty_table()
+    return _deduplicate(ds.dataset(sorted(paths), schema=_schema(), format='parquet').to_table())
+
+
+def manager_aggregates(date_from: date, date_to: date) -> List[Dict[str, Any]]:
+    """
+    Агрегаты по менеджерам: количество диалогов, суммарная и средняя сумма заказа,
+    средняя оценка по каждому критерию.
+    """
+    table = load_analyses(date_from, date_to)
+    if table.num_rows == 0:
+        return []
+    table = table.set_column(
+        table.schema.get_field_index('manager_name'), 'manager_name',
+        pc.fill_null(table['manager_name'], 'Неизвестно')
+    )
+    aggregations = [([], 'count_all'), ('total_summ', 'sum'), ('total_summ', 'mean')]
+    aggregations += [(criterion, 'mean') for criterion in config.ANALYSIS_CRITERIA]
+    grouped = table.group_by('manager_name').aggregate(aggregations)
+
+    result = []
+    for row in grouped.to_pylist():
+        item = {
+            'manager_name': row['manager_name'],
+            'dialogs': row['count_all'],
+            'total_summ': row['total_summ_sum'],
+            'avg_summ': row['total_summ_mean'],
+        }
+        for criterion in config.ANALYSIS_CRITERIA:
+            item[criterion] = row[f"{criterion}_mean"]
+        result.append(item)
+    return sorted(result, key=lambda item: item['dialogs'], reverse=True)
+
+
+def criterion_aggregates(date_from: date, date_to: date) -> List[Dict[str, Any]]:
+    """По каждому критерию: сколько раз выполнено (1), не применимо (0), не выполнено (-1) и средняя оценка."""
+    table = load_analyses(date_from, date_to)
+    result = []
+    for criterion in config.ANALYSIS_CRITERIA:
+        column = table[criterion]
+        counts = {item['values']: item['counts'] for item in pc.value_counts(column).to_pylist()} \
+            if table.num_rows else {}
+        result.append({
+            'criterion': criterion,
+            'done': counts.get(1, 0),
+            'not_applicable': counts.get(0, 0),
+            'failed': counts.get(-1, 0),
+            'mean': pc.mean(column).as_py() if table.num_rows else None,
+        })
+    return result
+
+
+def _parse_date(value: str) -> date:
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def main(argv: List[str] | None = None):
+    parser = argparse.ArgumentParser(description="Запросы к локальному хранилищу результатов анализа.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    today = date.today().isoformat()
+
+    for command, help_text in (('managers', "Агрегаты по менеджерам"), ('criteria', "Агрегаты по критериям")):
+        sub = subparsers.add_parser(command, help=help_text)
+        sub.add_argument('--from', dest='date_from', type=_parse_date, default=_parse_date(today))
+        sub.add_argument('--to', dest='date_to', type=_parse_date, default=_parse_date(today))
+
+    compact_parser = subparsers.add_parser('compact', help="Склеить файлы партиции")
+    compact_parser.add_argument('day', type=_parse_date)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'managers':
+        for item in manager_aggregates(args.date_from, args.date_to):
+            scores = ", ".join(
+                f"{criterion}={item[criterion]:.2f}" for criterion in config.ANALYSIS_CRITERIA
+                if item[criterion] is not None
+            )
+            print(f"{item['manager_name']}: диалогов {item['dialogs']}, сумма {item['total_summ'] or 0:,.0f} руб. | {scores}")
+    elif args.command == 'criteria':
+        for item in criterion_aggregates(args.date_from, args.date_to):
+            mean = f"{item['mean']:.2f}" if item['mean'] is not None else "Н/Д"
+            print(f"{item['criterion']:28} 1: {item['done']:<5} 0: {item['not_applicable']:<5} "
+                  f"-1: {item['failed']:<5} среднее: {mean}")
+    elif args.command == 'compact':
+        print(f"Строк в партиции: {compact_partition(args.day)}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,582 @@
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Callable
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Бенчмарки проекта (запуск: python benchmarks.py <команда>).
+#   imports — время импорта модулей в чистом интерпретаторе (python -X importtime) и проверка,
+#             что тяжелые пакеты (openai, websocket) не загружаются при импорте.
+#   micro   — микробенчмарки горячих функций на реалистичных данных (большие диалоги, много ссылок,
+#             испорченные ответы LLM). Результаты дописываются в BENCHMARK_HISTORY_PATH и сравниваются
+#             с предыдущими запусками.
+#   corpus  — генерирует синтетический корпус файлов dialogs/active и dialogs/closed (10k–500k диалогов).
+#   report  — прогон generate_daily_report на корпусе с заглушками RetailCRM/OpenAI/Google/Telegram:
+#             время manage_and_get_dialogs, агрегации скорости ответа и остальных шагов, пик памяти.
+#             С --sizes каждый размер прогоняется в отдельном процессе (пик памяти не смешивается).
+# С --check команда завершается с кодом 1, если время превысило бюджет (imports), загрузился
+# запрещенный пакет (imports) или функция замедлилась относительно истории (micro).
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Бюджеты времени импорта (мс, медиана по запускам). С запасом: основное время — requests и urllib3
+IMPORT_BUDGETS_MS = {
+    'config': 60,
+    'dialog_analyser': 250,
+    'data_exporter': 400,
+    'report_generator': 450,
+    'dialog_listener': 500,
+}
+# Пакеты, которые загружаются только при первом использовании клиента
+LAZY_PACKAGES = ('openai', 'websocket')
+
+# История микробенчмарков: JSONL, один запуск в строке
+BENCHMARK_HISTORY_PATH = os.getenv("BENCHMARK_HISTORY_PATH", os.path.join(PROJECT_DIR, 'benchmark_history.jsonl'))
+# Сколько последних запусков берется в базовую линию и во сколько раз медленнее считается регрессией
+REGRESSION_BASELINE_RUNS = 5
+REGRESSION_THRESHOLD = 1.3
+
+
+def measure_import(module: str) -> Dict[str, Any]:
+    """Один импорт модуля в отдельном процессе: накопленное время (мс) и загруженные ленивые пакеты."""
+    code = (f"import sys, json; import {module}; "
+            f"print(json.dumps([name for name in {LAZY_PACKAGES!r} if name in sys.modules]))")
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=PROJECT_DIR, capture_output=True, text=True, check=True
+    )
+    # Строка вида "import time:  self [us] | cumulative | module" для самого модуля — последняя с его именем
+    cumulative_us = None
+    for line in result.stderr.splitlines():
+        parts = [part.strip() for part in line.split('|')]
+        if len(parts) == 3 and parts[2] == module:
+            cumulative_us = int(parts[1])
+    return {
+        'ms': cumulative_us / 1000 if cumulative_us is not None else None,
+        'lazy_loaded': json.loads(result.stdout.strip().splitlines()[-1]),
+    }
+
+
+def bench_imports(runs: int = 5, modules: List[str] | None = None) -> List[Dict[str, Any]]:
+    """Медиана времени импорта каждого модуля по runs запускам и сравнение с бюджетом."""
+    results = []
+    for module in modules or list(IMPORT_BUDGETS_MS):
+        samples = [measure_import(module) for _ in range(runs)]
+        timings = [sample['ms'] for sample in samples if sample['ms'] is not None]
+        median_ms = statistics.median(timings) if timings else None
+        lazy_loaded = sorted({name for sample in samples for name in sample['lazy_loaded']})
+        budget = IMPORT_BUDGETS_MS.get(module)
+        results.append({
+            'module': module,
+            'median_ms': median_ms,
+            'min_ms': min(timings) if timings else None,
+            'budget_ms': budget,
+            'lazy_loaded': lazy_loaded,
+            'ok': not lazy_loaded and (budget is None or (median_ms is not None and median_ms <= budget)),
+        })
+    return results
+
+
+# --- Данные для микробенчмарков ---
+
+CLIENT_LINES = [
+    "Здравствуйте! Подскажите, аквариум на 120 литров есть в наличии?",
+    "А доставка в Екатеринбург сколько стоит и сколько идет?",
+    "Отправил фото грунта, такой подойдет?",
+    "Хорошо, давайте оформим. Оплата картой при получении возможна?",
+]
+MANAGER_LINES = [
+    "Добрый день! Да, в наличии, стоимость 12 900 руб. (с крышкой и светильником).",
+    "Доставка СДЭК 3-5 дней, ~650 руб. Можем отправить сегодня!",
+    "Ссылка на оплату: https://yookassa.ru/checkout/payments/v2/contract?orderId=2f8a-11",
+    "Подскажите, для каких целей выбираете? Пресноводный или морской?",
+]
+
+
+def make_dialog_lines(count: int, start: datetime, seed: int = 1) -> List[str]:
+    """Строки файла диалога в формате save_message_to_file: чередование клиента и менеджера, изображения."""
+    rng = random.Random(seed)
+    lines = []
+    moment = start
+    for index in range(count):
+        moment += timedelta(seconds=rng.randint(5, 900), microseconds=rng.randint(0, 999999))
+        if index % 2 == 0:
+            sender, content = 'КЛИЕНТ', rng.choice(CLIENT_LINES)
+        else:
+            sender, content = 'МЕНЕДЖЕР', rng.choice(MANAGER_LINES)
+        if rng.random() < 0.05:
+            content = '[Изображение]'
+        lines.append(f"[{moment.isoformat()}] {sender}: {content}")
+    return lines
+
+
+def make_llm_responses() -> List[str]:
+    """Ответы модели: корректный, без обертки, с мусором вокруг, обрезанный и вовсе без JSON."""
+    criteria = {
+        "установление_контакта": 1, "выявление_потребностей": 0, "квалификация": 1, "презентация": 1,
+        "возражение": 0, "отработка_возражения": 0, "проговорить_договоренности": 1,
+        "закрытие_на_оплату": 0, "уточнил_цель_покупки": 1, "последующий_уточняющий": 0,
+    }
+    body = json.dumps(criteria, ensure_ascii=False, indent=2)
+    summary = "Менеджер быстро ответил, но не закрыл на оплату. " * 20
+    return [
+        f"```json\n{body}\n```\n---SUMMARY---\n{summary}",
+        f"{body}\n---SUMMARY---\n{summary}",
+        f"Вот анализ диалога:\n```json\n{body}\n```\nКомментарий: {{не JSON}}\n---SUMMARY---\n{summary}",
+        f"```json\n{body[:len(body) // 2]}\n---SUMMARY---\n{summary}",
+        f"Не удалось проанализировать диалог. {summary}",
+        "```json\n{\"установление_контакта\": 1, \"квалификация\": \"да\",}\n```\n---SUMMARY---\nкоротко",
+    ]
+
+
+def make_link_messages() -> List[Dict[str, Any]]:
+    """Сообщения менеджера: длинный текст с десятками ссылок (разрешенных и нет) и сообщения без ссылок."""
+    domains = ['yookassa.ru', 'www.tinkoff.ru', 'pay.example.com', 'bit.ly', 'vk.com', 'ozon.ru']
+    links = " ".join(f"https://{domains[i % len(domains)]}/pay/{i}?amount={i * 100}" for i in range(40))
+    return [
+        {'from': {'type': 'user', 'name': 'Менеджер'}, 'dialog': {'id': 1}, 'content': f"Варианты оплаты: {links}"},
+        {'from': {'type': 'user', 'name': 'Менеджер'}, 'dialog': {'id': 1}, 'content': MANAGER_LINES[0] * 10},
+        {'from': {'type': 'customer', 'name': 'Клиент'}, 'dialog': {'id': 1}, 'content': links},
+    ]
+
+
+def _micro_benchmarks(workdir: str) -> Dict[str, Callable[[], Any]]:
+    """Имя бенчмарка -> функция без аргументов. Данные готовятся один раз, вне замера."""
+    import data_exporter
+    import dialog_analyser
+    import dialog_listener
+    import report_generator
+
+    start = datetime(2026, 10, 19, 8, 30)
+    lines = make_dialog_lines(2000, start)
+    large_dialog_path = os.path.join(workdir, 'dialog_100500_79001234567.txt')
+    with open(large_dialog_path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines + ["строка без метки времени", "[не дата] КЛИЕНТ: битая метка"]) + "\n")
+    dialog = report_generator.get_dialog_file_details(large_dialog_path)
+    phones = ['+7 (900) 123-45-67', '89001234567', '79001234567', '8-900-123-45-67 доб. 2', 'Неизвестно', '']
+    responses = make_llm_responses()
+    link_messages = make_link_messages()
+    durations = [timedelta(seconds=s) for s in (0, 7, 59, 61, 3599, 3600, 7322, 86400 * 2 + 5)]
+    notification = (
+        "🚨 Подозрительная активность\n\nМенеджер: Иван_Петров\nДиалог ID: 100500\n"
+        "Обнаруженная ссылка: https://pay.example.com/a-b_c?x=1&y=[2]\n\n"
+        f"Сообщение: {MANAGER_LINES[1] * 20}"
+    )
+
+    return {
+        'parse_dialog_line': lambda: [report_generator.parse_dialog_line(line) for line in lines[:200]],
+        'get_dialog_file_details': lambda: report_generator.get_dialog_file_details(large_dialog_path),
+        'analyze_dialog_speed_and_status': lambda: report_generator.analyze_dialog_speed_and_status(dialog),
+        'normalize_phone': lambda: [data_exporter.normalize_phone(phone) for phone in phones],
+        'check_for_unauthorized_links': lambda: [dialog_listener.check_for_unauthorized_links(message)
+                                                 for message in link_messages],
+        'parse_openai_response': lambda: [dialog_analyser.parse_openai_response(response) for response in responses],
+        'format_timedelta': lambda: [report_generator.format_timedelta(duration) for duration in durations],
+        'escape_markdown_v2': lambda: dialog_listener.escape_markdown_v2(notification),
+    }
+
+
+def time_call(func: Callable[[], Any], repeat: int = 5, min_seconds: float = 0.2) -> Dict[str, float]:
+    """Время одного вызова (мкс): число повторов подбирается так, чтобы замер длился не меньше min_seconds."""
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * min_seconds / elapsed)) if elapsed < min_seconds else number
+    samples = [total / number * 1e6 for total in timer.repeat(repeat=repeat, number=number)]
+    return {'median_us': statistics.median(samples), 'min_us': min(samples), 'number': number}
+
+
+def bench_micro(names: List[str] | None = None, repeat: int = 5) -> Dict[str, Dict[str, float]]:
+    """
+    Прогоняет микробенчмарки. Логирование на время замера отключено (измеряются сами функции),
+    уведомления Telegram из check_for_unauthorized_links не отправляются.
+    """
+    import dialog_listener
+
+    results = {}
+    original_notify = dialog_listener.send_telegram_notification
+    dialog_listener.send_telegram_notification = lambda text, topic_id: None
+    logging.disable(logging.CRITICAL)
+    try:
+        with tempfile.TemporaryDirectory(prefix='bench-') as workdir:
+            benchmarks = _micro_benchmarks(workdir)
+            for name in names or list(benchmarks):
+                if name not in benchmarks:
+                    raise ValueError(f"Неизвестный бенчмарк: {name}")
+                results[name] = time_call(benchmarks[name], repeat=repeat)
+    finally:
+        logging.disable(logging.NOTSET)
+        dialog_listener.send_telegram_notification = original_notify
+    return results
+
+
+def _git_revision() -> str | None:
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_DIR,
+                                capture_output=True, text=True, check=True)
+        return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path: str = BENCHMARK_HISTORY_PATH) -> List[Dict[str, Any]]:
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def append_history(results: Dict[str, Dict[str, float]], path: str = BENCHMARK_HISTORY_PATH):
+    record = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'machine': platform.node(),
+        'results': {name: round(item['median_us'], 3) for name, item in results.items()},
+    }
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def compare_with_history(results: Dict[str, Dict[str, float]], history: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Сравнивает медиану с базовой линией — медианой последних REGRESSION_BASELINE_RUNS запусков
+    на этой же машине и версии Python (другое железо сравнивать бессмысленно).
+    """
+    same_env = [record for record in history
+                if record.get('machine') == platform.node() and record.get('python') == platform.python_version()]
+    comparison = {}
+    for name, item in results.items():
+        previous = [record['results'][name] for record in same_env if name in record.get('results', {})]
+        previous = previous[-REGRESSION_BASELINE_RUNS:]
+        baseline = statistics.median(previous) if previous else None
+        ratio = item['median_us'] / baseline if baseline else None
+        comparison[name] = {
+            'baseline_us': baseline,
+            'ratio': ratio,
+            'regression': ratio is not None and ratio > REGRESSION_THRESHOLD,
+        }
+    return comparison
+
+
+# --- Синтетический корпус диалогов ---
+
+# Доли диалогов по дате последнего сообщения: сегодня (в отчет), за последние дни, старше MAX_DIALOG_AGE_DAYS
+CORPUS_AGE_SHARES = {'today': 0.45, 'recent': 0.35, 'old': 0.20}
+
+
+def _corpus_message_count(rng: random.Random) -> int:
+    """Длина диалога: в основном короткие, небольшая доля очень длинных."""
+    roll = rng.random()
+    if roll < 0.6:
+        return rng.randint(2, 10)
+    if roll < 0.95:
+        return rng.randint(11, 60)
+    return rng.randint(200, 600)
+
+
+def generate_corpus(root: str, files: int, active_share: float = 0.2, seed: int = 1,
+                    now: datetime | None = None) -> Dict[str, Any]:
+    """
+    Пишет files файлов диалогов в root/dialogs/active и root/dialogs/closed в формате save_message_to_file.
+    Даты последнего сообщения распределены по CORPUS_AGE_SHARES, часть диалогов длится несколько дней,
+    около 10% телефонов повторяются (клиент с несколькими диалогами), 5% строк — изображения.
+    active_share — доля диалогов текущего дня, оставшихся в active (их отчет закрывает принудительно).
+    Возвращает сводку и список телефонов диалогов текущего дня.
+    """
+    rng = random.Random(seed)
+    now = now or datetime.now()
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    today_window = max(60, int((now - midnight).total_seconds()) - 60)
+    active_dir = os.path.join(root, 'dialogs', 'active')
+    closed_dir = os.path.join(root, 'dialogs', 'closed')
+    os.makedirs(active_dir, exist_ok=True)
+    os.makedirs(closed_dir, exist_ok=True)
+
+    phones: List[str] = []
+    today_phones = set()
+    counts = Counter()
+    for index in range(files):
+        if phones and rng.random() < 0.1:
+            phone = rng.choice(phones)
+        else:
+            phone = f"79{rng.randint(0, 999_999_999):09d}"
+            phones.append(phone)
+
+        roll = rng.random()
+        if roll < CORPUS_AGE_SHARES['today']:
+            age = 'today'
+            last_time = midnight + timedelta(seconds=rng.randint(0, today_window))
+        elif roll < CORPUS_AGE_SHARES['today'] + CORPUS_AGE_SHARES['recent']:
+            age = 'recent'
+            last_time = midnight - timedelta(days=rng.randint(0, 1), seconds=rng.randint(1, 86399))
+        else:
+            age = 'old'
+            last_time = midnight - timedelta(days=rng.randint(4, 10), seconds=rng.randint(0, 86399))
+
+        message_count = _corpus_message_count(rng)
+        # Каждый пятый диалог растянут на несколько дней
+        span = timedelta(days=rng.randint(1, 3)) if rng.random() < 0.2 else timedelta(minutes=rng.randint(1, 240))
+        step = span / message_count
+        moment = last_time - span
+        from_client = True
+        lines = []
+        for _ in range(message_count):
+            moment += step
+            sender = 'КЛИЕНТ' if from_client else 'МЕНЕДЖЕР'
+            if rng.random() < 0.05:
+                content = 'Изображение'
+            else:
+                content = rng.choice(CLIENT_LINES if from_client else MANAGER_LINES)
+            lines.append(f"[{moment.isoformat()}] {sender}: {content}\n")
+            # Клиент иногда пишет несколько сообщений подряд, диалог может закончиться на клиенте
+            from_client = rng.random() < 0.35 if from_client else True
+        lines[-1] = f"[{last_time.isoformat()}]" + lines[-1].split(']', 1)[1]
+
+        in_active = rng.random() < (active_share if age == 'today' else 0.5)
+        directory = active_dir if in_active else closed_dir
+        with open(os.path.join(directory, f"dialog_{500000 + index}_{phone}.txt"), 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+        counts[f"{age}_{'active' if in_active else 'closed'}"] += 1
+        if age == 'today':
+            today_phones.add(phone)
+
+    return {'files': files, 'counts': dict(counts), 'today_phones': sorted(today_phones)}
+
+
+def _seed_report_orders(retailcrm, phones: List[str], seed: int = 1):
+    """Клиенты и заказы для телефонов дня: у части — новый заказ, у части — оплаченный день в день."""
+    import report_generator
+
+    rng = random.Random(seed)
+    today = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    old = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d %H:%M:%S')
+    retailcrm.add_user(1, "Менеджер", "1")
+    for customer_id, phone in enumerate(phones, start=1):
+        retailcrm.add_customer(customer_id, phone)
+        roll = rng.random()
+        if roll < 0.4:
+            retailcrm.add_order(customer_id, customer_id, status='new', managerId=1,
+                                totalSumm=rng.randint(5, 300) * 100)
+        elif roll < 0.5:
+            retailcrm.add_order(customer_id, customer_id, status=rng.choice(sorted(report_generator.PAYMENT_STATUSES)),
+                                managerId=1, totalSumm=rng.randint(5, 300) * 100)
+        elif roll < 0.8:
+            retailcrm.add_order(customer_id, customer_id, status='complete', createdAt=old, statusUpdatedAt=old)
+        # У остальных заказов нет: клиент попадет в список "без актуального заказа"
+    return today
+
+
+class _PhaseTimer:
+    """Подменяет функции модуля обертками, которые копят число вызовов и суммарное время."""
+
+    def __init__(self, module, names: List[str]):
+        self.module = module
+        self.phases = {name: {'calls': 0, 'seconds': 0.0} for name in names}
+        self.results: Dict[str, Any] = {}
+        self._originals = {name: getattr(module, name) for name in names}
+
+    def __enter__(self):
+        for name, original in self._originals.items():
+            setattr(self.module, name, self._wrap(name, original))
+        return self
+
+    def __exit__(self, *exc):
+        for name, original in self._originals.items():
+            setattr(self.module, name, original)
+
+    def _wrap(self, name: str, original: Callable):
+        phase = self.phases[name]
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = original(*args, **kwargs)
+                self.results[name] = result
+                return result
+            finally:
+                phase['calls'] += 1
+                phase['seconds'] += time.perf_counter() - start
+        return timed
+
+
+REPORT_PHASES = ['manage_and_get_dialogs', 'analyze_dialog_speed_and_status', 'refresh_order_mirror',
+                 'process_new_dialogs', 'get_day_in_day_paid_orders', 'send_report_to_telegram']
+
+
+def bench_report(files: int, workdir: str | None = None, active_share: float = 0.2, seed: int = 1,
+                 trace_memory: bool = False) -> Dict[str, Any]:
+    """
+    Генерирует корпус и прогоняет generate_daily_report против локальных заглушек.
+    trace_memory включает tracemalloc (точный пик памяти Python, но прогон заметно медленнее);
+    без него пик памяти — рост ru_maxrss процесса.
+    """
+    import resource
+    from local_standins import RetailCRMStandIn, OpenAIStandIn, GoogleStandIn, TelegramStandIn
+    from replay_harness import configure
+
+    workdir = workdir or tempfile.mkdtemp(prefix='report-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+
+    start = time.perf_counter()
+    corpus = generate_corpus(workdir, files, active_share, seed)
+    corpus_seconds = time.perf_counter() - start
+
+    standins = {'retailcrm': RetailCRMStandIn(), 'openai': OpenAIStandIn(), 'google': GoogleStandIn(),
+                'telegram': TelegramStandIn()}
+    for standin in standins.values():
+        standin.start()
+    try:
+        configure(standins['retailcrm'], standins['openai'], standins['google'], standins['telegram'])
+        import data_exporter
+        import report_generator
+        data_exporter.ANALYSIS_SHEET_CSV_URL = standins['google'].analysis_sheet_csv_url
+        _seed_report_orders(standins['retailcrm'], corpus['today_phones'], seed)
+
+        rss_before_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        if trace_memory:
+            tracemalloc.start()
+        with _PhaseTimer(report_generator, REPORT_PHASES) as timer, contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            report_generator.generate_daily_report()
+            total_seconds = time.perf_counter() - start
+            # Принудительное закрытие активных диалогов идет в фоне после отчета
+            report_generator.wait_forced_closes()
+            forced_close_seconds = time.perf_counter() - start - total_seconds
+        traced_peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20 if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+        rss_after_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    finally:
+        for standin in standins.values():
+            standin.stop()
+
+    return {
+        'files': files,
+        'corpus': corpus['counts'],
+        'corpus_seconds': corpus_seconds,
+        'total_seconds': total_seconds,
+        'dialogs_in_report': len(timer.results.get('manage_and_get_dialogs') or []),
+        'phases': timer.phases,
+        'forced_close_seconds': forced_close_seconds,
+        'forced_close': dict(report_generator.LAST_FORCED_CLOSE_SUMMARY),
+        'rss_peak_mb': rss_after_mb,
+        'rss_growth_mb': rss_after_mb - rss_before_mb,
+        'traced_peak_mb': traced_peak_mb,
+        'standin_requests': {name: len(standin.requests) for name, standin in standins.items()},
+        'workdir': workdir,
+    }
+
+
+def format_report_bench(result: Dict[str, Any]) -> str:
+    traced = f", tracemalloc {result['traced_peak_mb']:.0f} МБ" if result['traced_peak_mb'] is not None else ""
+    lines = [
+        f"Файлов: {result['files']} (корпус за {result['corpus_seconds']:.1f} с: "
+        + ", ".join(f"{name} {count}" for name, count in sorted(result['corpus'].items())) + ")",
+        f"generate_daily_report: {result['total_seconds']:.1f} с, диалогов в отчете {result['dialogs_in_report']}, "
+        f"пик RSS {result['rss_peak_mb']:.0f} МБ (+{result['rss_growth_mb']:.0f}){traced}",
+    ]
+    for name, phase in result['phases'].items():
+        lines.append(f"   {name:34} {phase['seconds']:8.2f} с ({phase['calls']} вызовов)")
+    forced = result['forced_close']
+    if forced:
+        lines.append(f"Фоновое закрытие после отчета: еще {result['forced_close_seconds']:.1f} с, "
+                     f"успешно {forced['succeeded']} из {forced['total']}, ошибок {forced['failed']}, "
+                     f"не успели {forced['not_finished']}")
+    lines.append("Запросов к заглушкам: " + ", ".join(f"{name} {count}"
+                                                    for name, count in result['standin_requests'].items()))
+    return "\n".join(lines)
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Бенчмарки проекта.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    imports_parser = subparsers.add_parser('imports', help="Время импорта модулей")
+    imports_parser.add_argument('modules', nargs='*', help="Модули (по умолчанию — все из IMPORT_BUDGETS_MS)")
+    imports_parser.add_argument('--runs', type=int, default=5)
+    imports_parser.add_argument('--check', action='store_true', help="Код 1 при превышении бюджета")
+
+    micro_parser = subparsers.add_parser('micro', help="Микробенчмарки горячих функций")
+    micro_parser.add_argument('names', nargs='*', help="Бенчмарки (по умолчанию — все)")
+    micro_parser.add_argument('--repeat', type=int, default=5)
+    micro_parser.add_argument('--no-save', action='store_true', help="Не дописывать результат в историю")
+    micro_parser.add_argument('--check', action='store_true', help="Код 1 при замедлении относительно истории")
+
+    corpus_parser = subparsers.add_parser('corpus', help="Синтетический корпус файлов диалогов")
+    corpus_parser.add_argument('directory', help="Каталог, в котором будет создан dialogs/")
+    corpus_parser.add_argument('--files', type=int, default=10000)
+    corpus_parser.add_argument('--active-share', type=float, default=0.2)
+    corpus_parser.add_argument('--seed', type=int, default=1)
+
+    report_parser = subparsers.add_parser('report', help="Масштабный прогон generate_daily_report")
+    report_parser.add_argument('--files', type=int, default=10000)
+    report_parser.add_argument('--sizes', help="Несколько размеров через запятую, каждый в отдельном процессе")
+    report_parser.add_argument('--workdir', help="Рабочий каталог (по умолчанию временный)")
+    report_parser.add_argument('--active-share', type=float, default=0.2)
+    report_parser.add_argument('--seed', type=int, default=1)
+    report_parser.add_argument('--tracemalloc', action='store_true', help="Точный пик памяти Python (медленнее)")
+    report_parser.add_argument('--json', action='store_true')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'imports':
+        results = bench_imports(args.runs, args.modules or None)
+        for item in results:
+            budget = f"{item['budget_ms']} мс" if item['budget_ms'] is not None else "—"
+            lazy = f" загружены: {', '.join(item['lazy_loaded'])}" if item['lazy_loaded'] else ""
+            print(f"{'OK ' if item['ok'] else 'FAIL'} {item['module']:20} медиана {item['median_ms']:7.1f} мс "
+                  f"(мин {item['min_ms']:.1f}, бюджет {budget}){lazy}")
+        if args.check and not all(item['ok'] for item in results):
+            return 1
+    elif args.command == 'micro':
+        results = bench_micro(args.names or None, args.repeat)
+        comparison = compare_with_history(results, load_history())
+        for name, item in results.items():
+            compared = comparison[name]
+            baseline = (f"база {compared['baseline_us']:.1f} мкс, x{compared['ratio']:.2f}"
+                        if compared['baseline_us'] else "база —")
+            print(f"{'SLOW' if compared['regression'] else 'OK  '} {name:32} {item['median_us']:10.1f} мкс "
+                  f"(мин {item['min_us']:.1f}, {baseline})")
+        if not args.no_save:
+            append_history(results)
+        if args.check and any(compared['regression'] for compared in comparison.values()):
+            return 1
+    elif args.command == 'corpus':
+        summary = generate_corpus(args.directory, args.files, args.active_share, args.seed)
+        print(f"Создано {summary['files']} файлов: {summary['counts']}")
+    elif args.command == 'report':
+        if args.sizes:
+            for size in [int(size) for size in args.sizes.split(',')]:
+                command = [sys.executable, os.path.abspath(__file__), 'report', '--files', str(size), '--json',
+                           '--active-share', str(args.active_share), '--seed', str(args.seed)]
+                if args.tracemalloc:
+                    command.append('--tracemalloc')
+                output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+                print(format_report_bench(json.loads(output)) + "\n")
+            return 0
+        logging.getLogger().setLevel(logging.WARNING)
+        result = bench_report(args.files, args.workdir, args.active_share, args.seed, args.tracemalloc)
+        print(json.dumps(result, ensure_ascii=False, indent=2) if args.json else format_report_bench(result))
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(main())
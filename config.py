@@ -12,12 +12,16 @@ RETAILCRM_API_KEY = os.getenv("RETAILCRM_API_KEY")
 
 # OpenAI API Key
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# Альтернативный адрес API OpenAI (например, локальная заглушка из local_standins). Пусто — api.openai.com
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
 
 # Настройки Telegram и Google Forms
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 TELEGRAM_TOPIC_ID = os.getenv("TELEGRAM_TOPIC_ID")
 TELEGRAM_WARNINGS_TOPIC_ID = os.getenv("TELEGRAM_WARNINGS_TOPIC_ID")
+# Адрес Bot API (для локальной заглушки из local_standins)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
 
 # Google Forms URL для полного анализа (с критериями OpenAI)
 GOOGLE_FORMS_URL = os.getenv("GOOGLE_FORMS_URL")
@@ -27,6 +31,193 @@ GOOGLE_FORMS_URL = os.getenv("GOOGLE_FORMS_URL")
 GOOGLE_FORMS_URL_FREE = os.getenv("GOOGLE_FORMS_URL_FREE")
 
 
+# --- Настройки очереди экспорта (outbox) ---
+
+# SQLite-файл очереди. По умолчанию лежит в dialogs/, которая смонтирована как volume в docker-compose
+OUTBOX_DB_PATH = os.getenv("OUTBOX_DB_PATH", "dialogs/outbox.sqlite3")
+# Количество фоновых потоков, разбирающих очередь
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "2"))
+# После стольких неудачных попыток строка уходит в карантин
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+# Экспоненциальная задержка между попытками: base * 2^(attempt-1), но не больше max
+OUTBOX_BASE_BACKOFF_SECONDS = float(os.getenv("OUTBOX_BASE_BACKOFF_SECONDS", "5"))
+OUTBOX_MAX_BACKOFF_SECONDS = float(os.getenv("OUTBOX_MAX_BACKOFF_SECONDS", "3600"))
+# Строка 'in_progress', не обновлявшаяся столько секунд, считается брошенной (процесс упал во время доставки)
+# и возвращается в очередь. Должно быть заметно больше времени доставки одной пачки
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "300"))
+
+
+# --- Настройки приемника экспорта ---
+
+# 'forms'  — каждая строка отправляется отдельным POST в Google Forms (по умолчанию)
+# 'sheets' — строки копятся и дописываются пачкой через Google Sheets API (values:append)
+EXPORT_SINK = os.getenv("EXPORT_SINK", "forms")
+# Дополнительные приемники через запятую, получают копию каждой строки (например, "warehouse")
+EXPORT_EXTRA_SINKS = [name.strip() for name in os.getenv("EXPORT_EXTRA_SINKS", "").split(",") if name.strip()]
+# Базовый URL таблицы для Sheets API, например https://sheets.googleapis.com/v4/spreadsheets/<ID>
+SHEETS_API_URL = os.getenv("SHEETS_API_URL")
+# OAuth-токен (Bearer) с доступом на запись в таблицу
+SHEETS_API_TOKEN = os.getenv("SHEETS_API_TOKEN")
+# Листы, в которые дописываются строки полного анализа и базового экспорта
+SHEETS_RANGE_FULL = os.getenv("SHEETS_RANGE_FULL", "Анализ чатов 23.30")
+SHEETS_RANGE_FREE = os.getenv("SHEETS_RANGE_FREE", "Хранение чатов")
+# Пачка отправляется, когда набралось EXPORT_BATCH_SIZE строк или самой старой из них больше EXPORT_FLUSH_INTERVAL_SECONDS
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "50"))
+EXPORT_FLUSH_INTERVAL_SECONDS = float(os.getenv("EXPORT_FLUSH_INTERVAL_SECONDS", "30"))
+# Локальное колоночное хранилище результатов анализа (Parquet, партиции по дням)
+ANALYSIS_WAREHOUSE_DIR = os.getenv("ANALYSIS_WAREHOUSE_DIR", "dialogs/warehouse")
+
+
+# --- Настройки конвейера обработки закрытых диалогов ---
+
+# Сколько диалогов одновременно может находиться на каждом этапе конвейера (data_exporter.PIPELINE_STAGES)
+PIPELINE_STAGE_LIMITS = {
+    'load': int(os.getenv("PIPELINE_LIMIT_LOAD", "16")),
+    'claim': int(os.getenv("PIPELINE_LIMIT_CLAIM", "16")),
+    'enrich': int(os.getenv("PIPELINE_LIMIT_ENRICH", "8")),
+    'filter': int(os.getenv("PIPELINE_LIMIT_FILTER", "16")),
+    'analyze': int(os.getenv("PIPELINE_LIMIT_ANALYZE", "4")),
+    'export': int(os.getenv("PIPELINE_LIMIT_EXPORT", "8")),
+    'archive': int(os.getenv("PIPELINE_LIMIT_ARCHIVE", "16")),
+}
+
+
+# --- Журнал обработки закрытых диалогов ---
+
+# SQLite-файл журнала: каждая версия диалога (dialog_id + хэш текста) анализируется и экспортируется один раз
+LEDGER_DB_PATH = os.getenv("LEDGER_DB_PATH", "dialogs/ledger.sqlite3")
+# Запись 'in_progress', не обновлявшаяся столько секунд, считается брошенной (перехватывается другим обработчиком)
+LEDGER_STALE_SECONDS = int(os.getenv("LEDGER_STALE_SECONDS", "1800"))
+# Сколько раз можно повторить обработку версии диалога, завершившуюся ошибкой
+LEDGER_MAX_ATTEMPTS = int(os.getenv("LEDGER_MAX_ATTEMPTS", "3"))
+# Пауза перед повтором обработки закрытого диалога слушателем, если OpenAI недоступен (удваивается с каждой попыткой)
+LEDGER_RETRY_BASE_SECONDS = float(os.getenv("LEDGER_RETRY_BASE_SECONDS", "60"))
+LEDGER_RETRY_MAX_SECONDS = float(os.getenv("LEDGER_RETRY_MAX_SECONDS", "900"))
+# Сколько дней хранить записи журнала
+LEDGER_RETENTION_DAYS = int(os.getenv("LEDGER_RETENTION_DAYS", "30"))
+
+
+# --- Локальный индекс клиентов (телефон -> клиент -> заказы) ---
+
+CUSTOMER_INDEX_DB_PATH = os.getenv("CUSTOMER_INDEX_DB_PATH", "dialogs/customer_index.sqlite3")
+# Период фоновой синхронизации с /api/v5/customers/history
+CUSTOMER_INDEX_SYNC_INTERVAL_SECONDS = int(os.getenv("CUSTOMER_INDEX_SYNC_INTERVAL_SECONDS", "60"))
+# За сколько дней заказы попадают в индекс при первичной выгрузке
+CUSTOMER_INDEX_ORDERS_DAYS = int(os.getenv("CUSTOMER_INDEX_ORDERS_DAYS", "90"))
+# Насколько устаревшему индексу можно доверять при обработке закрытых диалогов в реальном времени
+CUSTOMER_INDEX_MAX_STALENESS_SECONDS = int(os.getenv("CUSTOMER_INDEX_MAX_STALENESS_SECONDS", "180"))
+
+
+# --- Локальное зеркало заказов (хвост /api/v5/orders/history по sinceId) ---
+
+ORDER_MIRROR_DB_PATH = os.getenv("ORDER_MIRROR_DB_PATH", "dialogs/order_mirror.sqlite3")
+ORDER_MIRROR_SYNC_INTERVAL_SECONDS = int(os.getenv("ORDER_MIRROR_SYNC_INTERVAL_SECONDS", "30"))
+# Глубина зеркала: заказы, не менявшиеся дольше, удаляются
+ORDER_MIRROR_DAYS = int(os.getenv("ORDER_MIRROR_DAYS", "90"))
+# Насколько отставшему зеркалу можно доверять вместо прямых запросов к RetailCRM
+ORDER_MIRROR_MAX_STALENESS_SECONDS = int(os.getenv("ORDER_MIRROR_MAX_STALENESS_SECONDS", "120"))
+
+
+# --- Ограничение запросов к RetailCRM ---
+
+# Общий лимит запросов к /api/v5 на процесс (RetailCRM допускает 10 запросов в секунду с одного IP)
+RETAILCRM_MAX_RPS = float(os.getenv("RETAILCRM_MAX_RPS", "10"))
+# Сколько клиентов отчет проверяет в RetailCRM одновременно (метрика 2)
+REPORT_ENRICH_CONCURRENCY = int(os.getenv("REPORT_ENRICH_CONCURRENCY", "8"))
+# Сколько следующих страниц списка RetailCRM загружается заранее, пока обрабатывается текущая (0 — по одной)
+RETAILCRM_PREFETCH_PAGES = int(os.getenv("RETAILCRM_PREFETCH_PAGES", "3"))
+# Глубина снимка заказов для отчета, когда зеркало заказов несвежее: заказы, созданные за столько дней,
+# выгружаются постранично, и метрики 2 и 6 считаются по ним в памяти (не меньше MAX_ORDER_AGE_DAYS отчета)
+REPORT_ORDERS_LOOKBACK_DAYS = int(os.getenv("REPORT_ORDERS_LOOKBACK_DAYS", "30"))
+
+
+# --- Кэш результатов анализа OpenAI ---
+
+ANALYSIS_CACHE_ENABLED = os.getenv("ANALYSIS_CACHE_ENABLED", "1") == "1"
+ANALYSIS_CACHE_DB_PATH = os.getenv("ANALYSIS_CACHE_DB_PATH", "dialogs/analysis_cache.sqlite3")
+# Ограничения размера кэша: при превышении вытесняются самые давно использованные записи
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "50000"))
+ANALYSIS_CACHE_MAX_BYTES = int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+
+# --- Формат ответа OpenAI ---
+
+# 1 — Structured Outputs: ответ строго по JSON-схеме (критерии, chat_category, summary) со строгой проверкой.
+# 0 — прежний текстовый формат (```json + ---SUMMARY---) с разбором регулярными выражениями
+ANALYSIS_STRUCTURED_OUTPUT = os.getenv("ANALYSIS_STRUCTURED_OUTPUT", "1") == "1"
+# Сколько раз просить модель исправить ответ, не прошедший проверку
+ANALYSIS_REPAIR_ATTEMPTS = int(os.getenv("ANALYSIS_REPAIR_ATTEMPTS", "1"))
+
+
+# --- Локальный предклассификатор нецелевых диалогов ---
+
+# off — выключен; shadow — только сравнение с ответом модели; on — уверенные нецелевые диалоги без запроса к OpenAI
+PRECLASSIFIER_MODE = os.getenv("PRECLASSIFIER_MODE", "shadow")
+PRECLASSIFIER_MIN_CONFIDENCE = float(os.getenv("PRECLASSIFIER_MIN_CONFIDENCE", "0.85"))
+# zero — полный экспорт с нулевыми оценками и категорией; free — базовый экспорт
+PRECLASSIFIER_ROUTE = os.getenv("PRECLASSIFIER_ROUTE", "zero")
+
+
+# --- Метрики запросов к OpenAI ---
+
+ANALYSIS_METRICS_ENABLED = os.getenv("ANALYSIS_METRICS_ENABLED", "1") == "1"
+ANALYSIS_METRICS_DB_PATH = os.getenv("ANALYSIS_METRICS_DB_PATH", "dialogs/analysis_metrics.sqlite3")
+ANALYSIS_METRICS_RETENTION_DAYS = int(os.getenv("ANALYSIS_METRICS_RETENTION_DAYS", "30"))
+# Цены моделей в долларах за 1 млн токенов (для дневной стоимости в отчете)
+OPENAI_MODEL_PRICES = {
+    'gpt-5-mini': {'input': 0.25, 'cached_input': 0.025, 'output': 2.00},
+}
+# Скидка Batch API: стоимость пакетных запросов умножается на этот коэффициент
+OPENAI_BATCH_PRICE_FACTOR = float(os.getenv("OPENAI_BATCH_PRICE_FACTOR", "0.5"))
+
+
+# --- Сжатие диалога перед анализом OpenAI ---
+
+# Бюджет токенов на текст диалога: длинные переписки сокращаются из середины
+ANALYSIS_MAX_DIALOG_TOKENS = int(os.getenv("ANALYSIS_MAX_DIALOG_TOKENS", "6000"))
+# Сколько первых сообщений сохраняется всегда
+ANALYSIS_KEEP_HEAD_MESSAGES = int(os.getenv("ANALYSIS_KEEP_HEAD_MESSAGES", "12"))
+
+
+# --- Запросы к OpenAI (асинхронный движок) ---
+
+# Максимальный параллелизм запросов; фактический лимит подстраивается под заголовки x-ratelimit-*
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+OPENAI_MAX_ATTEMPTS = int(os.getenv("OPENAI_MAX_ATTEMPTS", "6"))
+OPENAI_BASE_BACKOFF_SECONDS = float(os.getenv("OPENAI_BASE_BACKOFF_SECONDS", "1"))
+OPENAI_MAX_BACKOFF_SECONDS = float(os.getenv("OPENAI_MAX_BACKOFF_SECONDS", "30"))
+# Дедлайн на весь запрос анализа, включая ожидание слота и повторы
+OPENAI_REQUEST_DEADLINE_SECONDS = float(os.getenv("OPENAI_REQUEST_DEADLINE_SECONDS", "180"))
+
+
+# --- Пакетный анализ OpenAI (Batch API) для принудительно закрываемых диалогов ---
+
+# 1 — диалоги, закрываемые в 23:00, анализируются одним пакетом Batch API вместо последовательных запросов
+ANALYSIS_BATCH_MODE = os.getenv("ANALYSIS_BATCH_MODE", "0") == "1"
+# Сколько ждать завершения пакета. Должно быть меньше LEDGER_STALE_SECONDS: пока пакет
+# выполняется, диалоги остаются захваченными в журнале обработки
+ANALYSIS_BATCH_TIMEOUT_SECONDS = int(os.getenv("ANALYSIS_BATCH_TIMEOUT_SECONDS", "1500"))
+ANALYSIS_BATCH_POLL_SECONDS = float(os.getenv("ANALYSIS_BATCH_POLL_SECONDS", "15"))
+
+
+# --- Фоновое принудительное закрытие диалогов после отчета ---
+
+# Отчет строится сразу по уже прочитанным сообщениям, а анализ и экспорт активных диалогов
+# выполняются в фоне пулом из стольких потоков
+FORCED_CLOSE_WORKERS = int(os.getenv("FORCED_CLOSE_WORKERS", "4"))
+# Срок на фоновое закрытие: не начатые к этому времени диалоги остаются в active, итог уходит в Telegram
+FORCED_CLOSE_DEADLINE_SECONDS = float(os.getenv("FORCED_CLOSE_DEADLINE_SECONDS", "1800"))
+
+
+# --- Промежуточные метрики 3–5, которые ведет слушатель ---
+
+# 1 — слушатель обновляет метрики скорости ответа и неотвеченных чатов по каждому сообщению,
+# и отчет берет их готовыми вместо разбора всех файлов диалогов
+INTRADAY_METRICS_ENABLED = os.getenv("INTRADAY_METRICS_ENABLED", "1") == "1"
+INTRADAY_METRICS_PATH = os.getenv("INTRADAY_METRICS_PATH", "dialogs/intraday_metrics.json")
+INTRADAY_METRICS_CHECKPOINT_SECONDS = float(os.getenv("INTRADAY_METRICS_CHECKPOINT_SECONDS", "30"))
+
+
 # --- Настройки фильтрации RetailCRM ---
 
 # Запрещенный метод оформления заказа, при котором анализ не проводится
@@ -74,11 +265,20 @@ ALLOWED_PAYMENT_DOMAINS = [
 # Статичные категории для анализа (можно оставить в коде)
 CATEGORIES = ['Заказ', 'Консультация', 'Технический', 'Доставка', 'Неизвестно']
 
+# Ключи критериев чек-листа ОКК в JSON-ответе OpenAI (порядок совпадает с колонками таблицы анализа)
+ANALYSIS_CRITERIA = [
+    'установление_контакта', 'выявление_потребностей', 'квалификация', 'презентация', 'возражение',
+    'отработка_возражения', 'проговорить_договоренности', 'закрытие_на_оплату', 'уточнил_цель_покупки',
+    'последующий_уточняющий',
+]
+
 # Остальные настройки
 MG_URL = RETAILCRM_API_URL
 
 
-# Адаптированный PROMPT_TEMPLATE для анализа чатов
+# Адаптированный PROMPT_TEMPLATE для анализа чатов.
+# Это системное сообщение: {0} — список категорий. Текст диалога отправляется отдельным сообщением
+# пользователя, поэтому начало запроса одинаково для всех диалогов и попадает в кэш промптов OpenAI.
 PROMPT_TEMPLATE = """Ты эксперт по продажам, анализирующий текстовые диалоги в чатах. Твоя задача — внимательно проанализировать **только предоставленную переписку** между Менеджером и Клиентом и выставить ТОЧНУЮ оценку по каждому из 12 критериев из чек-листа ОКК. **Строго запрещено** делать предположения о действиях, которых нет в тексте. Если менеджер не задал какой-то вопрос или не совершил действие, **строго ставь 0 или -1 в JSON-оценках и пропускай этот пункт в SUMMARY.**
 
 **Категоризация диалога:**
@@ -192,6 +392,5 @@ PROMPT_TEMPLATE = """Ты эксперт по продажам, анализир
 
 <b>Общие рекомендации:</b> Что можно улучшить в работе менеджера (конкретные рекомендации по развитию навыков или подходов).
 
-Текст чата для анализа:
-{1}
+Текст чата для анализа придет следующим сообщением пользователя.
 """
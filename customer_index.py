@@ -0,0 +1,448 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Iterable
+
+import config
+from phone_utils import normalize_phone_digits
+from retailcrm_api import api_get as _api_get, iter_pages as _iter_pages, PAGE_LIMIT
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Локальный индекс "нормализованный телефон -> клиент -> заказы".
+# Первичное наполнение — постраничная выгрузка /api/v5/customers (и заказов за CUSTOMER_INDEX_ORDERS_DAYS),
+# дальше индекс догоняет изменения через /api/v5/customers/history и /api/v5/orders/history с filter[sinceId].
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS customer_phones (
+    phone TEXT NOT NULL,
+    customer_id INTEGER NOT NULL,
+    PRIMARY KEY (phone, customer_id)
+);
+CREATE INDEX IF NOT EXISTS idx_customer_phones_customer ON customer_phones(customer_id);
+CREATE TABLE IF NOT EXISTS customer_orders (
+    customer_id INTEGER NOT NULL,
+    order_id INTEGER NOT NULL,
+    created_at TEXT,
+    PRIMARY KEY (customer_id, order_id)
+);
+CREATE INDEX IF NOT EXISTS idx_customer_orders_order ON customer_orders(order_id);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+_db_lock = threading.Lock()
+_sync_lock = threading.Lock()
+_initialized = False
+_sync_thread: threading.Thread | None = None
+
+
+# --------------------------------------- #
+#            Работа с базой
+# --------------------------------------- #
+
+def _connect() -> sqlite3.Connection:
+    db_dir = os.path.dirname(config.CUSTOMER_INDEX_DB_PATH)
+    if db_dir and not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+    conn = sqlite3.connect(config.CUSTOMER_INDEX_DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def init_index():
+    global _initialized
+    with _db_lock:
+        if _initialized:
+            return
+        conn = _connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            conn.commit()
+        finally:
+            conn.close()
+        _initialized = True
+
+
+def _get_state(key: str) -> str | None:
+    init_index()
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return row['value'] if row else None
+    finally:
+        conn.close()
+
+
+def _set_state(conn: sqlite3.Connection, key: str, value: str):
+    conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, value))
+
+
+def is_ready() -> bool:
+    """Индекс прошел первичное наполнение и ему можно доверять."""
+    return _get_state('bootstrapped_at') is not None
+
+
+def is_fresh() -> bool:
+    """
+    Заказы в индексе синхронизированы не позже CUSTOMER_INDEX_MAX_STALENESS_SECONDS назад.
+    Обработке закрытых диалогов в реальном времени нужен свежий индекс: заказ мог быть создан минуту назад.
+    """
+    synced_at = _get_state('orders_synced_at')
+    if not synced_at or not is_ready():
+        return False
+    age = datetime.now() - datetime.strptime(synced_at, '%Y-%m-%d %H:%M:%S')
+    return age.total_seconds() <= config.CUSTOMER_INDEX_MAX_STALENESS_SECONDS
+
+
+# --------------------------------------- #
+#            Наполнение индекса
+# --------------------------------------- #
+
+def _customer_phones(customer: Dict[str, Any]) -> set:
+    phones = {normalize_phone_digits(phone.get('number')) for phone in customer.get('phones', []) or []}
+    phones.discard("")
+    return phones
+
+
+def index_customers(customers: Iterable[Dict[str, Any]]) -> int:
+    """Заменяет телефоны переданных клиентов в индексе. Возвращает количество клиентов."""
+    init_index()
+    count = 0
+    with _db_lock:
+        conn = _connect()
+        try:
+            for customer in customers:
+                customer_id = customer.get('id')
+                if not customer_id:
+                    continue
+                conn.execute("DELETE FROM customer_phones WHERE customer_id = ?", (customer_id,))
+                conn.executemany(
+                    "INSERT OR IGNORE INTO customer_phones (phone, customer_id) VALUES (?, ?)",
+                    [(phone, customer_id) for phone in _customer_phones(customer)]
+                )
+                count += 1
+            conn.commit()
+        finally:
+            conn.close()
+    return count
+
+
+def remove_customers(customer_ids: Iterable[int]):
+    init_index()
+    with _db_lock:
+        conn = _connect()
+        try:
+            for customer_id in customer_ids:
+                conn.execute("DELETE FROM customer_phones WHERE customer_id = ?", (customer_id,))
+                conn.execute("DELETE FROM customer_orders WHERE customer_id = ?", (customer_id,))
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def index_orders(orders: Iterable[Dict[str, Any]]) -> int:
+    """
+    Привязывает заказы к клиентам в индексе. Телефоны из заказа тоже попадают в индекс:
+    по ним клиент находится, даже если в карточке клиента номер не заполнен.
+    """
+    init_index()
+    count = 0
+    with _db_lock:
+        conn = _connect()
+        try:
+            for order in orders:
+                customer = order.get('customer') or {}
+                customer_id = customer.get('id')
+                if not order.get('id') or not customer_id:
+                    continue
+                # Заказ могли перепривязать к другому клиенту
+                conn.execute("DELETE FROM customer_orders WHERE order_id = ? AND customer_id != ?",
+                             (order['id'], customer_id))
+                conn.execute(
+                    "INSERT OR REPLACE INTO customer_orders (customer_id, order_id, created_at) VALUES (?, ?, ?)",
+                    (customer_id, order['id'], order.get('createdAt'))
+                )
+                phones = _customer_phones(customer)
+                order_phone = normalize_phone_digits(order.get('phone'))
+                if order_phone:
+                    phones.add(order_phone)
+                conn.executemany(
+                    "INSERT OR IGNORE INTO customer_phones (phone, customer_id) VALUES (?, ?)",
+                    [(phone, customer_id) for phone in phones]
+                )
+                count += 1
+            conn.commit()
+        finally:
+            conn.close()
+    return count
+
+
+def bootstrap():
+    """
+    Первичное наполнение: все клиенты и заказы за последние CUSTOMER_INDEX_ORDERS_DAYS дней.
+    Изменения, произошедшие во время выгрузки, догоняет первая инкрементальная синхронизация
+    (она начинается с момента старта выгрузки).
+    """
+    started_at = datetime.now()
+    logger.info("Индекс клиентов: начало первичной выгрузки клиентов из RetailCRM.")
+
+    customers_count = 0
+    for customers in _iter_pages('customers', 'customers', {}):
+        customers_count += index_customers(customers)
+
+    orders_count = 0
+    orders_from = (started_at - timedelta(days=config.CUSTOMER_INDEX_ORDERS_DAYS)).strftime('%Y-%m-%d')
+    for orders in _iter_pages('orders', 'orders', {'filter[createdAtFrom]': orders_from}):
+        orders_count += index_orders(orders)
+
+    with _db_lock:
+        conn = _connect()
+        try:
+            _set_state(conn, 'history_start_date', started_at.strftime('%Y-%m-%d %H:%M:%S'))
+            _set_state(conn, 'orders_synced_at', started_at.strftime('%Y-%m-%d %H:%M:%S'))
+            _set_state(conn, 'bootstrapped_at', started_at.isoformat())
+            conn.commit()
+        finally:
+            conn.close()
+
+    logger.info(f"Индекс клиентов: первичная выгрузка завершена ({customers_count} клиентов, {orders_count} заказов).")
+
+
+def sync_customers_history() -> int:
+    """
+    Инкрементальная синхронизация через /api/v5/customers/history.
+    Изменившиеся клиенты перечитываются целиком (filter[ids][]), удаленные убираются из индекса.
+    Возвращает количество обработанных записей истории.
+    """
+    since_id = _get_state('customers_history_since_id')
+    processed = 0
+
+    while True:
+        params = {'limit': PAGE_LIMIT}
+        if since_id:
+            params['filter[sinceId]'] = since_id
+        else:
+            params['filter[startDate]'] = _get_state('history_start_date')
+        history = _api_get('customers/history', params).get('history', [])
+        if not history:
+            break
+
+        changed_ids, deleted_ids = set(), set()
+        for entry in history:
+            customer_id = (entry.get('customer') or {}).get('id')
+            if not customer_id:
+                continue
+            if entry.get('deleted'):
+                deleted_ids.add(customer_id)
+                changed_ids.discard(customer_id)
+            else:
+                changed_ids.add(customer_id)
+                deleted_ids.discard(customer_id)
+
+        if deleted_ids:
+            remove_customers(deleted_ids)
+        changed = sorted(changed_ids)
+        for i in range(0, len(changed), PAGE_LIMIT):
+            chunk = changed[i:i + PAGE_LIMIT]
+            customers = _api_get('customers', {'filter[ids][]': chunk, 'limit': PAGE_LIMIT}).get('customers', [])
+            index_customers(customers)
+
+        since_id = str(history[-1]['id'])
+        with _db_lock:
+            conn = _connect()
+            try:
+                _set_state(conn, 'customers_history_since_id', since_id)
+                conn.commit()
+            finally:
+                conn.close()
+        processed += len(history)
+        if len(history) < PAGE_LIMIT:
+            break
+
+    if processed:
+        logger.info(f"Индекс клиентов: обработано {processed} записей истории клиентов (sinceId={since_id}).")
+    return processed
+
+
+def remove_orders(order_ids: Iterable[int]):
+    init_index()
+    with _db_lock:
+        conn = _connect()
+        try:
+            conn.executemany("DELETE FROM customer_orders WHERE order_id = ?", [(order_id,) for order_id in order_ids])
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def sync_recent_orders() -> int:
+    """
+    Догоняет заказы через /api/v5/orders/history с filter[sinceId]: каждый цикл читает только новые
+    записи истории и перечитывает (filter[ids][]) лишь изменившиеся заказы — новые, перепривязанные
+    к другому клиенту или со сменой телефона. Возвращает количество обработанных записей истории.
+    """
+    since_id = _get_state('orders_history_since_id')
+    started_at = datetime.now()
+    processed = 0
+
+    while True:
+        params = {'limit': PAGE_LIMIT}
+        if since_id:
+            params['filter[sinceId]'] = since_id
+        else:
+            # Первый запуск после первичной выгрузки (или после перехода с выборки по createdAtFrom)
+            params['filter[startDate]'] = _get_state('orders_synced_at') or _get_state('history_start_date')
+        history = _api_get('orders/history', params).get('history', [])
+        if not history:
+            break
+
+        changed_ids, deleted_ids = set(), set()
+        for entry in history:
+            order_id = (entry.get('order') or {}).get('id')
+            if not order_id:
+                continue
+            if entry.get('deleted'):
+                deleted_ids.add(order_id)
+                changed_ids.discard(order_id)
+            else:
+                changed_ids.add(order_id)
+                deleted_ids.discard(order_id)
+
+        if deleted_ids:
+            remove_orders(deleted_ids)
+        changed = sorted(changed_ids)
+        for i in range(0, len(changed), PAGE_LIMIT):
+            chunk = changed[i:i + PAGE_LIMIT]
+            orders = _api_get('orders', {'filter[ids][]': chunk, 'limit': PAGE_LIMIT}).get('orders', [])
+            index_orders(orders)
+
+        since_id = str(history[-1]['id'])
+        with _db_lock:
+            conn = _connect()
+            try:
+                _set_state(conn, 'orders_history_since_id', since_id)
+                conn.commit()
+            finally:
+                conn.close()
+        processed += len(history)
+        if len(history) < PAGE_LIMIT:
+            break
+
+    # Отметку ставим и при пустой истории: по ней is_fresh() понимает, что индекс догнан
+    with _db_lock:
+        conn = _connect()
+        try:
+            _set_state(conn, 'orders_synced_at', started_at.strftime('%Y-%m-%d %H:%M:%S'))
+            conn.commit()
+        finally:
+            conn.close()
+    if processed:
+        logger.info(f"Индекс клиентов: обработано {processed} записей истории заказов (sinceId={since_id}).")
+    return processed
+
+
+def sync():
+    """Один цикл синхронизации: первичная выгрузка при необходимости, затем история клиентов и новые заказы."""
+    init_index()
+    with _sync_lock:
+        if not is_ready():
+            bootstrap()
+        sync_customers_history()
+        sync_recent_orders()
+
+
+def _sync_loop():
+    logger.info("Поток синхронизации индекса клиентов запущен.")
+    while True:
+        try:
+            sync()
+        except Exception as e:
+            logger.error(f"❌ Ошибка синхронизации индекса клиентов: {e}", exc_info=True)
+        time.sleep(config.CUSTOMER_INDEX_SYNC_INTERVAL_SECONDS)
+
+
+def start_customer_index_sync():
+    """Запускает фоновую синхронизацию индекса. Повторный вызов ничего не делает."""
+    global _sync_thread
+    if _sync_thread is not None:
+        return
+    _sync_thread = threading.Thread(target=_sync_loop, name='customer-index-sync', daemon=True)
+    _sync_thread.start()
+
+
+# --------------------------------------- #
+#            Поиск по индексу
+# --------------------------------------- #
+
+def find_customer_ids(phone: str) -> List[int]:
+    """ID клиентов RetailCRM с этим телефоном (телефон нормализуется)."""
+    normalized = normalize_phone_digits(phone)
+    if not normalized:
+        return []
+    init_index()
+    conn = _connect()
+    try:
+        rows = conn.execute("SELECT customer_id FROM customer_phones WHERE phone = ?", (normalized,)).fetchall()
+        return [row['customer_id'] for row in rows]
+    finally:
+        conn.close()
+
+
+def find_customer_ids_for_phones(phones: Iterable[str]) -> set:
+    """ID клиентов для набора телефонов одним запросом."""
+    normalized = {normalize_phone_digits(phone) for phone in phones}
+    normalized.discard("")
+    if not normalized:
+        return set()
+    init_index()
+    conn = _connect()
+    try:
+        placeholders = ", ".join("?" for _ in normalized)
+        rows = conn.execute(
+            f"SELECT DISTINCT customer_id FROM customer_phones WHERE phone IN ({placeholders})",
+            tuple(normalized)
+        ).fetchall()
+        return {row['customer_id'] for row in rows}
+    finally:
+        conn.close()
+
+
+def find_order_ids(phone: str) -> List[int]:
+    """ID заказов клиентов с этим телефоном, от самого нового к самому старому."""
+    normalized = normalize_phone_digits(phone)
+    if not normalized:
+        return []
+    init_index()
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            "SELECT co.order_id FROM customer_phones cp "
+            "JOIN customer_orders co ON co.customer_id = cp.customer_id "
+            "WHERE cp.phone = ? ORDER BY co.created_at DESC, co.order_id DESC",
+            (normalized,)
+        ).fetchall()
+        return [row['order_id'] for row in rows]
+    finally:
+        conn.close()
+
+
+def fetch_orders_by_ids(order_ids: List[int]) -> List[Dict[str, Any]]:
+    """Точная выборка заказов по внутренним ID (вместо нечеткого поиска filter[customer])."""
+    orders = []
+    for i in range(0, len(order_ids), PAGE_LIMIT):
+        chunk = order_ids[i:i + PAGE_LIMIT]
+        orders += _api_get('orders', {'filter[ids][]': chunk, 'limit': PAGE_LIMIT}).get('orders', [])
+    return orders
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    sync()
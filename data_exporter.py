@@ -5,14 +5,29 @@ import json
 import requests
 import datetime
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from typing import Dict
 
 # Добавляем корневую директорию проекта в sys.path для импорта других модулей
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(project_root)
 
 # Импортируем модули
-from dialog_analyser import analyze_dialog
+from dialog_analyser import analyze_dialog, analyze_dialogs_batch
+from openai_engine import AnalysisUnavailableError
+from dialog_compactor import compact_dialog
+import dialog_preclassifier
+import export_outbox
+import processing_ledger
+import customer_index
+import order_mirror
+from phone_utils import normalize_phone_digits
+from http_session import get_session
+from retailcrm_api import throttle as throttle_retailcrm, iter_orders
+from export_sinks import KIND_FULL, KIND_FREE
 import config
 
 # Настройка логирования для этого модуля
@@ -34,21 +49,14 @@ def normalize_phone(phone_str: str) -> str:
     Удаляет все нецифровые символы и заменяет начальную '8' на '7'.
     """
     logger.debug(f"Начало нормализации номера телефона: {phone_str}")
-    digits_only = re.sub(r'\D', '', phone_str)
-    if digits_only.startswith('8') and len(digits_only) == 11:
-        normalized = '7' + digits_only[1:]
-        logger.info(f"Номер {phone_str} нормализован в {normalized}.")
-        return normalized
-    elif digits_only.startswith('7') and len(digits_only) == 11:
+    normalized = normalize_phone_digits(phone_str)
+    if not normalized:
+        logger.warning(f"Не удалось нормализовать номер телефона: {phone_str}")
+    elif normalized == phone_str:
         logger.info(f"Номер {phone_str} уже в нужном формате.")
-        return digits_only
-    # Дополнительная обработка для российских мобильных (без +7)
-    elif digits_only.startswith('9') and len(digits_only) == 10:
-        normalized = '7' + digits_only
+    else:
         logger.info(f"Номер {phone_str} нормализован в {normalized}.")
-        return normalized
-    logger.warning(f"Не удалось нормализовать номер телефона: {phone_str}")
-    return ""
+    return normalized
 
 
 def move_dialog_to_closed(dialog_id: int, client_phone: str):
@@ -88,27 +96,34 @@ def get_latest_order_details_from_phone(phone_number: str) -> dict | None:
         return None
 
     try:
-        url = f"{config.RETAILCRM_BASE_URL}/api/v5/orders"
-        headers = {
-            'X-Api-Key': config.RETAILCRM_API_KEY
-        }
+        # Свежее зеркало заказов отвечает без обращения к RetailCRM
+        if order_mirror.is_fresh():
+            customer_ids = customer_index.find_customer_ids(normalized_phone) if customer_index.is_fresh() else []
+            orders = order_mirror.find_client_orders(normalized_phone, customer_ids, limit=1)
+            if orders:
+                logger.info(f"Найден самый новый заказ с ID: {orders[0].get('externalId', 'Неизвестно')} (зеркало заказов)")
+                return orders[0]
+
+        # Если локальный индекс клиентов свежий, берем самый новый заказ клиента по точному ID
+        # вместо нечеткого поиска filter[customer] по всем заказам
+        if customer_index.is_fresh():
+            order_ids = customer_index.find_order_ids(normalized_phone)
+            if order_ids:
+                orders = customer_index.fetch_orders_by_ids(order_ids[:1])
+                if orders:
+                    logger.info(f"Найден самый новый заказ с ID: {orders[0].get('externalId', 'Неизвестно')} (индекс клиентов)")
+                    return orders[0]
+
         params = {
             'filter[customer]': normalized_phone
         }
-        logger.debug(f"Отправка запроса в RetailCRM: URL={url}, params={params}")
-        response = requests.get(url, headers=headers, params=params, timeout=10)
-        response.raise_for_status()
-        logger.debug("Запрос к RetailCRM успешен.")
-
-        data = response.json()
-        if not data.get('orders'):
+        logger.debug(f"Поиск заказов в RetailCRM: params={params}")
+        # Самый новый по дате создания среди всех страниц выдачи (в памяти — одна страница)
+        latest_order = max(iter_orders(params), key=lambda x: x.get('createdAt', ''), default=None)
+        if latest_order is None:
             logger.info(f"Заказы для клиента с номером {normalized_phone} не найдены.")
             return None
 
-        # Сортируем заказы по дате создания в убывающем порядке, чтобы получить самый новый
-        sorted_orders = sorted(data['orders'], key=lambda x: x.get('createdAt', ''), reverse=True)
-        latest_order = sorted_orders[0]
-
         logger.info(f"Найден самый новый заказ с ID: {latest_order.get('externalId', 'Неизвестно')}")
         return latest_order
 
@@ -131,7 +146,8 @@ def get_manager_details_from_id(manager_id: int) -> dict | None:
             'X-Api-Key': config.RETAILCRM_API_KEY
         }
         logger.debug(f"Отправка запроса в RetailCRM: URL={url}")
-        response = requests.get(url, headers=headers, timeout=10)
+        throttle_retailcrm()
+        response = get_session().get(url, headers=headers, timeout=10)
         response.raise_for_status()
         logger.debug("Запрос к RetailCRM успешен.")
 
@@ -164,7 +180,7 @@ def is_order_link_in_analysis_sheet(order_link: str) -> bool:
 
     try:
         # Скачиваем данные как CSV (открытый доступ)
-        response = requests.get(ANALYSIS_SHEET_CSV_URL, timeout=10)
+        response = get_session().get(ANALYSIS_SHEET_CSV_URL, timeout=10)
         response.raise_for_status()
 
         # Декодируем контент
@@ -219,34 +235,31 @@ def is_order_link_in_analysis_sheet(order_link: str) -> bool:
 
 def send_to_google_forms(data: dict):
     """
-    Отправляет проанализированные данные в Google-таблицу через Google Forms
+    Ставит строку полного анализа в очередь экспорта в Google-таблицу
     (для диалогов, прошедших фильтрацию и анализ OpenAI).
+    Сама отправка выполняется фоновыми воркерами export_outbox через приемник
+    из export_sinks, поэтому сбой Google не теряет строку, за анализ которой уже заплачено.
     """
-    logger.info("Начало отправки данных в Google Forms (Полный анализ).")
+    logger.info("Постановка данных в очередь экспорта (Полный анализ).")
     logger.debug(f"Отправляемые данные: {data}")
     try:
-        response = requests.post(config.GOOGLE_FORMS_URL, data=data, timeout=10)
-        response.raise_for_status()
-        logger.info("✅ Данные успешно отправлены в Google Forms (Полный анализ).")
-    except requests.exceptions.RequestException as e:
-        logger.error(f"❌ Ошибка при отправке данных в Google Forms (Полный анализ): {e}", exc_info=True)
+        export_outbox.enqueue(KIND_FULL, data)
+    except Exception as e:
+        logger.error(f"❌ Ошибка при постановке данных в очередь экспорта (Полный анализ): {e}", exc_info=True)
 
 
 def send_to_google_forms_free(data: dict):
     """
-    Отправляет базовые данные в Google-таблицу через Google Forms
+    Ставит строку базового экспорта в очередь экспорта в Google-таблицу
     (для диалогов, не прошедших фильтрацию или не требующих анализа OpenAI).
     """
-    logger.info("Начало отправки данных в Google Forms (Базовый экспорт).")
+    logger.info("Постановка данных в очередь экспорта (Базовый экспорт).")
     logger.debug(f"Отправляемые данные: {data}")
 
-    # URL для базового экспорта берется из config.GOOGLE_FORMS_URL_FREE
     try:
-        response = requests.post(config.GOOGLE_FORMS_URL_FREE, data=data, timeout=10)
-        response.raise_for_status()
-        logger.info("✅ Данные успешно отправлены в Google Forms (Базовый экспорт).")
-    except requests.exceptions.RequestException as e:
-        logger.error(f"❌ Ошибка при отправке данных в Google Forms (Базовый экспорт): {e}", exc_info=True)
+        export_outbox.enqueue(KIND_FREE, data)
+    except Exception as e:
+        logger.error(f"❌ Ошибка при постановке данных в очередь экспорта (Базовый экспорт): {e}", exc_info=True)
 
 
 def send_to_telegram(summary: str):
@@ -255,7 +268,7 @@ def send_to_telegram(summary: str):
     Использует parse_mode='HTML'.
     """
     logger.info("Начало отправки резюме в Telegram.")
-    url = f"https://api.telegram.org/bot{config.TELEGRAM_BOT_TOKEN}/sendMessage"
+    url = f"{config.TELEGRAM_API_URL}/bot{config.TELEGRAM_BOT_TOKEN}/sendMessage"
     payload = {
         'chat_id': config.TELEGRAM_CHAT_ID,
         'message_thread_id': config.TELEGRAM_TOPIC_ID,
@@ -263,7 +276,7 @@ def send_to_telegram(summary: str):
         'parse_mode': 'HTML'
     }
     try:
-        response = requests.post(url, data=payload, timeout=10)
+        response = get_session().post(url, data=payload, timeout=10)
         response.raise_for_status()
         logger.info("✅ Резюме успешно отправлено в Telegram.")
     except requests.exceptions.RequestException as e:
@@ -271,196 +284,530 @@ def send_to_telegram(summary: str):
 
 
 # --- Основная логика обработки и экспорта ---
+#
+# Обработка закрытого диалога разбита на этапы конвейера:
+#   load -> claim -> enrich -> filter -> preclassify -> compact -> analyze -> export -> archive
+# Каждый этап принимает общий контекст (dict) и дополняет его. Внешние зависимости
+# (RetailCRM, OpenAI, очередь экспорта, файловая система) передаются аргументами,
+# поэтому любой этап можно запустить отдельно на заглушках.
+
+# Общий пул для параллельного ввода-вывода внутри этапов (менеджер + таблица анализа)
+_io_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='exporter-io')
+
+# Ограничения параллелизма по этапам: сколько диалогов одновременно может находиться в этапе
+_stage_semaphores = {
+    stage: threading.BoundedSemaphore(limit) for stage, limit in config.PIPELINE_STAGE_LIMITS.items()
+}
+
+# Накопленная статистика времени по этапам: {stage: {'count', 'total_seconds', 'max_seconds'}}
+STAGE_STATS: Dict[str, Dict[str, float]] = {}
+_stage_stats_lock = threading.Lock()
+
+
+def _record_stage_time(stage: str, elapsed: float):
+    with _stage_stats_lock:
+        stats = STAGE_STATS.setdefault(stage, {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+        stats['count'] += 1
+        stats['total_seconds'] += elapsed
+        stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+
+
+def get_stage_stats() -> Dict[str, Dict[str, float]]:
+    """Снимок статистики этапов со средним временем."""
+    with _stage_stats_lock:
+        return {
+            stage: {**stats, 'avg_seconds': stats['total_seconds'] / stats['count'] if stats['count'] else 0.0}
+            for stage, stats in STAGE_STATS.items()
+        }
 
-def process_and_export_data(dialog_id: int, client_phone: str):
+
+def run_stage(stage: str, stage_func, ctx: dict, **deps) -> dict:
     """
-    Центральная функция для обработки и экспорта данных закрытого диалога.
-    Включает логику фильтрации по статусу, методу заказа, дате создания
-    и наличию в таблице анализа.
+    Выполняет этап с учетом его лимита параллелизма и замеряет время выполнения.
+    Время ожидания слота не входит в замер.
     """
-    logger.info(f"=== Начало обработки закрытого диалога {dialog_id} ===")
+    semaphore = _stage_semaphores.get(stage)
+    if semaphore:
+        semaphore.acquire()
+    try:
+        start = time.perf_counter()
+        try:
+            stage_func(ctx, **deps)
+        finally:
+            elapsed = time.perf_counter() - start
+            ctx['timings'][stage] = elapsed
+            _record_stage_time(stage, elapsed)
+    finally:
+        if semaphore:
+            semaphore.release()
+    return ctx
+
+
+def new_dialog_context(dialog_id: int, client_phone: str) -> dict:
+    """Начальный контекст конвейера для одного диалога."""
+    return {
+        'dialog_id': dialog_id,
+        'client_phone': client_phone,
+        'file_path': None,
+        'dialog_text': "",
+        'order_details': None,
+        'order_link': 'Неизвестно',
+        'total_summ': 'Неизвестно',
+        'customer_type': 'Физическое лицо',  # Дефолтное значение
+        'manager_name': 'Неизвестно',
+        'order_number': 'Неизвестно',
+        'passes_order_filters': False,
+        'is_already_analyzed': False,
+        'should_analyze': False,
+        'analysis_text': None,  # Сжатый текст диалога для OpenAI (в экспорт уходит исходный)
+        'preclassification': None,  # (нецелевая категория или None, уверенность) локального классификатора
+        'analysis': None,
+        'summary': None,
+        'content_hash': None,
+        'claimed': False,  # Версия диалога захвачена в журнале обработки этим вызовом
+        'attempt': 0,  # Номер попытки обработки этой версии диалога (по журналу)
+        'skip': None,  # Причина пропуска обработки: остается только этап archive
+        'stop': None,  # Причина досрочной остановки конвейера
+        'timings': {},
+    }
 
-    # 1. Загрузка текста диалога
-    file_name = f'dialog_{dialog_id}_{client_phone}.txt'
+
+def evaluate_order_filters(order_details: dict, now: datetime | None = None) -> tuple[bool, list]:
+    """
+    Начальные фильтры полного анализа (Tier 1) по заказу: статус, метод оформления
+    и дата создания (заказ не старше 2 дней).
+    Возвращает (пройдены ли фильтры, список причин отказа).
+    """
+    now = now or datetime.now()
+    order_number = order_details.get('externalId', 'Неизвестно')
+
+    # --- ПРОВЕРКА ДАТЫ: Заказ должен быть не старше 2 дней ---
+    order_created_at_str = order_details.get('createdAt')
+    is_recent_order = False
+
+    if order_created_at_str:
+        try:
+            # Парсинг даты в формате "YYYY-MM-DD HH:MM:SS"
+            order_time = datetime.strptime(order_created_at_str, '%Y-%m-%d %H:%M:%S')
+
+            # Сравниваем с текущим временем минус 2 дня
+            two_days_ago = now - timedelta(days=2)
+
+            if order_time >= two_days_ago:
+                is_recent_order = True
+            else:
+                logger.info(
+                    f"Заказ {order_number} создан ({order_time}) более 2-х дней назад. Фильтрация по дате НЕ пройдена.")
+        except ValueError as e:
+            logger.error(
+                f"❌ Ошибка парсинга даты заказа {order_number} с форматом '{order_created_at_str}': {e}. Пропускаем анализ по дате.",
+                exc_info=True)
+        except Exception as e:
+            logger.error(f"❌ Непредвиденная ошибка при проверке даты заказа {order_number}: {e}", exc_info=True)
+    else:
+        logger.warning(f"В заказе {order_number} отсутствует поле 'createdAt'. Считаем НЕАКТУАЛЬНЫМ для анализа.")
+
+    order_status = order_details.get('status')
+    order_method = order_details.get('orderMethod')
+
+    is_valid_status = order_status in config.RETAILCRM_VALID_STATUSES
+    is_valid_method = order_method != config.INVALID_ORDER_METHOD
+
+    reasons = []
+    if not is_valid_status: reasons.append(f"Status: {order_status}")
+    if not is_valid_method: reasons.append(f"Method: {order_method}")
+    if order_created_at_str and not is_recent_order: reasons.append("Order is OLDER than 2 days")
+    if not order_created_at_str: reasons.append("Order has no createdAt")
+
+    return is_valid_status and is_valid_method and is_recent_order, reasons
+
+
+def stage_load(ctx: dict, read_file=None):
+    """Этап 1: находит файл диалога (active или closed) и читает его текст."""
+    file_name = f"dialog_{ctx['dialog_id']}_{ctx['client_phone']}.txt"
     active_path = os.path.join('dialogs', 'active', file_name)
     closed_path = os.path.join('dialogs', 'closed', file_name)
 
-    dialog_text = ""
-    file_path = None
     if os.path.exists(active_path):
-        file_path = active_path
+        ctx['file_path'] = active_path
     elif os.path.exists(closed_path):
-        file_path = closed_path
+        ctx['file_path'] = closed_path
     else:
         logger.warning(f"Файл диалога {file_name} не найден. Пропускаем обработку.")
+        ctx['stop'] = 'file_not_found'
         return
 
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            dialog_text = f.read()
+        if read_file:
+            ctx['dialog_text'] = read_file(ctx['file_path'])
+        else:
+            with open(ctx['file_path'], 'r', encoding='utf-8') as f:
+                ctx['dialog_text'] = f.read()
         logger.info(f"Текст диалога успешно загружен.")
     except Exception as e:
-        logger.error(f"Ошибка при чтении файла {file_path}: {e}", exc_info=True)
+        logger.error(f"Ошибка при чтении файла {ctx['file_path']}: {e}", exc_info=True)
+        ctx['stop'] = 'read_error'
+
+
+def stage_claim(ctx: dict, ledger=None):
+    """
+    Этап 2: захватывает версию диалога (dialog_id + хэш текста) в журнале обработки.
+    Один и тот же диалог может прийти дважды: из события dialog_closed и из принудительного
+    закрытия в 23:00, а переоткрытый диалог — повторными событиями. Без журнала каждый
+    дубль стоит еще одного вызова OpenAI и дублирует строку в таблице.
+    """
+    ledger = ledger or processing_ledger
+    ctx['content_hash'] = ledger.content_hash(ctx['dialog_text'])
+    claimed, existing_status = ledger.claim(ctx['dialog_id'], ctx['content_hash'])
+    ctx['claimed'] = claimed
+    if claimed:
+        entry = ledger.get_entry(ctx['dialog_id'], ctx['content_hash'])
+        ctx['attempt'] = entry['attempts'] if entry else 1
         return
 
-    # 2. Получаем детали последнего заказа и инициализируем переменные
-    order_details = get_latest_order_details_from_phone(client_phone)
-    order_link = 'Неизвестно'
-    total_summ = 'Неизвестно'
-    customer_type = 'Физическое лицо'  # Дефолтное значение
-    manager_name = 'Неизвестно'
-    should_analyze = False
-    order_number = 'Неизвестно'
-
-    if order_details:
-        # Формируем ссылку на заказ
-        order_link = f"{config.RETAILCRM_BASE_URL}/orders/{order_details.get('slug', 'Неизвестно')}/edit"
-        total_summ = order_details.get('totalSumm', 'Неизвестно')
-        order_number = order_details.get('externalId', 'Неизвестно')
-
-        # Определение типа клиента
-        customer_type = 'Юридическое лицо' if order_details.get('orderType') == 'b2b' else 'Физическое лицо'
-
-        manager_id = order_details.get('managerId')
-        if manager_id:
-            manager_details = get_manager_details_from_id(manager_id)
+    if existing_status == ledger.STATUS_DONE:
+        logger.info(f"Эта версия диалога {ctx['dialog_id']} уже обработана. Анализ и экспорт пропускаются.")
+        ctx['skip'] = 'already_done'
+    elif existing_status == ledger.STATUS_FAILED:
+        # Попытки исчерпаны: файл переносится в 'closed', иначе он подхватывался бы каждую ночь
+        logger.error(f"❌ Диалог {ctx['dialog_id']} исчерпал попытки обработки ({config.LEDGER_MAX_ATTEMPTS}). "
+                     f"Файл переносится в архив без экспорта.")
+        ctx['skip'] = 'ledger_failed'
+    else:
+        # Диалог сейчас обрабатывается другим потоком или процессом — файл он переместит сам
+        logger.info(f"Диалог {ctx['dialog_id']} не захвачен (статус в журнале: {existing_status}). Пропускаем.")
+        ctx['stop'] = f"ledger_{existing_status}"
+
+
+def stage_enrich(ctx: dict, fetch_order=None, fetch_manager=None, check_sheet=None):
+    """
+    Этап 3: ищет последний заказ клиента, затем параллельно получает менеджера
+    и проверяет наличие заказа в таблице анализа (только если заказ проходит начальные фильтры).
+    """
+    fetch_order = fetch_order or get_latest_order_details_from_phone
+    fetch_manager = fetch_manager or get_manager_details_from_id
+    check_sheet = check_sheet or is_order_link_in_analysis_sheet
+
+    order_details = fetch_order(ctx['client_phone'])
+    ctx['order_details'] = order_details
+    if not order_details:
+        return
+
+    # Формируем ссылку на заказ
+    ctx['order_link'] = f"{config.RETAILCRM_BASE_URL}/orders/{order_details.get('slug', 'Неизвестно')}/edit"
+    ctx['total_summ'] = order_details.get('totalSumm', 'Неизвестно')
+    ctx['order_number'] = order_details.get('externalId', 'Неизвестно')
+
+    # Определение типа клиента
+    ctx['customer_type'] = 'Юридическое лицо' if order_details.get('orderType') == 'b2b' else 'Физическое лицо'
+
+    passes_filters, reasons = evaluate_order_filters(order_details)
+    ctx['passes_order_filters'] = passes_filters
+    ctx['filter_reasons'] = reasons
+
+    # Поиск менеджера и проверка таблицы анализа независимы — выполняем их одновременно
+    manager_id = order_details.get('managerId')
+    manager_future = _io_executor.submit(fetch_manager, manager_id) if manager_id else None
+    sheet_future = _io_executor.submit(check_sheet, ctx['order_link']) if passes_filters else None
+
+    if manager_future:
+        try:
+            manager_details = manager_future.result()
             if manager_details:
                 first_name = manager_details.get('firstName', '')
                 last_name = manager_details.get('lastName', '')
-                manager_name = f"{first_name} {last_name}".strip()
-
-        # --- ПРОВЕРКА ДАТЫ: Заказ должен быть не старше 2 дней ---
-        order_created_at_str = order_details.get('createdAt')
-        is_recent_order = False
-
-        if order_created_at_str:
-            try:
-                # Парсинг даты в формате "YYYY-MM-DD HH:MM:SS"
-                order_time = datetime.strptime(order_created_at_str, '%Y-%m-%d %H:%M:%S')
-
-                # Сравниваем с текущим временем минус 2 дня
-                two_days_ago = datetime.now() - timedelta(days=2)
-
-                if order_time >= two_days_ago:
-                    is_recent_order = True
-                else:
-                    logger.info(
-                        f"Заказ {order_number} создан ({order_time}) более 2-х дней назад. Фильтрация по дате НЕ пройдена.")
-            except ValueError as e:
-                logger.error(
-                    f"❌ Ошибка парсинга даты заказа {order_number} с форматом '{order_created_at_str}': {e}. Пропускаем анализ по дате.",
-                    exc_info=True)
-            except Exception as e:
-                logger.error(f"❌ Непредвиденная ошибка при проверке даты заказа {order_number}: {e}", exc_info=True)
-        else:
-            logger.warning(f"В заказе {order_number} отсутствует поле 'createdAt'. Считаем НЕАКТУАЛЬНЫМ для анализа.")
+                ctx['manager_name'] = f"{first_name} {last_name}".strip()
+        except Exception as e:
+            logger.error(f"❌ Ошибка при получении менеджера {manager_id}: {e}", exc_info=True)
+
+    if sheet_future:
+        try:
+            ctx['is_already_analyzed'] = sheet_future.result()
+        except Exception as e:
+            # Если не смогли проверить, считаем, что ссылки нет (требуется полный анализ)
+            logger.error(f"❌ Ошибка при проверке таблицы анализа: {e}", exc_info=True)
 
-        # 3. Проверка условий для полного анализа (Tier 1) - Начальные фильтры
-        order_status = order_details.get('status')
-        order_method = order_details.get('orderMethod')
 
-        is_valid_status = order_status in config.RETAILCRM_VALID_STATUSES
-        is_valid_method = order_method != config.INVALID_ORDER_METHOD
+def stage_filter(ctx: dict):
+    """Этап 4: принимает решение о полном анализе OpenAI или базовом экспорте."""
+    order_details = ctx['order_details']
+    if not order_details:
+        logger.info("Заказ для клиента не найден. Производится базовый экспорт.")
+        ctx['should_analyze'] = False
+        return
 
-        # ОБЪЕДИНЕНИЕ ВСЕХ УСЛОВИЙ
-        if is_valid_status and is_valid_method and is_recent_order:
-            should_analyze = True
+    if not ctx['passes_order_filters']:
+        reasons = ctx.get('filter_reasons') or []
+        if reasons:
             logger.info(
-                f"Начальные условия фильтрации выполнены (Status: {order_status}, Method: {order_method}, Recent: True).")
+                f"Начальные условия фильтрации НЕ выполнены ({', '.join(reasons)}). Производится базовый экспорт.")
         else:
-            # Логирование причин, если начальные фильтры НЕ пройдены
-            reasons = []
-            if not is_valid_status: reasons.append(f"Status: {order_status}")
-            if not is_valid_method: reasons.append(f"Method: {order_method}")
-            if order_created_at_str and not is_recent_order: reasons.append("Order is OLDER than 2 days")
+            logger.info("Начальные условия фильтрации НЕ выполнены. Производится базовый экспорт.")
+        ctx['should_analyze'] = False
+        return
 
-            if reasons:
-                logger.info(
-                    f"Начальные условия фильтрации НЕ выполнены ({', '.join(reasons)}). Производится базовый экспорт.")
-            elif order_details and not order_created_at_str:
-                logger.info(
-                    "Начальные условия фильтрации НЕ выполнены (Проблема с датой или другое). Производится базовый экспорт.")
-            else:
-                logger.info("Начальные условия фильтрации НЕ выполнены. Производится базовый экспорт.")
+    logger.info(
+        f"Начальные условия фильтрации выполнены (Status: {order_details.get('status')}, "
+        f"Method: {order_details.get('orderMethod')}, Recent: True).")
 
-        # --- НОВЫЙ ФИЛЬТР: Проверка, был ли заказ уже проанализирован (наличие в Google Sheet) ---
-        if should_analyze:  # Проверяем только, если предыдущие фильтры пройдены
-            is_already_analyzed = is_order_link_in_analysis_sheet(order_link)
+    # --- Проверка, был ли заказ уже проанализирован (наличие в Google Sheet) ---
+    if ctx['is_already_analyzed']:
+        ctx['should_analyze'] = False
+        logger.info(
+            "Условие фильтрации НЕ выполнено (Order link already exists in Analysis Sheet). Производится базовый экспорт.")
+    else:
+        ctx['should_analyze'] = True
+        logger.info("Условие фильтрации (Order link check) выполнено. Производится полный анализ OpenAI.")
 
-            if is_already_analyzed:
-                should_analyze = False
-                logger.info(
-                    "Условие фильтрации НЕ выполнено (Order link already exists in Analysis Sheet). Производится базовый экспорт.")
-            else:
-                logger.info("Условие фильтрации (Order link check) выполнено. Производится полный анализ OpenAI.")
+
+def stage_preclassify(ctx: dict, classify=None):
+    """
+    Этап 5: локальный предклассификатор нецелевых диалогов (PRECLASSIFIER_MODE).
+    В режиме on уверенно нецелевой диалог получает нулевые оценки без запроса к OpenAI
+    (или уходит в базовый экспорт при PRECLASSIFIER_ROUTE=free).
+    """
+    if not ctx['should_analyze'] or config.PRECLASSIFIER_MODE == dialog_preclassifier.MODE_OFF:
+        return
+    classify = classify or dialog_preclassifier.classify
+
+    try:
+        category, confidence = classify(ctx['dialog_text'])
+    except Exception as e:
+        logger.error(f"❌ Ошибка предклассификатора для диалога {ctx['dialog_id']}: {e}", exc_info=True)
+        return
+    ctx['preclassification'] = (category, confidence)
+
+    routed = (config.PRECLASSIFIER_MODE == dialog_preclassifier.MODE_ON and category is not None
+              and dialog_preclassifier.is_confident(confidence))
+    dialog_preclassifier.record_prediction(category, confidence, routed)
+    if not routed:
+        return
+
+    if config.PRECLASSIFIER_ROUTE == 'free':
+        logger.info(f"Диалог {ctx['dialog_id']}: нецелевой ('{category}', {confidence:.2f}). Базовый экспорт без анализа.")
+        ctx['should_analyze'] = False
     else:
-        logger.info("Заказ для клиента не найден. Производится базовый экспорт.")
+        logger.info(f"Диалог {ctx['dialog_id']}: нецелевой ('{category}', {confidence:.2f}). Нулевые оценки без анализа.")
+        ctx['analysis'], ctx['summary'] = dialog_preclassifier.zero_score_analysis(category)
 
-    # --- Ветвление логики экспорта ---
 
-    if should_analyze:
-        # 4. Анализируем диалог с помощью OpenAI (Полный анализ - Tier 1)
-        try:
-            openai_json_data, summary = analyze_dialog(dialog_text, config.CATEGORIES)
-
-            if openai_json_data and summary:
-                logger.info("Анализ диалога OpenAI завершен. Приступаем к полному экспорту.")
-
-                # Формируем полную сводку для Telegram
-                full_summary_telegram = (
-                    f"<b>👤 Менеджер:</b> {manager_name}\n"
-                    f"<b>📱 Телефон клиента:</b> {client_phone}\n"
-                    f"<b>🔗 Ссылка на заказ:</b> <a href='{order_link}'>Заказ</a>\n\n"
-                    f"{summary}"
-                )
-
-                # Объединяем данные для Google Forms (с критериями)
-                # Теперь мы уверены, что OpenAI использует короткие, фиксированные ключи.
-                google_forms_data = {
-                    'entry.408402535': order_link,  # Ссылка на заказ
-                    'entry.711063137': total_summ,
-                    'entry.90684815': customer_type,
-                    'entry.1744925750': manager_name,
-                    'entry.1791797075': dialog_text,
-                    'entry.1213746785': openai_json_data.get('установление_контакта', 0),
-                    'entry.812648406': openai_json_data.get('выявление_потребностей', 0),
-                    'entry.567411627': openai_json_data.get('квалификация', 0),
-                    'entry.154941084': openai_json_data.get('презентация', 0),  # Короткий ключ
-                    'entry.45434250': openai_json_data.get('возражение', 0),  # Короткий ключ
-                    'entry.830702183': openai_json_data.get('отработка_возражения', 0),
-                    'entry.2001468013': openai_json_data.get('проговорить_договоренности', 0),
-                    'entry.1565546251': openai_json_data.get('закрытие_на_оплату', 0),
-                    'entry.982776944': openai_json_data.get('уточнил_цель_покупки', 0), # Короткий ключ
-                    'entry.1132365193': openai_json_data.get('последующий_уточняющий', 0)
-                }
-
-                send_to_google_forms(google_forms_data)
-                send_to_telegram(full_summary_telegram)
-            else:
-                logger.error(f"OpenAI не смог проанализировать диалог {dialog_id}. Переход к базовому экспорту.")
-                # Если анализ провалился, переходим к базовому экспорту
-                should_analyze = False  # Принудительно переключаем на базовый экспорт
+def stage_compact(ctx: dict, compact=None):
+    """
+    Этап 6: сжимает текст диалога для OpenAI — относительные метки времени, схлопнутые заглушки
+    вложений и бюджет токенов (ANALYSIS_MAX_DIALOG_TOKENS) с сокращением середины длинных переписок.
+    """
+    if not ctx['should_analyze'] or ctx['analysis']:
+        return
+    compact = compact or compact_dialog
 
-        except Exception as e:
-            logger.error(f"❌ Критическая ошибка в процессе анализа OpenAI: {e}", exc_info=True)
-            should_analyze = False
-
-    if not should_analyze:
-        # 5. Экспорт базовых данных (Tier 2) - Таблица Хранение чатов
-        # Собираем данные для Google Forms без критериев
-        google_forms_data_free = {
-            'entry.1563894862': order_link,  # Отправляем order_link
-            'entry.844658380': total_summ,  # Сумма заказа
-            'entry.1126205710': customer_type,  # Физ/Юр
-            'entry.3334402': dialog_text  # Диалог
-        }
+    try:
+        ctx['analysis_text'], stats = compact(ctx['dialog_text'])
+    except Exception as e:
+        logger.error(f"❌ Ошибка сжатия диалога {ctx['dialog_id']}, анализируем исходный текст: {e}", exc_info=True)
+        ctx['analysis_text'] = ctx['dialog_text']
+        return
+
+    logger.info(
+        f"Диалог {ctx['dialog_id']} сжат для анализа: токенов {stats['tokens_before']} -> {stats['tokens_after']}, "
+        f"сообщений {stats['messages_before']} -> {stats['messages_after']} "
+        f"(пропущено из середины: {stats['dropped_messages']}).")
+
+
+def stage_analyze(ctx: dict, analyze=None):
+    """Этап 7: полный анализ OpenAI (Tier 1). При неудаче переключает диалог на базовый экспорт."""
+    if not ctx['should_analyze'] or ctx['analysis']:
+        return
+    analyze = analyze or analyze_dialog
+
+    try:
+        openai_json_data, summary = analyze(ctx['analysis_text'] or ctx['dialog_text'], config.CATEGORIES)
+    except AnalysisUnavailableError as e:
+        if ctx['attempt'] < config.LEDGER_MAX_ATTEMPTS:
+            # Диалог остается в 'active' и помечается в журнале как failed: следующая попытка
+            # (повторное закрытие или принудительное закрытие в 23:00) выполнит полный анализ
+            logger.error(f"❌ OpenAI недоступен для диалога {ctx['dialog_id']} (попытка {ctx['attempt']}). "
+                         f"Обработка будет повторена.")
+            raise
+        logger.error(f"❌ OpenAI недоступен для диалога {ctx['dialog_id']}, попытки исчерпаны: {e}. "
+                     f"Переход к базовому экспорту.")
+        ctx['should_analyze'] = False
+        return
+    except Exception as e:
+        logger.error(f"❌ Критическая ошибка в процессе анализа OpenAI: {e}", exc_info=True)
+        ctx['should_analyze'] = False
+        return
+
+    if openai_json_data and summary:
+        logger.info("Анализ диалога OpenAI завершен. Приступаем к полному экспорту.")
+        if ctx['preclassification']:
+            dialog_preclassifier.record_agreement(*ctx['preclassification'], openai_json_data.get('chat_category'))
+        ctx['analysis'] = openai_json_data
+        ctx['summary'] = summary
+    else:
+        logger.error(f"OpenAI не смог проанализировать диалог {ctx['dialog_id']}. Переход к базовому экспорту.")
+        # Если анализ провалился, переходим к базовому экспорту
+        ctx['should_analyze'] = False
+
+
+def build_full_export_row(ctx: dict) -> dict:
+    """Строка полного экспорта. Соответствие полям формы/колонкам таблицы задается в export_sinks."""
+    openai_json_data = ctx['analysis']
+    # Теперь мы уверены, что OpenAI использует короткие, фиксированные ключи.
+    export_row = {
+        'timestamp': datetime.now().strftime('%d.%m.%Y %H:%M:%S'),
+        'dialog_id': ctx['dialog_id'],
+        'order_link': ctx['order_link'],  # Ссылка на заказ
+        'total_summ': ctx['total_summ'],
+        'customer_type': ctx['customer_type'],
+        'manager_name': ctx['manager_name'],
+        'dialog_text': ctx['dialog_text'],
+        'chat_category': openai_json_data.get('chat_category'),
+        'summary': ctx['summary'],
+        # Версия диалога из журнала обработки: по ней хранилище отбрасывает повторный экспорт
+        'content_hash': ctx['content_hash'],
+    }
+    for criterion in config.ANALYSIS_CRITERIA:
+        export_row[criterion] = openai_json_data.get(criterion, 0)
+    return export_row
+
+
+def build_free_export_row(ctx: dict) -> dict:
+    """Строка базового экспорта (Tier 2, таблица "Хранение чатов") без критериев."""
+    return {
+        'timestamp': datetime.now().strftime('%d.%m.%Y %H:%M:%S'),
+        'order_link': ctx['order_link'],  # Отправляем order_link
+        'total_summ': ctx['total_summ'],  # Сумма заказа
+        'customer_type': ctx['customer_type'],  # Физ/Юр
+        'dialog_text': ctx['dialog_text']  # Диалог
+    }
 
-        send_to_google_forms_free(google_forms_data_free)
+
+def stage_export(ctx: dict, export_full=None, export_free=None, notify=None):
+    """Этап 8: ставит строку в очередь экспорта и отправляет резюме полного анализа в Telegram."""
+    export_full = export_full or send_to_google_forms
+    export_free = export_free or send_to_google_forms_free
+    notify = notify or send_to_telegram
+
+    if ctx['should_analyze'] and ctx['analysis']:
+        # Формируем полную сводку для Telegram
+        full_summary_telegram = (
+            f"<b>👤 Менеджер:</b> {ctx['manager_name']}\n"
+            f"<b>📱 Телефон клиента:</b> {ctx['client_phone']}\n"
+            f"<b>🔗 Ссылка на заказ:</b> <a href='{ctx['order_link']}'>Заказ</a>\n\n"
+            f"{ctx['summary']}"
+        )
+        export_full(build_full_export_row(ctx))
+        notify(full_summary_telegram)
+    else:
+        export_free(build_free_export_row(ctx))
         logger.info("Базовый экспорт данных завершен.")
 
-    # 6. Перемещаем файл после обработки
-    move_dialog_to_closed(dialog_id, client_phone)
-    logger.info(f"=== Обработка диалога {dialog_id} завершена ===")
+
+def stage_archive(ctx: dict, archive=None):
+    """Этап 9: перемещает файл диалога в 'closed'."""
+    archive = archive or move_dialog_to_closed
+    archive(ctx['dialog_id'], ctx['client_phone'])
+
+
+# Порядок этапов конвейера
+PIPELINE_STAGES = [
+    ('load', stage_load),
+    ('claim', stage_claim),
+    ('enrich', stage_enrich),
+    ('filter', stage_filter),
+    ('preclassify', stage_preclassify),
+    ('compact', stage_compact),
+    ('analyze', stage_analyze),
+    ('export', stage_export),
+    ('archive', stage_archive),
+]
+
+
+# Этапы до анализа и начиная с него: между ними пакетный режим собирает диалоги в один пакет OpenAI
+PREPARE_STAGES = ('load', 'claim', 'enrich', 'filter', 'preclassify', 'compact')
+
+
+def _run_stages(ctx: dict, stage_names, stage_deps: dict | None = None):
+    """Прогоняет контекст через указанные этапы PIPELINE_STAGES; при ошибке помечает версию диалога как failed."""
+    stage_deps = stage_deps or {}
+    try:
+        for stage, stage_func in PIPELINE_STAGES:
+            if stage not in stage_names:
+                continue
+            if ctx['stop']:
+                break
+            if ctx['skip'] and stage != 'archive':
+                continue
+            run_stage(stage, stage_func, ctx, **stage_deps.get(stage, {}))
+    except Exception as e:
+        if ctx['claimed']:
+            processing_ledger.mark_failed(ctx['dialog_id'], ctx['content_hash'], str(e))
+        logger.error(f"❌ Ошибка обработки диалога {ctx['dialog_id']}: {e}", exc_info=True)
+        raise
+
+
+def prepare_dialog(dialog_id: int, client_phone: str) -> dict:
+    """Этапы до анализа: загрузка, захват в журнале, обогащение, фильтрация и сжатие текста."""
+    logger.info(f"=== Начало обработки закрытого диалога {dialog_id} ===")
+    ctx = new_dialog_context(dialog_id, client_phone)
+    _run_stages(ctx, PREPARE_STAGES)
+    return ctx
+
+
+def complete_dialog(ctx: dict, analyze=None) -> dict:
+    """Этапы начиная с анализа: анализ OpenAI, экспорт и архивирование, затем отметка в журнале."""
+    remaining = [stage for stage, _ in PIPELINE_STAGES if stage not in PREPARE_STAGES]
+    _run_stages(ctx, remaining, {'analyze': {'analyze': analyze}} if analyze else None)
+
+    # Строка поставлена в очередь экспорта — эта версия диалога обработана окончательно
+    if ctx['claimed'] and 'export' in ctx['timings']:
+        outcome = KIND_FULL if ctx['should_analyze'] and ctx['analysis'] else KIND_FREE
+        processing_ledger.mark_done(ctx['dialog_id'], ctx['content_hash'], outcome)
+
+    timings = ", ".join(f"{stage}={elapsed:.2f}с" for stage, elapsed in ctx['timings'].items())
+    logger.info(f"=== Обработка диалога {ctx['dialog_id']} завершена ({timings}) ===")
+    return ctx
+
+
+def process_and_export_data(dialog_id: int, client_phone: str):
+    """
+    Центральная функция для обработки и экспорта данных закрытого диалога.
+    Прогоняет диалог через этапы конвейера (PIPELINE_STAGES): загрузка, захват версии
+    диалога в журнале обработки, обогащение данными RetailCRM, фильтрация по статусу, методу заказа, дате создания и наличию
+    в таблице анализа, анализ OpenAI, экспорт и архивирование.
+    """
+    ctx = prepare_dialog(dialog_id, client_phone)
+    return complete_dialog(ctx)
+
+
+def process_dialogs_batch(dialogs: list) -> Dict[int, dict]:
+    """
+    Обрабатывает несрочные диалоги [(dialog_id, client_phone), ...] с анализом через OpenAI Batch API:
+    все диалоги проходят этапы до анализа, диалоги для полного анализа уходят одним пакетом,
+    затем каждый завершается экспортом и архивированием. Диалоги, по которым пакет не вернул
+    результат, анализируются обычным запросом.
+    Возвращает {dialog_id: контекст} для диалогов, обработанных без ошибок.
+    """
+    prepared = []
+    for dialog_id, client_phone in dialogs:
+        try:
+            prepared.append(prepare_dialog(dialog_id, client_phone))
+        except Exception:
+            continue  # Ошибка уже записана в журнал и в лог
+
+    to_analyze = {str(ctx['dialog_id']): ctx['analysis_text'] or ctx['dialog_text'] for ctx in prepared
+                  if not ctx['stop'] and not ctx['skip'] and ctx['should_analyze'] and not ctx['analysis']}
+    batch_results = analyze_dialogs_batch(to_analyze, config.CATEGORIES) if to_analyze else {}
+
+    processed = {}
+    for ctx in prepared:
+        result = batch_results.get(str(ctx['dialog_id']))
+        analyze = (lambda text, categories, result=result: result) if result else None
+        try:
+            processed[ctx['dialog_id']] = complete_dialog(ctx, analyze=analyze)
+        except Exception:
+            continue
+    return processed
 
 
 # --- Тестовый модуль ---
@@ -1,29 +1,42 @@
+import io
 import os
 import re
+import time
 import logging
+import threading
+from functools import lru_cache
 from datetime import datetime
 from collections import Counter
-import openai
 import json
 import config
 from config import PROMPT_TEMPLATE
+import analysis_cache
+import analysis_metrics
+import openai_engine
+from openai_engine import AnalysisUnavailableError, openai_api_error
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
 # --- Константы и конфигурация для OpenAI ---
-try:
-    # Используем config.OPENAI_API_KEY, который загружается через load_dotenv() в config.py
-    OPENAI_API_KEY = config.OPENAI_API_KEY
-    if not OPENAI_API_KEY:
-        logger.error("Переменная OPENAI_API_KEY пуста. Пожалуйста, проверьте файл .env.")
-        exit(1)
-except AttributeError:
-    logger.error("В файле config.py отсутствует переменная OPENAI_API_KEY.")
-    exit(1)
-
-# Инициализируем клиент OpenAI с новым синтаксисом
-client = openai.OpenAI(api_key=OPENAI_API_KEY)
+
+# Синхронный клиент OpenAI (Files и Batch API). Создается при первом обращении: импорт пакета
+# openai занимает сотни миллисекунд, а слушателю и отчету без анализа он не нужен
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            import openai
+
+            if not config.OPENAI_API_KEY:
+                raise AnalysisUnavailableError("Переменная OPENAI_API_KEY пуста. Пожалуйста, проверьте файл .env.")
+            _client = openai.OpenAI(api_key=config.OPENAI_API_KEY, base_url=config.OPENAI_BASE_URL)
+        return _client
+
 
 # Финальный выбор: gpt-5-mini. Обеспечивает баланс надежности и экономии.
 RECOMMENDED_MODEL = "gpt-5-mini"
@@ -85,52 +98,424 @@ def parse_openai_response(response: str) -> tuple[dict, str] | None:
         return None, None
 
 
+# --- Структурированный ответ (Structured Outputs) ---
+
+# Дополнение к PROMPT_TEMPLATE в режиме Structured Outputs: формат задается схемой, а не ```json/---SUMMARY---
+STRUCTURED_OUTPUT_INSTRUCTIONS = """
+
+**Формат ответа в этом режиме (заменяет формат, описанный выше):** верни ОДИН JSON-объект строго по заданной схеме, без ```json и без ---SUMMARY---. Оценки критериев — целые числа 1, 0 или -1, "chat_category" — значение из списка категорий. Резюме (в описанной выше HTML-разметке) помести в поле "summary"."""
+
+
+class AnalysisValidationError(ValueError):
+    """Ответ модели не соответствует схеме анализа."""
+
+
+@lru_cache(maxsize=8)
+def analysis_json_schema(categories: tuple) -> dict:
+    """JSON-схема ответа: chat_category, 10 критериев (-1/0/1) и summary. Все поля обязательны."""
+    properties = {'chat_category': {'type': 'string', 'enum': list(categories)}}
+    for criterion in config.ANALYSIS_CRITERIA:
+        properties[criterion] = {'type': 'integer', 'enum': [-1, 0, 1]}
+    properties['summary'] = {'type': 'string'}
+    return {
+        'type': 'object',
+        'properties': properties,
+        'required': list(properties),
+        'additionalProperties': False,
+    }
+
+
+def response_format(categories: list) -> dict:
+    return {
+        'type': 'json_schema',
+        'json_schema': {'name': 'dialog_analysis', 'strict': True, 'schema': analysis_json_schema(tuple(categories))},
+    }
+
+
+def validate_structured_response(raw_response: str, categories: list) -> tuple[dict, str]:
+    """
+    Строгая проверка ответа по схеме. Возвращает (json_data без summary, summary)
+    или выбрасывает AnalysisValidationError со списком нарушений.
+    """
+    try:
+        data = json.loads(raw_response or "")
+    except json.JSONDecodeError as e:
+        raise AnalysisValidationError(f"невалидный JSON: {e}") from e
+    if not isinstance(data, dict):
+        raise AnalysisValidationError("ответ не является JSON-объектом")
+
+    problems = []
+    expected = set(analysis_json_schema(tuple(categories))['properties'])
+    missing = expected - set(data)
+    unexpected = set(data) - expected
+    if missing:
+        problems.append(f"нет полей: {', '.join(sorted(missing))}")
+    if unexpected:
+        problems.append(f"лишние поля: {', '.join(sorted(unexpected))}")
+    if 'chat_category' in data and data['chat_category'] not in categories:
+        problems.append(f"chat_category '{data['chat_category']}' не из списка категорий")
+    for criterion in config.ANALYSIS_CRITERIA:
+        value = data.get(criterion)
+        # bool — подкласс int, но True/False оценкой не являются
+        if criterion in data and (type(value) is not int or value not in (-1, 0, 1)):
+            problems.append(f"{criterion}={value!r} (ожидается -1, 0 или 1)")
+    summary = data.get('summary')
+    if 'summary' in data and (not isinstance(summary, str) or not summary.strip()):
+        problems.append("summary пустое")
+    if problems:
+        raise AnalysisValidationError("; ".join(problems))
+
+    json_data = {key: value for key, value in data.items() if key != 'summary'}
+    return json_data, summary.strip()
+
+
+# Результаты разбора ответов с момента запуска процесса
+PARSE_STATS = {'parsed': 0, 'repaired': 0, 'failed': 0, 'parse_seconds': 0.0}
+_parse_stats_lock = threading.Lock()
+
+
+def _record_parse(outcome: str, seconds: float):
+    with _parse_stats_lock:
+        PARSE_STATS[outcome] += 1
+        PARSE_STATS['parse_seconds'] += seconds
+
+
+def get_parse_stats() -> dict:
+    """Снимок статистики разбора: доля неудачных ответов и среднее время разбора."""
+    with _parse_stats_lock:
+        stats = dict(PARSE_STATS)
+    total = stats['parsed'] + stats['repaired'] + stats['failed']
+    stats['failure_rate'] = stats['failed'] / total if total else 0.0
+    stats['avg_parse_ms'] = stats['parse_seconds'] / total * 1000 if total else 0.0
+    return stats
+
+
+def parse_analysis_response(raw_response: str, categories: list,
+                            structured: bool | None = None) -> tuple[dict | None, str | None, str | None]:
+    """
+    Разбирает ответ в выбранном режиме. Возвращает (json_data, summary, описание ошибки).
+    """
+    structured = config.ANALYSIS_STRUCTURED_OUTPUT if structured is None else structured
+    if structured:
+        try:
+            json_data, summary = validate_structured_response(raw_response, categories)
+            return json_data, summary, None
+        except AnalysisValidationError as e:
+            return None, None, str(e)
+
+    json_data, summary = parse_openai_response(raw_response or "")
+    if json_data and summary:
+        return json_data, summary, None
+    return None, None, "ответ не разобран"
+
+
+@lru_cache(maxsize=8)
+def _system_prompt(categories: tuple, structured: bool = False) -> str:
+    # Используем PROMPT_TEMPLATE из config: {0} — список категорий
+    prompt = PROMPT_TEMPLATE.format(", ".join([f"'{cat}'" for cat in categories]))
+    return prompt + STRUCTURED_OUTPUT_INSTRUCTIONS if structured else prompt
+
+
+def build_messages(dialog_text: str, categories: list) -> list:
+    """
+    Системное сообщение — неизменный чек-лист с зафиксированными категориями, сообщение пользователя —
+    только текст диалога. Одинаковое начало запроса позволяет OpenAI брать его из кэша промптов.
+    """
+    return [
+        {"role": "system", "content": _system_prompt(tuple(categories), config.ANALYSIS_STRUCTURED_OUTPUT)},
+        {"role": "user", "content": dialog_text},
+    ]
+
+
+def build_request_body(messages: list, categories: list) -> dict:
+    """Параметры chat.completions.create для анализа (общие для обычного и пакетного режима)."""
+    body = {
+        "model": RECOMMENDED_MODEL,
+        "messages": messages,
+        "prompt_cache_key": prompt_cache_key(categories),
+    }
+    if config.ANALYSIS_STRUCTURED_OUTPUT:
+        body["response_format"] = response_format(categories)
+    return body
+
+
+def prompt_cache_key(categories: list) -> str:
+    """Ключ маршрутизации кэша промптов: запросы с одинаковым системным сообщением идут на один кэш."""
+    system_prompt = _system_prompt(tuple(categories), config.ANALYSIS_STRUCTURED_OUTPUT)
+    return f"dialog-analysis-{analysis_cache.prompt_version(system_prompt)}"
+
+
+# --- Учет токенов ---
+
+def record_usage(usage) -> dict:
+    """
+    Токены запроса из usage ответа (объект SDK или dict из Batch API), включая
+    prompt_tokens_details.cached_tokens. Итоги за день (и доля токенов из кэша промптов)
+    считаются по запросам, сохраненным analysis_metrics.
+    """
+    if usage is None:
+        return {}
+    if not isinstance(usage, dict):
+        usage = usage.model_dump()
+    details = usage.get('prompt_tokens_details') or {}
+    tokens = {
+        'prompt_tokens': usage.get('prompt_tokens') or 0,
+        'cached_tokens': details.get('cached_tokens') or 0,
+        'completion_tokens': usage.get('completion_tokens') or 0,
+    }
+    return tokens
+
+
+# --- Статистика анализа для ежедневного отчета ---
+
+def format_process_stats() -> str:
+    """
+    Блок ежедневного отчета (HTML для Telegram) со счетчиками анализа с момента запуска процесса
+    (итоги и стоимость за день по сохраненным запросам — analysis_metrics.format_daily_rollup).
+    Пусто, если счетчики нулевые.
+    """
+    cache = analysis_cache.get_cache_stats()
+    engine = openai_engine.get_engine_stats()
+    parse = get_parse_stats()
+    logger.info(f"Статистика анализа с момента запуска: кэш {cache}, движок OpenAI {engine}, разбор ответов {parse}")
+
+    lines = []
+    lookups = cache['hits'] + cache['misses']
+    if lookups:
+        lines.append(f"   Кэш анализов: попаданий {cache['hits']} из {lookups} ({cache['hit_ratio']:.0%}), "
+                     f"ошибок {cache['errors']}")
+    if engine['requests']:
+        lines.append(f"   Запросы OpenAI: {engine['requests']}, успешных {engine['succeeded']}, "
+                     f"повторов {engine['retries']} (из них 429: {engine['rate_limited']}), неудачных {engine['failed']}")
+    parsed_total = parse['parsed'] + parse['repaired'] + parse['failed']
+    if parsed_total:
+        lines.append(f"   Разбор ответов: {parsed_total}, исправлено повторным запросом {parse['repaired']}, "
+                     f"не разобрано {parse['failed']} ({parse['failure_rate']:.0%}), "
+                     f"в среднем {parse['avg_parse_ms']:.1f} мс")
+    if not lines:
+        return ""
+    return "\n\n⚙️ Анализ с момента запуска:\n" + "\n".join(lines)
+
+
 def analyze_dialog(dialog_text: str, categories: list) -> tuple[dict, str] | None:
     """
     Отправляет диалог в OpenAI API для анализа и возвращает структурированные данные и резюме.
     """
+    cache_key = analysis_cache.make_key(RECOMMENDED_MODEL, PROMPT_TEMPLATE, categories, dialog_text)
+    cached = analysis_cache.get(cache_key)
+    if cached:
+        logger.info("Результат анализа диалога взят из кэша.")
+        return cached
+
     logger.info(f"Начало анализа диалога с помощью OpenAI, модель: {RECOMMENDED_MODEL}.")
-    # Используем PROMPT_TEMPLATE из config.
-    # PROMPT_TEMPLATE теперь использует {0} и {1} для большей надежности (исправлено в config.py).
-    prompt = PROMPT_TEMPLATE.format(
-        ", ".join([f"'{cat}'" for cat in categories]),
-        dialog_text
-    )
-    logger.debug(f"Prompt для OpenAI: {prompt[:200]}...")
+    messages = build_messages(dialog_text, categories)
+    logger.debug(f"Диалог для OpenAI: {dialog_text[:200]}...")
 
+    request_body = build_request_body(messages, categories)
+    repair_attempts = config.ANALYSIS_REPAIR_ATTEMPTS if config.ANALYSIS_STRUCTURED_OUTPUT else 0
+
+    request_info = {}
+    request_start = time.perf_counter()
     try:
-        response = client.chat.completions.create(
-            model=RECOMMENDED_MODEL,
-            messages=[{"role": "user", "content": prompt}],
-        )
-        logger.info("Запрос к OpenAI успешно выполнен.")
+        for attempt in range(repair_attempts + 1):
+            # Запрос идет через общий асинхронный движок: адаптивный лимит параллелизма,
+            # повторы временных ошибок с задержкой и дедлайн на весь запрос
+            request_info, request_start = {}, time.perf_counter()
+            response = openai_engine.chat_completion(info=request_info, **request_body)
+            latency = time.perf_counter() - request_start
+            tokens = record_usage(response.usage)
+            logger.info(f"Запрос к OpenAI успешно выполнен. Токены: вход {tokens.get('prompt_tokens')} "
+                        f"(из кэша {tokens.get('cached_tokens')}), выход {tokens.get('completion_tokens')}.")
 
-        raw_response = response.choices[0].message.content
-        # Уровень DEBUG покажет сырой ответ в логах
-        logger.debug(f"Raw OpenAI response:\n{raw_response}")
+            message = response.choices[0].message
+            raw_response = message.content
+            # Уровень DEBUG покажет сырой ответ в логах
+            logger.debug(f"Raw OpenAI response:\n{raw_response}")
 
-        json_data, summary = parse_openai_response(raw_response)
+            parse_start = time.perf_counter()
+            if getattr(message, 'refusal', None):
+                json_data, summary, error = None, None, f"модель отказалась отвечать: {message.refusal}"
+            else:
+                json_data, summary, error = parse_analysis_response(raw_response, categories)
+            parse_seconds = time.perf_counter() - parse_start
+            analysis_metrics.record_request(
+                RECOMMENDED_MODEL, latency, tokens, request_info.get('retries', 0),
+                analysis_metrics.OUTCOME_PARSED if json_data and summary else analysis_metrics.OUTCOME_INVALID
+            )
 
-        if json_data and summary:
-            logger.info("Анализ диалога завершен успешно.")
-            return json_data, summary
-        else:
-            logger.warning("Анализ диалога не дал валидных данных. Возвращаем None.")
-            return None, None
-    except openai.APIError as e:
-        logger.error(f"Ошибка API OpenAI: {e}")
-        return None, None
-    except openai.APIConnectionError as e:
-        logger.error(f"Ошибка подключения к API OpenAI: {e}")
+            if json_data and summary:
+                _record_parse('repaired' if attempt else 'parsed', parse_seconds)
+                logger.info("Анализ диалога завершен успешно." if not attempt else
+                            f"Анализ диалога завершен успешно после исправления ({attempt}).")
+                analysis_cache.put(cache_key, RECOMMENDED_MODEL, json_data, summary)
+                return json_data, summary
+
+            if attempt >= repair_attempts:
+                _record_parse('failed', parse_seconds)
+                break
+            # Просим модель исправить ответ, показав ей ее же ответ и найденные нарушения
+            logger.warning(f"Ответ OpenAI не прошел проверку ({error}). Запрашиваем исправление.")
+            request_body["messages"] = messages + [
+                {"role": "assistant", "content": raw_response or ""},
+                {"role": "user", "content": f"Ответ не прошел проверку: {error}. "
+                                            f"Верни исправленный JSON-объект строго по схеме."},
+            ]
+
+        logger.warning("Анализ диалога не дал валидных данных. Возвращаем None.")
         return None, None
-    except openai.RateLimitError as e:
-        logger.error(f"Превышен лимит запросов к API OpenAI: {e}")
+    except AnalysisUnavailableError as e:
+        # Лимиты и сбои подключения не должны тихо превращать диалог в базовый экспорт:
+        # решение о повторе принимает конвейер
+        logger.error(f"❌ OpenAI недоступен, анализ не выполнен: {e}")
+        analysis_metrics.record_request(RECOMMENDED_MODEL, time.perf_counter() - request_start, None,
+                                        request_info.get('retries', 0), analysis_metrics.OUTCOME_UNAVAILABLE)
+        raise
+    except openai_api_error() as e:
+        # Постоянные ошибки API (неверный запрос и т.п.) — повтор не поможет
+        logger.error(f"Ошибка API OpenAI: {e}")
+        analysis_metrics.record_request(RECOMMENDED_MODEL, time.perf_counter() - request_start, None,
+                                        request_info.get('retries', 0), analysis_metrics.OUTCOME_API_ERROR)
         return None, None
     except Exception as e:
         logger.error(f"Неизвестная ошибка при работе с OpenAI: {e}", exc_info=True)
         return None, None
 
 
+# --- Пакетный режим (OpenAI Batch API) ---
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def submit_batch(requests_bodies: dict) -> str:
+    """
+    Собирает запросы {custom_id: тело chat.completions} в JSONL-файл Batch API, загружает его и создает пакет.
+    Возвращает ID пакета.
+    """
+    lines = [
+        json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": body,
+        }, ensure_ascii=False)
+        for custom_id, body in requests_bodies.items()
+    ]
+    jsonl = ("\n".join(lines) + "\n").encode('utf-8')
+
+    batch_file = get_client().files.create(file=("dialogs_batch.jsonl", io.BytesIO(jsonl)), purpose="batch")
+    batch = get_client().batches.create(
+        input_file_id=batch_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window="24h",
+    )
+    logger.info(f"Пакет анализа {batch.id} отправлен в OpenAI ({len(requests_bodies)} диалогов).")
+    return batch.id
+
+
+def wait_for_batch(batch_id: str, timeout: float, poll_interval: float):
+    """
+    Опрашивает пакет до финального статуса. Если пакет не успел за timeout секунд,
+    он отменяется и возвращается None.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        batch = get_client().batches.retrieve(batch_id)
+        if batch.status in BATCH_FINAL_STATUSES:
+            logger.info(f"Пакет анализа {batch_id} завершен со статусом '{batch.status}'.")
+            return batch
+        if time.monotonic() >= deadline:
+            logger.error(f"❌ Пакет анализа {batch_id} не завершился за {timeout:.0f} с (статус '{batch.status}'). Отменяем.")
+            try:
+                get_client().batches.cancel(batch_id)
+            except Exception as e:
+                logger.error(f"❌ Не удалось отменить пакет {batch_id}: {e}", exc_info=True)
+            return None
+        time.sleep(poll_interval)
+
+
+def collect_batch_results(batch, categories: list) -> dict:
+    """Читает выходной файл пакета и разбирает каждый ответ (parse_analysis_response)."""
+    results = {}
+    if not getattr(batch, 'output_file_id', None):
+        return results
+
+    content = get_client().files.content(batch.output_file_id).text
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+            custom_id = item.get('custom_id')
+            response = item.get('response') or {}
+            if item.get('error') or response.get('status_code') != 200:
+                logger.error(f"❌ Ошибка анализа в пакете для {custom_id}: {item.get('error') or response.get('status_code')}")
+                continue
+            raw_response = response['body']['choices'][0]['message']['content']
+            tokens = record_usage(response['body'].get('usage'))
+            model = response['body'].get('model') or RECOMMENDED_MODEL
+        except Exception as e:
+            logger.error(f"❌ Не удалось разобрать строку результата пакета: {e}", exc_info=True)
+            continue
+
+        parse_start = time.perf_counter()
+        json_data, summary, error = parse_analysis_response(raw_response, categories)
+        # Задержка отдельного ответа внутри пакета не определена
+        analysis_metrics.record_request(
+            model, None, tokens, 0,
+            analysis_metrics.OUTCOME_PARSED if json_data and summary else analysis_metrics.OUTCOME_INVALID,
+            mode='batch'
+        )
+        if json_data and summary:
+            _record_parse('parsed', time.perf_counter() - parse_start)
+            results[custom_id] = (json_data, summary)
+        else:
+            # Без исправления: такой диалог будет проанализирован обычным запросом
+            _record_parse('failed', time.perf_counter() - parse_start)
+            logger.warning(f"Ответ пакета для {custom_id} не прошел проверку: {error}")
+    return results
+
+
+def analyze_dialogs_batch(dialogs: dict, categories: list,
+                          timeout: float | None = None, poll_interval: float | None = None) -> dict:
+    """
+    Пакетный анализ {custom_id: dialog_text} через OpenAI Batch API.
+    Возвращает {custom_id: (json_data, summary)} только для успешно разобранных ответов;
+    диалоги без результата вызывающий код анализирует обычным способом.
+    """
+    timeout = config.ANALYSIS_BATCH_TIMEOUT_SECONDS if timeout is None else timeout
+    poll_interval = config.ANALYSIS_BATCH_POLL_SECONDS if poll_interval is None else poll_interval
+
+    results, prompts, cache_keys = {}, {}, {}
+    for custom_id, dialog_text in dialogs.items():
+        cache_key = analysis_cache.make_key(RECOMMENDED_MODEL, PROMPT_TEMPLATE, categories, dialog_text)
+        cached = analysis_cache.get(cache_key)
+        if cached:
+            results[custom_id] = cached
+        else:
+            prompts[custom_id] = build_request_body(build_messages(dialog_text, categories), categories)
+            cache_keys[custom_id] = cache_key
+
+    if not prompts:
+        return results
+
+    try:
+        batch = wait_for_batch(submit_batch(prompts), timeout, poll_interval)
+        batch_results = collect_batch_results(batch, categories) if batch else {}
+    except Exception as e:
+        logger.error(f"❌ Ошибка пакетного анализа OpenAI: {e}", exc_info=True)
+        return results
+
+    for custom_id, (json_data, summary) in batch_results.items():
+        if custom_id not in cache_keys:
+            continue
+        analysis_cache.put(cache_keys[custom_id], RECOMMENDED_MODEL, json_data, summary)
+        results[custom_id] = (json_data, summary)
+
+    logger.info(f"Пакетный анализ: получено {len(batch_results)} из {len(prompts)} результатов.")
+    return results
+
+
 # --- Вспомогательные функции для работы с файлами ---
 def parse_dialog_file(file_path: str) -> str | None:
     """
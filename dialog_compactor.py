@@ -0,0 +1,132 @@
+import logging
+import re
+from datetime import datetime
+from typing import Dict, Any, List
+
+import config
+
+# tiktoken нужен только для точного подсчета токенов, без него используется оценка по длине текста
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Сжатие диалога перед анализом OpenAI:
+# 1. ISO-метки времени с микросекундами заменяются на минуты от начала диалога ([+12 мин]);
+# 2. подряд идущие заглушки вложений одного отправителя ("Изображение") схлопываются в одну строку;
+# 3. если диалог не укладывается в ANALYSIS_MAX_DIALOG_TOKENS, из середины выбрасываются сообщения,
+#    первые ANALYSIS_KEEP_HEAD_MESSAGES и максимум последних сохраняются.
+# В экспорт по-прежнему уходит исходный текст, сжатый нужен только модели.
+
+MESSAGE_REGEX = re.compile(r'^\[(.*?)\] (КЛИЕНТ|МЕНЕДЖЕР): (.*)$')
+# Текст сообщений-заглушек, которые пишет dialog_listener вместо вложений
+PLACEHOLDER_MESSAGES = {'Изображение'}
+# Кодировка семейства моделей gpt-4o / gpt-5
+TOKENIZER_ENCODING = 'o200k_base'
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """Количество токенов текста (tiktoken, а без него — оценка ~3 символа на токен для кириллицы)."""
+    global _encoding
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 3 + 1
+
+
+def parse_messages(dialog_text: str) -> List[Dict[str, Any]]:
+    """
+    Разбирает текст диалога на сообщения {'time', 'sender', 'content'}.
+    Строки без метки времени — продолжение многострочного сообщения.
+    """
+    messages = []
+    for line in dialog_text.splitlines():
+        match = MESSAGE_REGEX.match(line.strip())
+        if match:
+            timestamp_str, sender, content = match.groups()
+            try:
+                message_time = datetime.fromisoformat(timestamp_str)
+            except ValueError:
+                message_time = None
+            messages.append({'time': message_time, 'sender': sender, 'content': content.strip()})
+        elif messages and line.strip():
+            messages[-1]['content'] += "\n" + line.strip()
+        elif line.strip():
+            messages.append({'time': None, 'sender': None, 'content': line.strip()})
+    return messages
+
+
+def _collapse_placeholders(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Схлопывает подряд идущие одинаковые заглушки одного отправителя: 'Изображение ×3'."""
+    collapsed = []
+    for message in messages:
+        previous = collapsed[-1] if collapsed else None
+        if (previous and message['content'] in PLACEHOLDER_MESSAGES
+                and previous['sender'] == message['sender'] and previous['base_content'] == message['content']):
+            previous['repeat'] += 1
+            continue
+        collapsed.append({**message, 'base_content': message['content'], 'repeat': 1})
+    return collapsed
+
+
+def _format_message(message: Dict[str, Any], start_time: datetime | None) -> str:
+    content = message['base_content']
+    if message['repeat'] > 1:
+        content = f"{content} ×{message['repeat']}"
+    if message['sender'] is None:
+        return content
+    if message['time'] is not None and start_time is not None:
+        minutes = int((message['time'] - start_time).total_seconds() // 60)
+        return f"[+{minutes} мин] {message['sender']}: {content}"
+    return f"{message['sender']}: {content}"
+
+
+def compact_dialog(dialog_text: str, max_tokens: int | None = None,
+                   keep_head: int | None = None) -> tuple[str, Dict[str, int]]:
+    """
+    Возвращает (сжатый текст, статистика). Статистика: tokens_before, tokens_after,
+    messages_before, messages_after, dropped_messages.
+    """
+    max_tokens = max_tokens or config.ANALYSIS_MAX_DIALOG_TOKENS
+    keep_head = config.ANALYSIS_KEEP_HEAD_MESSAGES if keep_head is None else keep_head
+
+    messages = parse_messages(dialog_text)
+    stats = {
+        'tokens_before': count_tokens(dialog_text),
+        'messages_before': len(messages),
+        'dropped_messages': 0,
+    }
+    if not messages:
+        stats.update(tokens_after=stats['tokens_before'], messages_after=0)
+        return dialog_text, stats
+
+    start_time = next((message['time'] for message in messages if message['time'] is not None), None)
+    lines = [_format_message(message, start_time) for message in _collapse_placeholders(messages)]
+    line_tokens = [count_tokens(line) + 1 for line in lines]  # +1 — перевод строки
+
+    if sum(line_tokens) > max_tokens and len(lines) > keep_head + 1:
+        # Начало диалога (приветствие, квалификация) и его конец (закрытие, договоренности)
+        # важнее всего для оценки, поэтому выбрасываем сообщения из середины
+        head = lines[:keep_head]
+        budget = max_tokens - sum(line_tokens[:keep_head]) - count_tokens("[... пропущено 0000 сообщений ...]")
+        tail_start = len(lines)
+        while tail_start > keep_head and budget - line_tokens[tail_start - 1] >= 0:
+            tail_start -= 1
+            budget -= line_tokens[tail_start]
+        # Последнее сообщение сохраняем всегда
+        tail_start = min(tail_start, len(lines) - 1)
+        dropped = tail_start - keep_head
+        if dropped > 0:
+            lines = head + [f"[... пропущено {dropped} сообщений ...]"] + lines[tail_start:]
+            stats['dropped_messages'] = dropped
+
+    compacted = "\n".join(lines)
+    stats['tokens_after'] = count_tokens(compacted)
+    stats['messages_after'] = len(lines)
+    return compacted, stats
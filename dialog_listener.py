@@ -3,7 +3,6 @@ import logging
 import os
 import time
 import requests
-import websocket
 import pytz
 from threading import Thread
 from datetime import datetime, time as dt_time
@@ -13,9 +12,15 @@ import urllib.parse
 # Импортируем новые модули
 from dialog_analyser import analyze_dialog
 from data_exporter import move_dialog_to_closed, process_and_export_data
+from openai_engine import AnalysisUnavailableError
 from report_generator import generate_daily_report
 # ИМПОРТ НОВОЙ ЛОГИКИ:
 from retailcrm_api import create_ad_hoc_avito_task
+from export_outbox import start_outbox_workers
+from customer_index import start_customer_index_sync
+from order_mirror import start_order_mirror_sync
+import intraday_metrics
+from http_session import get_session
 
 # Настройка логирования для этого модуля (можно использовать тот же, что и в main.py)
 logger = logging.getLogger(__name__)
@@ -58,27 +63,34 @@ AVITO_TASK_COMPLETED_DIALOGS = set()
 #           Вспомогательные функции
 # --------------------------------------- #
 
+# Специальные символы MarkdownV2, которые нужно экранировать обратной косой чертой
+MARKDOWN_V2_SPECIAL_CHARS = r'_*[]()~`>#+-=|{}.!'
+
+
+def escape_markdown_v2(text: str) -> str:
+    """
+    Экранирует специальные символы MarkdownV2.
+    Цепочка str.replace быстрее str.translate и re.sub: на кириллическом тексте translate медленнее в ~4 раза.
+    """
+    for char in MARKDOWN_V2_SPECIAL_CHARS:
+        text = text.replace(char, f'\\{char}')
+    return text
+
+
 def send_telegram_notification(text: str, topic_id: str):
     """
     Отправляет уведомление в Telegram-группу с поддержкой тем.
     """
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+    url = f"{config.TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
     payload = {
         'chat_id': TELEGRAM_CHAT_ID,
         'message_thread_id': topic_id,
-        'text': text,
+        'text': escape_markdown_v2(text),
         'parse_mode': 'MarkdownV2'
     }
 
-    # Экранируем специальные символы для MarkdownV2
-    special_chars = r'_*[]()~`>#+-=|{}.!'
-    clean_text = text
-    for char in special_chars:
-        clean_text = clean_text.replace(char, f'\\{char}')
-    payload['text'] = clean_text
-
     try:
-        response = requests.post(url, data=payload)
+        response = get_session().post(url, data=payload)
         response.raise_for_status()
         logger.info("Уведомление успешно отправлено в Telegram.")
     except requests.exceptions.RequestException as e:
@@ -140,11 +152,21 @@ def save_message_to_file(dialog_id: int, client_phone: str, sender_type: str, me
     formatted_message = f"[{timestamp}] {sender_type.upper()}: {message_text}\n"
 
     try:
+        new_file = not os.path.exists(file_path)
         with open(file_path, 'a', encoding='utf-8') as f:
             f.write(formatted_message)
         logger.info(f"Сообщение для диалога {dialog_id} сохранено в файл: {file_path}")
     except Exception as e:
         logger.error(f"Ошибка при сохранении сообщения в файл {file_path}: {e}")
+        return
+
+    # Метрики 3–5 отчета обновляются сразу, а не пересчитываются по файлам в 23:00
+    if config.INTRADAY_METRICS_ENABLED:
+        try:
+            intraday_metrics.record_message(dialog_id, client_phone, sender_type.upper(),
+                                            datetime.fromisoformat(timestamp), new_file)
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении промежуточных метрик диалога {dialog_id}: {e}", exc_info=True)
 
 
 # --------------------------------------- #
@@ -240,7 +262,7 @@ def on_message(ws, message):
                 logger.info(f"Получено событие закрытия для диалога {dialog_id}.")
                 # Запускаем обработку в отдельном потоке
                 thread = Thread(
-                    target=process_and_export_data,
+                    target=process_closed_dialog,
                     args=(dialog_id, client_phone)
                 )
                 thread.start()
@@ -257,6 +279,29 @@ def on_message(ws, message):
         logger.error(f"Ошибка: {e}")
 
 
+def process_closed_dialog(dialog_id: int, client_phone: str):
+    """
+    Обработка закрытого диалога в потоке слушателя. Если OpenAI недоступен, обработка повторяется
+    с растущей паузой: журнал обработки считает попытки, и после LEDGER_MAX_ATTEMPTS диалог уходит
+    в базовый экспорт, а не ждет принудительного закрытия в 23:00.
+    """
+    for attempt in range(1, config.LEDGER_MAX_ATTEMPTS + 1):
+        try:
+            process_and_export_data(dialog_id, client_phone)
+            return
+        except AnalysisUnavailableError:
+            delay = min(config.LEDGER_RETRY_BASE_SECONDS * 2 ** (attempt - 1), config.LEDGER_RETRY_MAX_SECONDS)
+            logger.warning(f"Диалог {dialog_id}: OpenAI недоступен, повтор обработки через {delay:.0f} с.")
+            time.sleep(delay)
+        except Exception as e:
+            # Ошибка уже записана в журнал обработки; диалог остается в 'active' до 23:00
+            logger.error(f"Ошибка обработки закрытого диалога {dialog_id}: {e}")
+            return
+    # Последняя попытка по журналу сама уходит в базовый экспорт, так что сюда доходит только гонка
+    # с другим обработчиком этого диалога
+    logger.error(f"Диалог {dialog_id}: OpenAI недоступен, повторы исчерпаны. Диалог остается до 23:00.")
+
+
 def on_error(ws, error):
     logger.error(f"WebSocket ошибка: {error}")
 
@@ -279,7 +324,10 @@ def create_websocket():
     """
     Создаёт WebSocketApp для RetailCRM и возвращает его.
     """
-    ws_url = f"{API_URL.replace('https://', 'wss://')}/ws?events=message_new,dialog_closed"
+    # websocket-client нужен только слушателю: импортируется при создании соединения
+    import websocket
+
+    ws_url = f"{API_URL.replace('https://', 'wss://').replace('http://', 'ws://')}/ws?events=message_new,dialog_closed"
     ws = websocket.WebSocketApp(
         ws_url,
         header=["X-Bot-Token: " + TOKEN],
@@ -383,8 +431,12 @@ def start_listener():
     """
     Точка входа для запуска слушателя событий и планировщика отчетов.
     """
+    if not config.OPENAI_API_KEY:
+        logger.error("Переменная OPENAI_API_KEY пуста. Пожалуйста, проверьте файл .env.")
+        return
+
     try:
-        test_request = requests.get(f"{API_URL}/bots", headers=HEADERS)
+        test_request = get_session().get(f"{API_URL}/bots", headers=HEADERS)
         if test_request.status_code == 403:
             logger.error("Ошибка авторизации: неверный токен бота.")
             return
@@ -392,6 +444,9 @@ def start_listener():
         logger.error(f"Не удалось подключиться к API RetailCRM: {e}")
         return
 
+    # 0. Восстановление промежуточных метрик 3–5 до приема первых сообщений
+    intraday_metrics.start_intraday_metrics()
+
     # 1. Запуск слушателя WebSocket
     ws = create_websocket()
     ws_thread = Thread(target=run_with_reconnect, args=(ws,), daemon=True)
@@ -401,6 +456,15 @@ def start_listener():
     report_scheduler_thread = Thread(target=report_scheduler, daemon=True)
     report_scheduler_thread.start()
 
+    # 3. Запуск воркеров очереди экспорта в Google Forms
+    start_outbox_workers()
+
+    # 4. Запуск синхронизации локального индекса клиентов
+    start_customer_index_sync()
+
+    # 5. Запуск синхронизации зеркала заказов
+    start_order_mirror_sync()
+
     try:
         # Основной поток просто ожидает
         while True:
@@ -0,0 +1,170 @@
+import logging
+import re
+import threading
+from typing import Dict, Any, List
+
+import config
+from dialog_compactor import parse_messages, PLACEHOLDER_MESSAGES
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Локальный предклассификатор нецелевых диалогов ("Технический", "Доставка", "Неизвестно").
+# По таким диалогам модель все равно ставит нули по всем критериям, поэтому при уверенном
+# срабатывании правил запрос к OpenAI не нужен. Режимы (PRECLASSIFIER_MODE):
+#   off    — выключен;
+#   shadow — предсказание только сравнивается с ответом модели (статистика согласия), анализ как обычно;
+#   on     — уверенные предсказания (>= PRECLASSIFIER_MIN_CONFIDENCE) идут сразу в экспорт
+#            с нулевыми оценками (PRECLASSIFIER_ROUTE=zero) или в базовый экспорт (free).
+
+MODE_OFF = 'off'
+MODE_SHADOW = 'shadow'
+MODE_ON = 'on'
+
+NON_SALES_CATEGORIES = ('Технический', 'Доставка', 'Неизвестно')
+
+# Правила: (регулярное выражение, вес). Ищутся по сообщениям клиента и менеджера
+KEYWORD_RULES: Dict[str, List[tuple]] = {
+    'Доставка': [
+        (re.compile(r'доставк|курьер'), 1.0),
+        (re.compile(r'трек|отслежива|номер отправлени'), 2.0),
+        (re.compile(r'сдэк|cdek|боксберри|boxberry|почт\w* росси|пэк|деловые линии'), 1.5),
+        (re.compile(r'пункт\w* выдачи|пвз|постамат|самовывоз'), 1.0),
+        (re.compile(r'посылк|отправлен|отгруж|когда (придет|привезут|доставят)|где (мой )?заказ'), 1.5),
+    ],
+    'Технический': [
+        (re.compile(r'не работает|не включается|сломал|слома|не заряжа|не печата'), 2.0),
+        (re.compile(r'брак|дефект|гаранти|сервисн\w* центр|ремонт'), 2.0),
+        (re.compile(r'инструкци|подключ|настро|прошивк|драйвер|ошибк'), 1.0),
+        (re.compile(r'возврат|вернуть товар|обмен'), 1.0),
+    ],
+}
+
+# Признаки продажи: снижают уверенность в нецелевой категории
+SALES_RULES: List[tuple] = [
+    (re.compile(r'цен[аеуы]|стоимост|сколько стоит|прайс'), 2.0),
+    (re.compile(r'в наличии|купить|заказать|оформить|оформлени|подобрать|подберите'), 2.0),
+    (re.compile(r'оплат|сч[её]т на|скидк|рассрочк|кредит'), 1.5),
+    (re.compile(r'каталог|артикул|аналог|комплект'), 1.0),
+]
+
+# Априорный вес "не знаю": чем больше совпадений правил, тем ближе уверенность к 1
+PRIOR_WEIGHT = 1.0
+# Диалог без содержательных сообщений клиента (только приветствие/вложения) — "Неизвестно".
+# Уверенность ниже порога PRECLASSIFIER_MIN_CONFIDENCE: короткие ответы клиента бывают и в продажах,
+# которые ведет менеджер, поэтому в режиме on это правило само по себе OpenAI не обходит
+UNKNOWN_MAX_CLIENT_WORDS = 3
+UNKNOWN_CONFIDENCE = 0.6
+
+# Статистика с момента запуска процесса. agreement — {предсказание: {категория модели: количество}}
+PRECLASSIFIER_STATS: Dict[str, Any] = {
+    'predicted': 0, 'confident': 0, 'routed': 0,
+    'compared': 0, 'agreed': 0, 'confident_compared': 0, 'confident_agreed': 0,
+    'agreement': {},
+}
+_stats_lock = threading.Lock()
+
+
+def _score(rules: List[tuple], text: str) -> float:
+    return sum(weight for pattern, weight in rules if pattern.search(text))
+
+
+def classify(dialog_text: str) -> tuple[str | None, float]:
+    """
+    Возвращает (нецелевая категория или None, уверенность 0..1).
+    None — диалог похож на продажу или правила ничего не нашли.
+    """
+    messages = parse_messages(dialog_text)
+    client_text = " ".join(message['content'] for message in messages
+                           if message['sender'] == 'КЛИЕНТ' and message['content'] not in PLACEHOLDER_MESSAGES)
+    all_text = " ".join(message['content'] for message in messages).lower()
+
+    sales_score = _score(SALES_RULES, all_text)
+    if len(client_text.split()) <= UNKNOWN_MAX_CLIENT_WORDS and not sales_score:
+        return 'Неизвестно', UNKNOWN_CONFIDENCE
+
+    scores = {category: _score(rules, all_text) for category, rules in KEYWORD_RULES.items()}
+    category, best = max(scores.items(), key=lambda item: item[1])
+    if best <= 0:
+        return None, 0.0
+    others = sum(scores.values()) - best
+    return category, best / (best + others + sales_score + PRIOR_WEIGHT)
+
+
+def zero_score_analysis(category: str) -> tuple[dict, str]:
+    """Результат анализа для нецелевого диалога: все критерии 0 и резюме в HTML-разметке промпта."""
+    json_data = {'chat_category': category}
+    json_data.update({criterion: 0 for criterion in config.ANALYSIS_CRITERIA})
+    summary = (f"<b>Категория:</b> {category}\n"
+               f"<i>Нецелевой диалог, определен локальным классификатором. Критерии продаж не оцениваются.</i>")
+    return json_data, summary
+
+
+def is_confident(confidence: float) -> bool:
+    return confidence >= config.PRECLASSIFIER_MIN_CONFIDENCE
+
+
+def record_prediction(category: str | None, confidence: float, routed: bool):
+    with _stats_lock:
+        PRECLASSIFIER_STATS['predicted'] += 1
+        if category and is_confident(confidence):
+            PRECLASSIFIER_STATS['confident'] += 1
+        if routed:
+            PRECLASSIFIER_STATS['routed'] += 1
+
+
+def record_agreement(category: str | None, confidence: float, llm_category: str | None):
+    """Сравнивает предсказание с категорией, которую поставила модель (режим shadow)."""
+    predicted = category or 'Продажа'
+    # Для продажных категорий модели важен только факт "не нецелевой"
+    actual = llm_category if llm_category in NON_SALES_CATEGORIES else 'Продажа'
+    agreed = predicted == actual
+    with _stats_lock:
+        PRECLASSIFIER_STATS['compared'] += 1
+        PRECLASSIFIER_STATS['agreed'] += agreed
+        if category and is_confident(confidence):
+            PRECLASSIFIER_STATS['confident_compared'] += 1
+            PRECLASSIFIER_STATS['confident_agreed'] += agreed
+        row = PRECLASSIFIER_STATS['agreement'].setdefault(predicted, {})
+        row[actual] = row.get(actual, 0) + 1
+    if category and is_confident(confidence) and not agreed:
+        logger.warning(f"Предклассификатор: уверенно '{category}' ({confidence:.2f}), модель — '{llm_category}'.")
+
+
+def get_preclassifier_stats() -> Dict[str, Any]:
+    """
+    Снимок статистики с долей согласия с моделью. confident_precision — доля уверенных
+    предсказаний, совпавших с моделью: именно они в режиме on обходят OpenAI.
+    """
+    with _stats_lock:
+        stats = {**PRECLASSIFIER_STATS,
+                 'agreement': {key: dict(value) for key, value in PRECLASSIFIER_STATS['agreement'].items()}}
+    stats['agreement_rate'] = stats['agreed'] / stats['compared'] if stats['compared'] else 0.0
+    stats['confident_precision'] = (stats['confident_agreed'] / stats['confident_compared']
+                                    if stats['confident_compared'] else 0.0)
+    return stats
+
+
+def format_preclassifier_stats() -> str:
+    """
+    Блок ежедневного отчета (HTML для Telegram) со статистикой предклассификатора с момента запуска:
+    по согласию с моделью в режиме shadow решают, можно ли включать режим on. Пусто, если он выключен.
+    """
+    if config.PRECLASSIFIER_MODE == MODE_OFF:
+        return ""
+    stats = get_preclassifier_stats()
+    logger.info(f"Статистика предклассификатора ({config.PRECLASSIFIER_MODE}): {stats}")
+    if not stats['predicted']:
+        return ""
+
+    text = (
+        f"\n\n🔎 Предклассификатор ({config.PRECLASSIFIER_MODE}, с момента запуска): диалогов {stats['predicted']}, "
+        f"уверенных {stats['confident']}, без OpenAI {stats['routed']}\n"
+        f"   Согласие с моделью: {stats['agreed']} из {stats['compared']} ({stats['agreement_rate']:.0%}), "
+        f"уверенные: {stats['confident_agreed']} из {stats['confident_compared']} ({stats['confident_precision']:.0%})"
+    )
+    mismatches = [f"{predicted} → {actual}: {count}" for predicted, row in stats['agreement'].items()
+                  for actual, count in row.items() if predicted != actual]
+    if mismatches:
+        text += f"\n   Расхождения: {', '.join(mismatches)}"
+    return text
@@ -0,0 +1,452 @@
+import argparse
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Any, List
+
+import config
+from export_sinks import (get_sink, get_export_sink, get_active_sinks, KIND_FULL, KIND_FREE, PermanentExportError,
+                          FULL_FORM_FIELDS, FREE_FORM_FIELDS)
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# --- Статусы строк очереди ---
+STATUS_PENDING = 'pending'
+STATUS_IN_PROGRESS = 'in_progress'
+STATUS_DONE = 'done'
+STATUS_QUARANTINED = 'quarantined'
+
+# Типы строк первой версии очереди: payload был готовыми полями Google Forms (entry.<id>)
+LEGACY_KINDS = {
+    'forms_full': (KIND_FULL, FULL_FORM_FIELDS),
+    'forms_free': (KIND_FREE, FREE_FORM_FIELDS),
+}
+
+# Как часто воркер проверяет очередь, если его не разбудили явно
+POLL_INTERVAL_SECONDS = 5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    sink TEXT NOT NULL DEFAULT '',
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at);
+"""
+
+_db_lock = threading.Lock()
+_wakeup = threading.Event()
+_initialized = False
+_workers: List[threading.Thread] = []
+
+
+# --------------------------------------- #
+#            Работа с базой
+# --------------------------------------- #
+
+def _connect() -> sqlite3.Connection:
+    db_dir = os.path.dirname(config.OUTBOX_DB_PATH)
+    if db_dir and not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+    conn = sqlite3.connect(config.OUTBOX_DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _migrate_legacy_rows(conn: sqlite3.Connection) -> int:
+    """
+    Переводит строки первой версии очереди ('forms_full' / 'forms_free' с полями entry.<id>)
+    в типы 'full' / 'free' с логическими ключами строки экспорта, чтобы их мог доставить любой приемник.
+    """
+    placeholders = ", ".join("?" for _ in LEGACY_KINDS)
+    rows = conn.execute(f"SELECT id, kind, payload, created_at FROM outbox WHERE kind IN ({placeholders})",
+                        tuple(LEGACY_KINDS)).fetchall()
+    for row in rows:
+        kind, form_fields = LEGACY_KINDS[row['kind']]
+        legacy_payload = json.loads(row['payload'])
+        payload = {'timestamp': datetime.fromtimestamp(row['created_at']).strftime('%d.%m.%Y %H:%M:%S')}
+        payload.update({key: legacy_payload[entry_id] for key, entry_id in form_fields.items()
+                        if entry_id in legacy_payload})
+        conn.execute("UPDATE outbox SET kind = ?, payload = ? WHERE id = ?",
+                     (kind, json.dumps(payload, ensure_ascii=False), row['id']))
+    return len(rows)
+
+
+def init_outbox():
+    """
+    Создает таблицу очереди и переводит строки первой версии очереди в текущий формат.
+    Строки, оставшиеся в 'in_progress' после аварийной остановки, возвращает в очередь _claim_due_batch
+    по истечении OUTBOX_LEASE_SECONDS: init_outbox вызывают и CLI, и ручной запуск отчета, и сброс
+    здесь отправил бы повторно пачку, которую сейчас доставляет слушатель.
+    """
+    global _initialized
+    with _db_lock:
+        if _initialized:
+            return
+        conn = _connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            # Очереди, созданные до появления дополнительных приемников, не имеют колонки sink.
+            # Пустой sink означает основной приемник.
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(outbox)")}
+            if 'sink' not in columns:
+                conn.execute("ALTER TABLE outbox ADD COLUMN sink TEXT NOT NULL DEFAULT ''")
+            migrated = _migrate_legacy_rows(conn)
+            conn.commit()
+        finally:
+            conn.close()
+        _initialized = True
+
+    if migrated:
+        logger.info(f"Outbox: {migrated} строк первой версии очереди переведены в текущий формат.")
+
+
+def enqueue(kind: str, payload: Dict[str, Any]) -> List[int]:
+    """
+    Записывает строку экспорта в очередь (по копии на каждый активный приемник,
+    которому нужен этот тип строк) и будит воркеры.
+    Копии доставляются и повторяются независимо, поэтому сбой одного приемника
+    не приводит к дублям в другом. Возвращает ID строк в очереди.
+    """
+    init_outbox()
+    now = time.time()
+    payload_json = json.dumps(payload, ensure_ascii=False)
+    sink_names = [sink.name for sink in get_active_sinks() if sink.accepts(kind)]
+    row_ids = []
+    with _db_lock:
+        conn = _connect()
+        try:
+            for sink_name in sink_names:
+                cursor = conn.execute(
+                    "INSERT INTO outbox (kind, sink, payload, status, attempts, next_attempt_at, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, 0, ?, ?, ?)",
+                    (kind, sink_name, payload_json, STATUS_PENDING, now, now, now)
+                )
+                row_ids.append(cursor.lastrowid)
+            conn.commit()
+        finally:
+            conn.close()
+
+    logger.info(f"Outbox: строки {row_ids} ({kind} -> {', '.join(sink_names)}) поставлены в очередь на экспорт.")
+    _wakeup.set()
+    return row_ids
+
+
+def _resolve_sink(sink_name: str):
+    """Приемник строки очереди. Пустое имя — основной приемник."""
+    return get_sink(sink_name) if sink_name else get_export_sink()
+
+
+def _ready_batch(conn: sqlite3.Connection, kind: str, sink_name: str, now: float,
+                 force: bool) -> List[sqlite3.Row]:
+    """Строки группы (тип, приемник), если пачка готова к отправке, иначе пустой список."""
+    try:
+        max_batch_size = _resolve_sink(sink_name).max_batch_size
+    except Exception as e:
+        # Доставка такой строки все равно упадет и отправит ее в карантин
+        logger.error(f"Outbox: не удалось получить приемник '{sink_name}': {e}")
+        max_batch_size = 1
+    rows = conn.execute(
+        "SELECT * FROM outbox WHERE status = ? AND kind = ? AND sink = ? AND next_attempt_at <= ? "
+        "ORDER BY id LIMIT ?",
+        (STATUS_PENDING, kind, sink_name, now, max_batch_size)
+    ).fetchall()
+
+    # Повторные попытки не ждут наполнения пачки
+    is_ready = (
+            force or
+            len(rows) >= max_batch_size or
+            rows[0]['attempts'] > 0 or
+            now - rows[0]['created_at'] >= config.EXPORT_FLUSH_INTERVAL_SECONDS
+    )
+    return rows if is_ready else []
+
+
+def _claim_due_batch(force: bool = False) -> List[sqlite3.Row]:
+    """
+    Атомарно забирает пачку строк одного типа для одного приемника, срок попытки которых наступил.
+    Пачка отдается, только если набралось max_batch_size строк приемника или самая старая из них
+    ждет дольше EXPORT_FLUSH_INTERVAL_SECONDS (force=True отдает пачку сразу). Группы (тип, приемник)
+    перебираются от самой старой строки: неготовая пачка одного приемника не задерживает остальные.
+    Захват выполняется в транзакции BEGIN IMMEDIATE: слушатель и ручной запуск (drain) не заберут
+    одни и те же строки. Там же в очередь возвращаются строки с истекшей арендой (OUTBOX_LEASE_SECONDS).
+    """
+    now = time.time()
+    with _db_lock:
+        conn = _connect()
+        try:
+            # BEGIN IMMEDIATE сразу берет блокировку на запись: выборка и захват атомарны между процессами
+            conn.execute("BEGIN IMMEDIATE")
+            recovered = conn.execute(
+                "UPDATE outbox SET status = ?, updated_at = ? WHERE status = ? AND updated_at < ?",
+                (STATUS_PENDING, now, STATUS_IN_PROGRESS, now - config.OUTBOX_LEASE_SECONDS)
+            ).rowcount
+            if recovered:
+                logger.warning(f"Outbox: {recovered} строк с истекшей арендой возвращены в очередь.")
+            groups = conn.execute(
+                "SELECT kind, sink, MIN(id) AS first_id FROM outbox WHERE status = ? AND next_attempt_at <= ? "
+                "GROUP BY kind, sink ORDER BY first_id",
+                (STATUS_PENDING, now)
+            ).fetchall()
+            for group in groups:
+                rows = _ready_batch(conn, group['kind'], group['sink'], now, force)
+                if rows:
+                    break
+            else:
+                conn.commit()
+                return []
+
+            row_ids = [row['id'] for row in rows]
+            placeholders = ", ".join("?" for _ in row_ids)
+            conn.execute(
+                f"UPDATE outbox SET status = ?, updated_at = ? WHERE id IN ({placeholders})",
+                (STATUS_IN_PROGRESS, now, *row_ids)
+            )
+            conn.commit()
+            return rows
+        finally:
+            conn.close()
+
+
+def _update_row(row_id: int, **fields):
+    fields['updated_at'] = time.time()
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    with _db_lock:
+        conn = _connect()
+        try:
+            conn.execute(f"UPDATE outbox SET {assignments} WHERE id = ?", (*fields.values(), row_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def compute_backoff(attempts: int) -> float:
+    """Экспоненциальная задержка с джиттером (±20%) для попытки номер attempts."""
+    delay = config.OUTBOX_BASE_BACKOFF_SECONDS * (2 ** max(attempts - 1, 0))
+    delay = min(delay, config.OUTBOX_MAX_BACKOFF_SECONDS)
+    return delay * random.uniform(0.8, 1.2)
+
+
+# --------------------------------------- #
+#            Доставка
+# --------------------------------------- #
+
+def _deliver(rows: List[sqlite3.Row]):
+    """
+    Пытается доставить пачку строк через текущий приемник и фиксирует результат в очереди.
+    Если пачка из нескольких строк отвергнута как постоянная ошибка, строки доставляются
+    по одной, чтобы в карантин попала только "ядовитая" строка, а не вся пачка.
+    """
+    kind = rows[0]['kind']
+    row_ids = [row['id'] for row in rows]
+    ids_str = ", ".join(str(row_id) for row_id in row_ids)
+
+    try:
+        if kind not in (KIND_FULL, KIND_FREE):
+            raise PermanentExportError(f"Неизвестный тип экспорта: {kind}")
+        _resolve_sink(rows[0]['sink']).send_batch(kind, [json.loads(row['payload']) for row in rows])
+    except PermanentExportError as e:
+        if len(rows) > 1:
+            logger.warning(f"Outbox: пачка [{ids_str}] ({kind}) отвергнута ({e}). Доставляем строки по одной.")
+            for row in rows:
+                _deliver([row])
+            return
+        _update_row(row_ids[0], status=STATUS_QUARANTINED, attempts=rows[0]['attempts'] + 1, last_error=str(e))
+        logger.error(f"❌ Outbox: строка {ids_str} ({kind}) отправлена в карантин: {e}")
+        return
+    except Exception as e:
+        for row in rows:
+            attempts = row['attempts'] + 1
+            if attempts >= config.OUTBOX_MAX_ATTEMPTS:
+                _update_row(row['id'], status=STATUS_QUARANTINED, attempts=attempts, last_error=str(e))
+                logger.error(f"❌ Outbox: строка {row['id']} ({kind}) отправлена в карантин "
+                             f"после {attempts} попыток: {e}")
+            else:
+                delay = compute_backoff(attempts)
+                _update_row(row['id'], status=STATUS_PENDING, attempts=attempts, last_error=str(e),
+                            next_attempt_at=time.time() + delay)
+                logger.warning(f"Outbox: ошибка экспорта строки {row['id']} ({kind}), попытка "
+                               f"{attempts}/{config.OUTBOX_MAX_ATTEMPTS}. Повтор через {delay:.0f} с. Ошибка: {e}")
+        return
+
+    for row in rows:
+        _update_row(row['id'], status=STATUS_DONE, attempts=row['attempts'] + 1, last_error=None)
+    logger.info(f"✅ Outbox: строки [{ids_str}] ({kind}) успешно экспортированы.")
+
+
+def drain_once() -> int:
+    """
+    Синхронно доставляет все строки, срок попытки которых уже наступил.
+    Возвращает количество обработанных строк.
+    """
+    init_outbox()
+    processed = 0
+    while True:
+        rows = _claim_due_batch(force=True)
+        if not rows:
+            return processed
+        _deliver(rows)
+        processed += len(rows)
+
+
+def _worker_loop():
+    logger.info(f"Поток outbox-воркера {threading.current_thread().name} запущен.")
+    while True:
+        try:
+            rows = _claim_due_batch()
+            if not rows:
+                _wakeup.wait(POLL_INTERVAL_SECONDS)
+                _wakeup.clear()
+                continue
+            _deliver(rows)
+        except Exception as e:
+            logger.error(f"Критическая ошибка в outbox-воркере: {e}", exc_info=True)
+            time.sleep(POLL_INTERVAL_SECONDS)
+
+
+def start_outbox_workers(num_workers: int | None = None):
+    """Запускает фоновые потоки, разбирающие очередь. Повторный вызов ничего не делает."""
+    init_outbox()
+    if _workers:
+        return
+    num_workers = num_workers or config.OUTBOX_WORKERS
+    for i in range(num_workers):
+        thread = threading.Thread(target=_worker_loop, name=f"outbox-worker-{i + 1}", daemon=True)
+        thread.start()
+        _workers.append(thread)
+
+
+# --------------------------------------- #
+#            Инспекция и повтор
+# --------------------------------------- #
+
+def get_stats() -> Dict[str, int]:
+    """Количество строк в очереди по статусам."""
+    init_outbox()
+    conn = _connect()
+    try:
+        rows = conn.execute("SELECT status, COUNT(*) AS cnt FROM outbox GROUP BY status").fetchall()
+        return {row['status']: row['cnt'] for row in rows}
+    finally:
+        conn.close()
+
+
+def list_entries(status: str | None = None, limit: int = 50) -> List[Dict[str, Any]]:
+    """Последние строки очереди (опционально с фильтром по статусу)."""
+    init_outbox()
+    conn = _connect()
+    try:
+        if status:
+            rows = conn.execute("SELECT * FROM outbox WHERE status = ? ORDER BY id DESC LIMIT ?",
+                                (status, limit)).fetchall()
+        else:
+            rows = conn.execute("SELECT * FROM outbox ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [dict(row) for row in rows]
+    finally:
+        conn.close()
+
+
+def get_entry(row_id: int) -> Dict[str, Any] | None:
+    init_outbox()
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT * FROM outbox WHERE id = ?", (row_id,)).fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
+
+def replay(row_ids: List[int] | None = None) -> int:
+    """
+    Возвращает строки в очередь на немедленную отправку со сброшенным счетчиком попыток.
+    Без row_ids повторяет все строки из карантина.
+    """
+    init_outbox()
+    now = time.time()
+    with _db_lock:
+        conn = _connect()
+        try:
+            if row_ids:
+                placeholders = ", ".join("?" for _ in row_ids)
+                count = conn.execute(
+                    f"UPDATE outbox SET status = ?, attempts = 0, next_attempt_at = ?, updated_at = ? "
+                    f"WHERE id IN ({placeholders}) AND status != ?",
+                    (STATUS_PENDING, now, now, *row_ids, STATUS_IN_PROGRESS)
+                ).rowcount
+            else:
+                count = conn.execute(
+                    "UPDATE outbox SET status = ?, attempts = 0, next_attempt_at = ?, updated_at = ? "
+                    "WHERE status = ?",
+                    (STATUS_PENDING, now, now, STATUS_QUARANTINED)
+                ).rowcount
+            conn.commit()
+        finally:
+            conn.close()
+
+    logger.info(f"Outbox: {count} строк возвращено в очередь.")
+    _wakeup.set()
+    return count
+
+
+def _format_ts(ts: float | None) -> str:
+    return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S') if ts else '-'
+
+
+def main(argv: List[str] | None = None):
+    parser = argparse.ArgumentParser(description="Инспекция и повтор очереди экспорта.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('stats', help="Количество строк по статусам")
+
+    list_parser = subparsers.add_parser('list', help="Последние строки очереди")
+    list_parser.add_argument('--status', choices=[STATUS_PENDING, STATUS_IN_PROGRESS, STATUS_DONE, STATUS_QUARANTINED])
+    list_parser.add_argument('--limit', type=int, default=50)
+
+    show_parser = subparsers.add_parser('show', help="Полное содержимое строки")
+    show_parser.add_argument('id', type=int)
+
+    replay_parser = subparsers.add_parser('replay', help="Повторить строки (по умолчанию весь карантин)")
+    replay_parser.add_argument('ids', type=int, nargs='*')
+
+    subparsers.add_parser('drain', help="Синхронно отправить все готовые к отправке строки")
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'stats':
+        for status, count in sorted(get_stats().items()):
+            print(f"{status:12} {count}")
+    elif args.command == 'list':
+        for entry in list_entries(args.status, args.limit):
+            print(f"{entry['id']:>6}  {entry['kind']:6}  {entry['sink'] or '-':10}  {entry['status']:12}  попыток: {entry['attempts']:<3} "
+                  f"создана: {_format_ts(entry['created_at'])}  след. попытка: {_format_ts(entry['next_attempt_at'])}  "
+                  f"{entry['last_error'] or ''}")
+    elif args.command == 'show':
+        entry = get_entry(args.id)
+        if not entry:
+            print(f"Строка {args.id} не найдена.")
+            return
+        entry['payload'] = json.loads(entry['payload'])
+        print(json.dumps(entry, indent=4, ensure_ascii=False))
+    elif args.command == 'replay':
+        print(f"Возвращено в очередь: {replay(args.ids)}")
+    elif args.command == 'drain':
+        print(f"Обработано строк: {drain_once()}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,203 @@
+import logging
+import threading
+import urllib.parse
+from typing import Dict, Any, List
+
+import requests
+
+import config
+from http_session import get_session
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# --- Типы экспорта ---
+KIND_FULL = 'full'  # Полный анализ (с критериями OpenAI)
+KIND_FREE = 'free'  # Базовый экспорт (без критериев OpenAI)
+
+# --- Соответствие полей строки экспорта и полей Google Forms ---
+# Полный анализ (таблица "Анализ чатов 23.30")
+FULL_FORM_FIELDS = {
+    'order_link': 'entry.408402535',  # Ссылка на заказ
+    'total_summ': 'entry.711063137',
+    'customer_type': 'entry.90684815',
+    'manager_name': 'entry.1744925750',
+    'dialog_text': 'entry.1791797075',
+    'установление_контакта': 'entry.1213746785',
+    'выявление_потребностей': 'entry.812648406',
+    'квалификация': 'entry.567411627',
+    'презентация': 'entry.154941084',
+    'возражение': 'entry.45434250',
+    'отработка_возражения': 'entry.830702183',
+    'проговорить_договоренности': 'entry.2001468013',
+    'закрытие_на_оплату': 'entry.1565546251',
+    'уточнил_цель_покупки': 'entry.982776944',
+    'последующий_уточняющий': 'entry.1132365193',
+}
+
+# Базовый экспорт (таблица "Хранение чатов")
+FREE_FORM_FIELDS = {
+    'order_link': 'entry.1563894862',
+    'total_summ': 'entry.844658380',  # Сумма заказа
+    'customer_type': 'entry.1126205710',  # Физ/Юр
+    'dialog_text': 'entry.3334402',  # Диалог
+}
+
+# Колонки листов при пакетной записи: первая колонка — отметка времени, как в ответах Google Forms
+FULL_SHEET_COLUMNS = ['timestamp'] + list(FULL_FORM_FIELDS)
+FREE_SHEET_COLUMNS = ['timestamp'] + list(FREE_FORM_FIELDS)
+
+
+class PermanentExportError(Exception):
+    """Ошибка, повтор которой не имеет смысла (строка сразу уходит в карантин)."""
+
+
+def _raise_for_status(response: requests.Response):
+    """
+    raise_for_status, который отличает постоянные ошибки от временных:
+    4xx (кроме 408/429) повторять бессмысленно.
+    """
+    try:
+        response.raise_for_status()
+    except requests.exceptions.HTTPError as e:
+        status = response.status_code
+        if 400 <= status < 500 and status not in (408, 429):
+            raise PermanentExportError(f"HTTP {status}: {e}") from e
+        raise
+
+
+class ExportSink:
+    """
+    Базовый приемник экспорта. Получает пачку строк одного типа (KIND_FULL/KIND_FREE)
+    и должен либо записать их все, либо выбросить исключение.
+    """
+    name = 'base'
+    # Сколько строк очередь может отдать приемнику за один вызов send_batch
+    max_batch_size = 1
+
+    def accepts(self, kind: str) -> bool:
+        """Нужны ли приемнику строки этого типа (строки остальных типов в него не ставятся)."""
+        return True
+
+    def send_batch(self, kind: str, rows: List[Dict[str, Any]]):
+        raise NotImplementedError
+
+
+class GoogleFormsSink(ExportSink):
+    """Одна строка = один POST в Google Forms."""
+    name = 'forms'
+    max_batch_size = 1
+
+    def __init__(self, full_url: str | None = None, free_url: str | None = None):
+        self.urls = {
+            KIND_FULL: full_url or config.GOOGLE_FORMS_URL,
+            KIND_FREE: free_url or config.GOOGLE_FORMS_URL_FREE,
+        }
+        self.fields = {KIND_FULL: FULL_FORM_FIELDS, KIND_FREE: FREE_FORM_FIELDS}
+
+    def send_batch(self, kind: str, rows: List[Dict[str, Any]]):
+        url = self.urls.get(kind)
+        if not url:
+            raise PermanentExportError(f"URL Google Forms для экспорта '{kind}' не задан в конфигурации.")
+        fields = self.fields[kind]
+
+        for row in rows:
+            form_data = {entry_id: row.get(key, '') for key, entry_id in fields.items()}
+            response = get_session().post(url, data=form_data, timeout=10)
+            _raise_for_status(response)
+
+
+class SheetsAppendSink(ExportSink):
+    """
+    Дописывает пачку строк одним запросом spreadsheets.values.append Google Sheets API.
+    Ночной всплеск принудительных закрытий превращается в несколько запросов вместо сотен.
+    """
+    name = 'sheets'
+
+    def __init__(self, api_url: str | None = None, token: str | None = None,
+                 max_batch_size: int | None = None):
+        self.api_url = (api_url or config.SHEETS_API_URL or '').rstrip('/')
+        self.token = token if token is not None else config.SHEETS_API_TOKEN
+        self.max_batch_size = max_batch_size or config.EXPORT_BATCH_SIZE
+        self.ranges = {KIND_FULL: config.SHEETS_RANGE_FULL, KIND_FREE: config.SHEETS_RANGE_FREE}
+        self.columns = {KIND_FULL: FULL_SHEET_COLUMNS, KIND_FREE: FREE_SHEET_COLUMNS}
+
+    def send_batch(self, kind: str, rows: List[Dict[str, Any]]):
+        if not self.api_url:
+            raise PermanentExportError("SHEETS_API_URL не задан в конфигурации.")
+        if kind not in self.ranges:
+            raise PermanentExportError(f"Неизвестный тип экспорта: {kind}")
+
+        columns = self.columns[kind]
+        values = [[row.get(column, '') for column in columns] for row in rows]
+        sheet_range = urllib.parse.quote(self.ranges[kind], safe='')
+        url = f"{self.api_url}/values/{sheet_range}:append"
+        params = {'valueInputOption': 'RAW', 'insertDataOption': 'INSERT_ROWS'}
+        headers = {'Authorization': f"Bearer {self.token}"} if self.token else {}
+
+        logger.info(f"Пакетная запись {len(values)} строк ({kind}) в лист '{self.ranges[kind]}'.")
+        response = get_session().post(url, params=params, json={'values': values}, headers=headers, timeout=30)
+        _raise_for_status(response)
+
+
+def _create_warehouse_sink() -> ExportSink:
+    # Ленивый импорт: хранилище тянет pyarrow, который нужен только при включенном приемнике
+    from analysis_warehouse import AnalysisWarehouseSink
+    return AnalysisWarehouseSink()
+
+
+SINK_FACTORIES = {
+    GoogleFormsSink.name: GoogleFormsSink,
+    SheetsAppendSink.name: SheetsAppendSink,
+    'warehouse': _create_warehouse_sink,
+}
+
+_sinks: Dict[str, ExportSink] = {}
+_primary_sink_name: str | None = None
+_sinks_lock = threading.Lock()
+
+
+def get_sink(name: str) -> ExportSink:
+    """Возвращает приемник по имени (экземпляр создается один раз)."""
+    with _sinks_lock:
+        if name not in _sinks:
+            factory = SINK_FACTORIES.get(name)
+            if factory is None:
+                raise PermanentExportError(f"Неизвестный приемник экспорта: '{name}'")
+            _sinks[name] = factory()
+            logger.info(f"Приемник экспорта '{name}' инициализирован.")
+        return _sinks[name]
+
+
+def get_export_sink() -> ExportSink:
+    """Основной приемник, выбранный в config.EXPORT_SINK (или подмененный через set_export_sink)."""
+    name = _primary_sink_name or config.EXPORT_SINK
+    if name not in SINK_FACTORIES and name not in _sinks:
+        logger.error(f"Неизвестный приемник экспорта '{name}'. Используем Google Forms.")
+        name = GoogleFormsSink.name
+    return get_sink(name)
+
+
+def get_active_sinks() -> List[ExportSink]:
+    """Основной приемник и дополнительные из config.EXPORT_EXTRA_SINKS."""
+    sinks = [get_export_sink()]
+    for name in config.EXPORT_EXTRA_SINKS:
+        try:
+            sink = get_sink(name)
+        except Exception as e:
+            logger.error(f"❌ Не удалось инициализировать дополнительный приемник '{name}': {e}", exc_info=True)
+            continue
+        if sink not in sinks:
+            sinks.append(sink)
+    return sinks
+
+
+def set_export_sink(sink: ExportSink | None):
+    """Подменяет основной приемник (например, на локальный стенд). None — вернуться к config.EXPORT_SINK."""
+    global _primary_sink_name
+    with _sinks_lock:
+        if sink is None:
+            _primary_sink_name = None
+            return
+        _sinks[sink.name] = sink
+        _primary_sink_name = sink.name
@@ -0,0 +1,19 @@
+import threading
+
+import requests
+
+# Общие HTTP-сессии для запросов к RetailCRM, Google и Telegram.
+# requests.get/post создают новую сессию на каждый вызов, поэтому TLS-рукопожатие и TCP-соединение
+# каждый раз устанавливаются заново. Сессия создается при первом запросе в каждом потоке
+# (requests.Session не гарантирует потокобезопасность) и дальше переиспользует соединения.
+
+_local = threading.local()
+
+
+def get_session() -> requests.Session:
+    """Сессия requests текущего потока (создается при первом обращении)."""
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        _local.session = session
+    return session
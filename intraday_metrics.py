@@ -0,0 +1,285 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime, date, timedelta
+from glob import glob
+from typing import Dict, Any, List
+
+import config
+import report_generator
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Метрики 3–5 ежедневного отчета, которые слушатель обновляет по мере поступления сообщений
+# (вместо повторного чтения и разбора всех файлов диалогов в 23:00).
+# Для каждого файла диалога хранится его вклад (сумма и число циклов ответа, медленный первый ответ,
+# отправитель и время последнего сообщения), а для каждого дня — суммы вкладов диалогов, последнее
+# сообщение которых пришлось на этот день, как в manage_and_get_dialogs. Новое сообщение снимает
+# вклад диалога с дня его прежнего последнего сообщения и добавляет к текущему: чтение метрик за день — O(1).
+# Правила расчета те же, что в report_generator.analyze_dialog_speed_and_status.
+#
+# Диалог, закрытый и перенесенный в closed, после нового сообщения начинается в active заново
+# (новый файл), поэтому для одного dialog_id может быть несколько поколений — как строк в отчете.
+# Состояние периодически сохраняется в INTRADAY_METRICS_PATH; при старте файлы active/ и closed/, изменившиеся
+# после сохранения, перечитываются (сообщения между сохранением и остановкой не теряются; перенос в closed/
+# сохраняет время изменения файла).
+
+SLOW_FIRST_RESPONSE = timedelta(minutes=5)
+
+_lock = threading.Lock()
+# ключ файла ("<dialog_id>_<телефон>") -> поколения диалога, последнее — текущий файл в active
+_dialogs: Dict[str, List[Dict[str, Any]]] = {}
+# 'YYYY-MM-DD' -> суммы вкладов диалогов
+_day_totals: Dict[str, Dict[str, int]] = {}
+_ready = False
+_dirty = False
+_checkpoint_thread: threading.Thread | None = None
+
+
+def _new_totals() -> Dict[str, int]:
+    return {'dialogs': 0, 'response_us': 0, 'response_count': 0, 'slow_first_response': 0,
+            'unanswered_working': 0, 'unanswered_non_working': 0}
+
+
+def _new_state(timestamp: datetime) -> Dict[str, Any]:
+    return {'first_time': timestamp, 'last_time': None, 'last_sender': None, 'first_client_time': None,
+            'first_response_done': False, 'slow': False, 'response_us': 0, 'response_count': 0}
+
+
+def _apply(state: Dict[str, Any], sign: int):
+    """Добавляет (sign=1) или снимает (sign=-1) вклад диалога в суммы дня его последнего сообщения."""
+    last_time = state['last_time']
+    totals = _day_totals.setdefault(last_time.date().isoformat(), _new_totals())
+    totals['dialogs'] += sign
+    totals['response_us'] += sign * state['response_us']
+    totals['response_count'] += sign * state['response_count']
+    totals['slow_first_response'] += sign * state['slow']
+    if state['last_sender'] == 'КЛИЕНТ':
+        if report_generator.WORK_START_TIME <= last_time.time() <= report_generator.WORK_END_TIME:
+            totals['unanswered_working'] += sign
+        elif report_generator.WORK_END_TIME < last_time.time() <= report_generator.REPORT_END_TIME:
+            totals['unanswered_non_working'] += sign
+
+
+def _advance(state: Dict[str, Any], sender: str, timestamp: datetime):
+    """Учитывает следующее сообщение диалога (без пересчета сумм дня)."""
+    if sender == 'МЕНЕДЖЕР' and state['last_sender'] == 'КЛИЕНТ':
+        response_time = timestamp - state['last_time']
+        state['response_us'] += response_time // timedelta(microseconds=1)
+        state['response_count'] += 1
+    if sender == 'КЛИЕНТ' and state['first_client_time'] is None:
+        state['first_client_time'] = timestamp
+    if (state['first_client_time'] is not None and sender == 'МЕНЕДЖЕР' and not state['first_response_done']
+            and timestamp > state['first_client_time']):
+        state['first_response_done'] = True
+        state['slow'] = timestamp - state['first_client_time'] > SLOW_FIRST_RESPONSE
+    state['last_sender'] = sender
+    state['last_time'] = timestamp
+
+
+def record_message(dialog_id: int, client_phone: str, sender: str, timestamp: datetime, new_file: bool = False):
+    """
+    Учитывает сообщение, только что записанное в файл диалога.
+    sender — 'КЛИЕНТ' или 'МЕНЕДЖЕР', new_file — сообщение создало файл в active (новое поколение диалога).
+    """
+    global _dirty
+    # Отчет учитывает только файлы с именем по DIALOG_FILE_REGEX (телефон только из цифр; диалоги Авито
+    # с телефоном 'Неизвестно' и номера вида '+7…' в него не попадают) — метрики 3–5 считаются по тем же
+    if not re.match(report_generator.DIALOG_FILE_REGEX, f"dialog_{dialog_id}_{client_phone}.txt"):
+        return
+    key = f"{dialog_id}_{client_phone}"
+    with _lock:
+        generations = _dialogs.setdefault(key, [])
+        if new_file or not generations:
+            generations.append(_new_state(timestamp))
+        state = generations[-1]
+        if state['last_time'] is not None:
+            _apply(state, -1)
+        _advance(state, sender, timestamp)
+        _apply(state, 1)
+        _dirty = True
+
+
+def get_day_metrics(day: date) -> Dict[str, Any] | None:
+    """
+    Метрики 3–5 за день (по диалогам с последним сообщением в этот день).
+    None — состояние еще не восстановлено (start_intraday_metrics не вызывался).
+    """
+    if not _ready:
+        return None
+    with _lock:
+        totals = dict(_day_totals.get(day.isoformat()) or _new_totals())
+    count = totals['response_count']
+    totals['avg_response_time'] = timedelta(microseconds=totals['response_us']) / count if count else None
+    return totals
+
+
+def is_ready() -> bool:
+    return _ready
+
+
+def format_day_metrics(day: date) -> str:
+    """Метрики 3–5 за день текстом (для запроса в течение дня)."""
+    metrics = get_day_metrics(day)
+    if metrics is None:
+        return "Промежуточные метрики недоступны: состояние не загружено."
+    average = metrics['avg_response_time']
+    return (
+        f"Диалогов за {day.strftime('%d.%m.%Y')}: {metrics['dialogs']}\n"
+        f"3. Скорость ответа (ср. цикл): {report_generator.format_timedelta(average) if average else 'Н/Д'}, "
+        f"медленный первый ответ (> 5 мин): {metrics['slow_first_response']} шт.\n"
+        f"4. Неотвеченных чатов (20:00-23:30): {metrics['unanswered_non_working']} шт.\n"
+        f"5. Неотвеченных чатов (раб. время 9:00-20:00): {metrics['unanswered_working']} шт."
+    )
+
+
+# --------------------------------------- #
+#     Восстановление и сохранение состояния
+# --------------------------------------- #
+
+def _state_from_file(file_path: str) -> Dict[str, Any] | None:
+    details = report_generator.get_dialog_file_details(file_path)
+    if not details:
+        return None
+    state = _new_state(details['first_message_time'])
+    for message in details['messages']:
+        _advance(state, message['sender'], message['time'])
+    return state
+
+
+def _file_key(file_path: str) -> str:
+    # dialog_<id>_<телефон>.txt -> "<id>_<телефон>"
+    return os.path.basename(file_path)[len('dialog_'):-len('.txt')]
+
+
+def _serialize(state: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: value.isoformat() if isinstance(value, datetime) else value for key, value in state.items()}
+
+
+def _deserialize(data: Dict[str, Any]) -> Dict[str, Any]:
+    state = dict(data)
+    for key in ('first_time', 'last_time', 'first_client_time'):
+        if state.get(key):
+            state[key] = datetime.fromisoformat(state[key])
+    return state
+
+
+def _recount_days():
+    _day_totals.clear()
+    for generations in _dialogs.values():
+        for state in generations:
+            if state['last_time'] is not None:
+                _apply(state, 1)
+
+
+def load_state():
+    """
+    Загружает сохраненное состояние и перечитывает файлы active/ и closed/, измененные после сохранения
+    (диалог мог получить сообщения и уйти в closed/ уже после него). Без сохраненного состояния
+    строит его по всем файлам.
+    """
+    global _ready
+    saved_at = None
+    dialogs: Dict[str, List[Dict[str, Any]]] = {}
+    if os.path.exists(config.INTRADAY_METRICS_PATH):
+        try:
+            with open(config.INTRADAY_METRICS_PATH, encoding='utf-8') as f:
+                data = json.load(f)
+            saved_at = data['saved_at']
+            dialogs = {key: [_deserialize(state) for state in generations]
+                       for key, generations in data['dialogs'].items()}
+        except Exception as e:
+            logger.error(f"❌ Не удалось прочитать состояние метрик {config.INTRADAY_METRICS_PATH}, "
+                         f"строим заново по файлам: {e}", exc_info=True)
+            saved_at, dialogs = None, {}
+
+    # Закрытые файлы — прежние поколения диалога, файл в active — текущее
+    file_paths = []
+    for directory in (report_generator.DIALOG_DIR_CLOSED, report_generator.DIALOG_DIR_ACTIVE):
+        file_paths += sorted(path for path in glob(os.path.join(directory, 'dialog_*.txt'))
+                             if saved_at is None or os.path.getmtime(path) > saved_at)
+
+    rebuilt = 0
+    for file_path in file_paths:
+        state = _state_from_file(file_path)
+        if state is None:
+            continue
+        generations = dialogs.setdefault(_file_key(file_path), [])
+        # Файл, начатый тем же сообщением, что и сохраненное поколение, — то же поколение, дописанное позже
+        same = [index for index, item in enumerate(generations) if item['first_time'] == state['first_time']]
+        if same:
+            generations[same[0]] = state
+        else:
+            generations.append(state)
+            generations.sort(key=lambda item: item['first_time'])
+        rebuilt += 1
+
+    with _lock:
+        _dialogs.clear()
+        _dialogs.update(dialogs)
+        _recount_days()
+        _ready = True
+    logger.info(f"Промежуточные метрики: {len(dialogs)} диалогов, перечитано файлов: {rebuilt}.")
+
+
+def prune():
+    """Удаляет поколения диалогов, последнее сообщение которых старше срока хранения файлов."""
+    limit = datetime.now() - timedelta(days=report_generator.MAX_DIALOG_AGE_DAYS + 1)
+    with _lock:
+        for key in list(_dialogs):
+            _dialogs[key] = [state for state in _dialogs[key] if state['last_time'] and state['last_time'] >= limit]
+            if not _dialogs[key]:
+                del _dialogs[key]
+        for day in [day for day in _day_totals if day < limit.date().isoformat()]:
+            del _day_totals[day]
+
+
+def checkpoint(force: bool = False):
+    """Атомарно сохраняет состояние на диск (если оно менялось с прошлого сохранения)."""
+    global _dirty
+    with _lock:
+        if not _dirty and not force:
+            return
+        data = {
+            'saved_at': time.time(),
+            'dialogs': {key: [_serialize(state) for state in generations] for key, generations in _dialogs.items()},
+        }
+        _dirty = False
+    directory = os.path.dirname(config.INTRADAY_METRICS_PATH)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{config.INTRADAY_METRICS_PATH}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, config.INTRADAY_METRICS_PATH)
+
+
+def _checkpoint_loop():
+    while True:
+        time.sleep(config.INTRADAY_METRICS_CHECKPOINT_SECONDS)
+        try:
+            prune()
+            checkpoint()
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения промежуточных метрик: {e}", exc_info=True)
+
+
+def start_intraday_metrics():
+    """Восстанавливает состояние и запускает периодическое сохранение. Повторный вызов ничего не делает."""
+    global _checkpoint_thread
+    if not config.INTRADAY_METRICS_ENABLED or _checkpoint_thread is not None:
+        return
+    load_state()
+    _checkpoint_thread = threading.Thread(target=_checkpoint_loop, name='intraday-metrics-checkpoint', daemon=True)
+    _checkpoint_thread.start()
+
+
+if __name__ == "__main__":
+    # Промежуточные метрики за сегодня по сохраненному состоянию и текущим файлам диалогов
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_state()
+    print(format_day_metrics(datetime.now(report_generator.MOSCOW_TZ).date()))
@@ -0,0 +1,691 @@
+"""
+Локальные HTTP-заглушки внешних сервисов для тестов и нагрузочных прогонов без сети.
+
+Каждая заглушка — настоящий HTTP-сервер на 127.0.0.1 в отдельном потоке с настраиваемой
+задержкой ответа и долей ошибок. Чтобы направить в нее систему, достаточно подставить
+ее URL в соответствующую переменную config (GOOGLE_FORMS_URL, SHEETS_API_URL и т.д.).
+"""
+import base64
+import email.parser
+import email.policy
+import hashlib
+import itertools
+import json
+import logging
+import random
+import re
+import struct
+import threading
+import time
+import urllib.parse
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Callable, Tuple
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Ответ обработчика: (HTTP-статус, тело) или (HTTP-статус, тело, заголовки). Тело dict/list сериализуется в JSON.
+StandInResponse = Tuple[int, Any] | Tuple[int, Any, Dict[str, str]]
+
+
+class StandInRequest:
+    """Разобранный входящий запрос, который получает обработчик маршрута."""
+
+    def __init__(self, method: str, path: str, query: Dict[str, List[str]], headers: Dict[str, str],
+                 body: bytes, match: re.Match):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+        self.match = match
+
+    def json(self) -> Any:
+        return json.loads(self.body.decode('utf-8')) if self.body else None
+
+    def form(self) -> Dict[str, str]:
+        return {key: values[-1] for key, values in urllib.parse.parse_qs(self.body.decode('utf-8')).items()}
+
+    def multipart(self) -> Dict[str, bytes]:
+        """Поля multipart/form-data (так SDK OpenAI загружает файлы)."""
+        content_type = self.headers.get('Content-Type') or self.headers.get('content-type', '')
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode('utf-8') + self.body
+        )
+        fields = {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if name:
+                fields[name] = part.get_payload(decode=True)
+        return fields
+
+
+# GUID из RFC 6455 для Sec-WebSocket-Accept
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class StandInWebSocket:
+    """Серверная сторона WebSocket-соединения (RFC 6455, только текстовые кадры, без расширений)."""
+
+    def __init__(self, sock, rfile, wfile):
+        self.sock = sock
+        self.rfile = rfile
+        self.wfile = wfile
+        self.closed = False
+        self._send_lock = threading.Lock()
+
+    def _send_frame(self, opcode: int, payload: bytes):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        with self._send_lock:
+            self.wfile.write(header + payload)
+
+    def send_text(self, text: str) -> bool:
+        """Отправляет текстовый кадр. False — соединение уже закрыто."""
+        if self.closed:
+            return False
+        try:
+            self._send_frame(0x1, text.encode('utf-8'))
+            return True
+        except OSError:
+            self.closed = True
+            return False
+
+    def _read_frame(self) -> tuple[int | None, bytes]:
+        header = self.rfile.read(2)
+        if len(header) < 2:
+            return None, b''
+        opcode, length = header[0] & 0x0F, header[1] & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', self.rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.rfile.read(8))[0]
+        mask = self.rfile.read(4) if header[1] & 0x80 else b''
+        payload = self.rfile.read(length)
+        if mask:
+            payload = bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+        return opcode, payload
+
+    def serve(self):
+        """Читает кадры клиента до закрытия: отвечает на ping, остальное игнорирует."""
+        try:
+            while not self.closed:
+                opcode, payload = self._read_frame()
+                if opcode is None or opcode == 0x8:
+                    break
+                if opcode == 0x9:
+                    self._send_frame(0xA, payload)
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._send_frame(0x8, b'')
+        except OSError:
+            pass
+        try:
+            self.sock.shutdown(2)
+        except OSError:
+            pass
+
+
+class StandInServer:
+    """
+    Базовый HTTP-сервер заглушки.
+    latency — задержка перед ответом в секундах, error_rate — доля ответов 503.
+    Все запросы складываются в self.requests для последующих проверок.
+    Пути, зарегистрированные через websocket_route, принимают WebSocket-соединения (self.ws_connections).
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, host: str = '127.0.0.1', port: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests: List[Dict[str, Any]] = []
+        self._routes: List[Tuple[str, re.Pattern, Callable[[StandInRequest], StandInResponse]]] = []
+        self._ws_routes: List[re.Pattern] = []
+        self.ws_connections: List[StandInWebSocket] = []
+        self._lock = threading.RLock()  # _run_batch вызывает _completion под блокировкой
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def route(self, method: str, pattern: str, handler: Callable[[StandInRequest], StandInResponse]):
+        """Регистрирует обработчик для метода и регулярного выражения пути (без query)."""
+        self._routes.append((method, re.compile(f"^{pattern}$"), handler))
+
+    def websocket_route(self, pattern: str):
+        """Регистрирует путь (регулярное выражение без query), на котором принимаются WebSocket-соединения."""
+        self._ws_routes.append(re.compile(f"^{pattern}$"))
+
+    def broadcast(self, text: str) -> int:
+        """Отправляет текст всем открытым WebSocket-соединениям. Возвращает число получателей."""
+        with self._lock:
+            connections = [connection for connection in self.ws_connections if not connection.closed]
+        return sum(connection.send_text(text) for connection in connections)
+
+    def wait_for_websocket(self, count: int = 1, timeout: float = 10.0) -> bool:
+        """Ждет, пока подключится count WebSocket-клиентов."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if sum(not connection.closed for connection in self.ws_connections) >= count:
+                    return True
+            time.sleep(0.05)
+        return False
+
+    def _serve_websocket(self, handler: BaseHTTPRequestHandler):
+        accept = base64.b64encode(
+            hashlib.sha1((handler.headers.get('Sec-WebSocket-Key', '') + WEBSOCKET_GUID).encode('ascii')).digest()
+        ).decode('ascii')
+        handler.send_response(101, 'Switching Protocols')
+        handler.send_header('Upgrade', 'websocket')
+        handler.send_header('Connection', 'Upgrade')
+        handler.send_header('Sec-WebSocket-Accept', accept)
+        handler.end_headers()
+        connection = StandInWebSocket(handler.connection, handler.rfile, handler.wfile)
+        with self._lock:
+            self.ws_connections.append(connection)
+        logger.info(f"Заглушка {type(self).__name__}: WebSocket-клиент подключен.")
+        connection.serve()
+        handler.close_connection = True
+
+    def start(self) -> 'StandInServer':
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        logger.info(f"Заглушка {type(self).__name__} запущена на {self.url}.")
+        return self
+
+    def stop(self):
+        for connection in list(self.ws_connections):
+            connection.close()
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _dispatch(self, method: str, raw_path: str, headers: Dict[str, str], body: bytes) -> StandInResponse:
+        parsed = urllib.parse.urlsplit(raw_path)
+        path = urllib.parse.unquote(parsed.path)
+        with self._lock:
+            self.requests.append({'method': method, 'path': path, 'time': time.time()})
+
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            return 503, {'success': False, 'errorMsg': 'Injected error'}
+
+        for route_method, pattern, handler in self._routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                request = StandInRequest(method, path, urllib.parse.parse_qs(parsed.query), headers, body, match)
+                return handler(request)
+        return 404, {'success': False, 'errorMsg': f"No stand-in route for {method} {path}"}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _handle(self):
+                if self.headers.get('Upgrade', '').lower() == 'websocket':
+                    path = urllib.parse.urlsplit(self.path).path
+                    if any(pattern.match(path) for pattern in server._ws_routes):
+                        server._serve_websocket(self)
+                        return
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                extra_headers = {}
+                try:
+                    response = server._dispatch(self.command, self.path, dict(self.headers), body)
+                    status, payload = response[:2]
+                    if len(response) > 2:
+                        extra_headers = response[2]
+                except Exception as e:
+                    logger.error(f"Ошибка в обработчике заглушки: {e}", exc_info=True)
+                    status, payload = 500, {'success': False, 'errorMsg': str(e)}
+
+                if isinstance(payload, (dict, list)):
+                    data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                    content_type = 'application/json; charset=utf-8'
+                else:
+                    data = str(payload or '').encode('utf-8')
+                    content_type = 'text/plain; charset=utf-8'
+
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in extra_headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = _handle
+
+            def log_message(self, format, *args):
+                logger.debug(f"{type(server).__name__}: {format % args}")
+
+        return Handler
+
+
+class GoogleStandIn(StandInServer):
+    """
+    Заглушка Google Forms (POST /forms/<name>/formResponse),
+    Google Sheets API (POST /v4/spreadsheets/<id>/values/<range>:append) и
+    CSV-выгрузки таблицы анализа (GET /spreadsheets/d/<id>/gviz/tq) со ссылками из analysis_links.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.form_responses: Dict[str, List[Dict[str, str]]] = defaultdict(list)
+        self.sheet_rows: Dict[str, List[List[Any]]] = defaultdict(list)
+        self.append_calls = 0
+        self.analysis_links: List[str] = []
+        self.route('POST', r'/forms/(?P<name>[^/]+)/formResponse', self._form_response)
+        self.route('POST', r'/v4/spreadsheets/(?P<sheet>[^/]+)/values/(?P<range>.+):append', self._values_append)
+        self.route('GET', r'/spreadsheets/d/(?P<sheet>[^/]+)/gviz/tq', self._analysis_sheet_csv)
+
+    def forms_url(self, name: str) -> str:
+        """URL формы, который подставляется в GOOGLE_FORMS_URL / GOOGLE_FORMS_URL_FREE."""
+        return f"{self.url}/forms/{name}/formResponse"
+
+    @property
+    def sheets_api_url(self) -> str:
+        """URL таблицы, который подставляется в SHEETS_API_URL."""
+        return f"{self.url}/v4/spreadsheets/standin"
+
+    @property
+    def analysis_sheet_csv_url(self) -> str:
+        """URL, который подставляется в data_exporter.ANALYSIS_SHEET_CSV_URL."""
+        return f"{self.url}/spreadsheets/d/standin/gviz/tq?tqx=out:csv"
+
+    def _analysis_sheet_csv(self, request: StandInRequest) -> StandInResponse:
+        lines = ['"Отметка времени","Номер заказа"']
+        lines += [f'"01.01.2026 00:00:00","{link}"' for link in self.analysis_links]
+        return 200, "\n".join(lines)
+
+    def _form_response(self, request: StandInRequest) -> StandInResponse:
+        with self._lock:
+            self.form_responses[request.match.group('name')].append(request.form())
+        return 200, 'OK'
+
+    def _values_append(self, request: StandInRequest) -> StandInResponse:
+        values = (request.json() or {}).get('values', [])
+        sheet_range = request.match.group('range')
+        with self._lock:
+            self.sheet_rows[sheet_range].extend(values)
+            self.append_calls += 1
+        return 200, {'updates': {'updatedRange': sheet_range, 'updatedRows': len(values)}}
+
+
+def _query_value(request: StandInRequest, name: str, default: str | None = None) -> str | None:
+    values = request.query.get(name)
+    return values[-1] if values else default
+
+
+def _digits(value: str | None) -> str:
+    return re.sub(r'\D', '', value or '')
+
+
+class RetailCRMStandIn(StandInServer):
+    """
+    Заглушка RetailCRM: REST API /api/v5 (orders, orders/history, customers, customers/history,
+    users/<id>, tasks/create) и API бота MessageGateway (GET /api/bot/v1/bots, WebSocket /api/bot/v1/ws).
+    Адреса для config: RETAILCRM_BASE_URL — url, RETAILCRM_API_URL — bot_api_url.
+    Данные наполняются через add_user / add_customer / add_order, события в WebSocket — push_event.
+    """
+
+    BOT_PREFIX = '/api/bot/v1'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.orders: Dict[int, Dict[str, Any]] = {}
+        self.customers: Dict[int, Dict[str, Any]] = {}
+        self.users: Dict[int, Dict[str, Any]] = {}
+        self.order_history: List[Dict[str, Any]] = []
+        self.customer_history: List[Dict[str, Any]] = []
+        self.tasks: List[Dict[str, Any]] = []
+        self._history_ids = itertools.count(1)
+        self._task_ids = itertools.count(1)
+        self.route('GET', r'/api/v5/orders', self._list_orders)
+        self.route('GET', r'/api/v5/orders/history', self._list_orders_history)
+        self.route('GET', r'/api/v5/customers', self._list_customers)
+        self.route('GET', r'/api/v5/customers/history', self._list_customers_history)
+        self.route('GET', r'/api/v5/users/(?P<user_id>\d+)', self._get_user)
+        self.route('POST', r'/api/v5/tasks/create', self._create_task)
+        self.route('GET', rf'{self.BOT_PREFIX}/bots', self._bots)
+        self.websocket_route(rf'{self.BOT_PREFIX}/ws')
+
+    @property
+    def bot_api_url(self) -> str:
+        return f"{self.url}{self.BOT_PREFIX}"
+
+    def add_user(self, user_id: int, first_name: str, last_name: str = '') -> Dict[str, Any]:
+        user = {'id': user_id, 'firstName': first_name, 'lastName': last_name, 'active': True}
+        with self._lock:
+            self.users[user_id] = user
+        return user
+
+    def add_customer(self, customer_id: int, phone: str, first_name: str = '') -> Dict[str, Any]:
+        customer = {'id': customer_id, 'firstName': first_name, 'phones': [{'number': phone}],
+                    'createdAt': time.strftime('%Y-%m-%d %H:%M:%S')}
+        with self._lock:
+            self.customers[customer_id] = customer
+            self.customer_history.append({'id': next(self._history_ids), 'createdAt': customer['createdAt'],
+                                          'created': True, 'field': 'id', 'customer': {'id': customer_id}})
+        return customer
+
+    def add_order(self, order_id: int, customer_id: int, **fields) -> Dict[str, Any]:
+        """Добавляет заказ (поля по умолчанию — новый заказ текущего дня) и запись в историю."""
+        now = time.strftime('%Y-%m-%d %H:%M:%S')
+        customer = self.customers.get(customer_id) or {}
+        phone = (customer.get('phones') or [{}])[0].get('number')
+        order = {
+            'id': order_id, 'externalId': str(order_id), 'slug': order_id, 'createdAt': now,
+            'statusUpdatedAt': now, 'status': 'new', 'orderMethod': 'shopping-cart', 'orderType': 'eshop-individual',
+            'totalSumm': 1000, 'managerId': None, 'phone': phone,
+            'customer': {'id': customer_id, 'phones': [{'number': phone}] if phone else []},
+            **fields,
+        }
+        with self._lock:
+            self.orders[order_id] = order
+            self.order_history.append({'id': next(self._history_ids), 'createdAt': now, 'created': True,
+                                       'field': 'status', 'order': {'id': order_id}})
+        return order
+
+    def push_event(self, event: Dict[str, Any]) -> int:
+        """Отправляет событие (message_new, dialog_closed) всем подключенным слушателям."""
+        return self.broadcast(json.dumps(event, ensure_ascii=False))
+
+    @staticmethod
+    def _page(items: List[Dict[str, Any]], request: StandInRequest, key: str) -> StandInResponse:
+        limit = int(_query_value(request, 'limit', '20'))
+        page = int(_query_value(request, 'page', '1'))
+        total_pages = max(1, -(-len(items) // limit))
+        return 200, {
+            'success': True,
+            key: items[(page - 1) * limit:page * limit],
+            'pagination': {'limit': limit, 'totalCount': len(items), 'currentPage': page,
+                           'totalPageCount': total_pages},
+        }
+
+    def _list_orders(self, request: StandInRequest) -> StandInResponse:
+        ids = {int(value) for value in request.query.get('filter[ids][]', [])}
+        phone = _digits(_query_value(request, 'filter[customer]'))
+        statuses = set(request.query.get('filter[extendedStatus][]', []))
+        created_from = _query_value(request, 'filter[createdAtFrom]')
+        created_to = _query_value(request, 'filter[createdAtTo]')
+        updated_from = _query_value(request, 'filter[statusUpdatedAtFrom]')
+        updated_to = _query_value(request, 'filter[statusUpdatedAtTo]')
+        with self._lock:
+            orders = list(self.orders.values())
+        result = []
+        for order in orders:
+            created, updated = order['createdAt'][:10], (order.get('statusUpdatedAt') or '')[:10]
+            if ((ids and order['id'] not in ids) or (phone and phone not in _digits(order.get('phone')))
+                    or (statuses and order['status'] not in statuses)
+                    or (created_from and created < created_from) or (created_to and created > created_to)
+                    or (updated_from and updated < updated_from) or (updated_to and updated > updated_to)):
+                continue
+            result.append(order)
+        return self._page(sorted(result, key=lambda order: order['id']), request, 'orders')
+
+    def _history_page(self, history: List[Dict[str, Any]], request: StandInRequest) -> StandInResponse:
+        since_id = int(_query_value(request, 'filter[sinceId]', '0'))
+        order_id = _query_value(request, 'filter[orderId]')
+        start = _query_value(request, 'filter[startDate]')
+        end = _query_value(request, 'filter[endDate]')
+        with self._lock:
+            entries = [entry for entry in history if entry['id'] > since_id
+                       and (not order_id or str(entry.get('order', {}).get('id')) == order_id)
+                       and (not start or entry['createdAt'] >= start) and (not end or entry['createdAt'] <= end)]
+        return self._page(entries, request, 'history')
+
+    def _list_orders_history(self, request: StandInRequest) -> StandInResponse:
+        return self._history_page(self.order_history, request)
+
+    def _list_customers_history(self, request: StandInRequest) -> StandInResponse:
+        return self._history_page(self.customer_history, request)
+
+    def _list_customers(self, request: StandInRequest) -> StandInResponse:
+        ids = {int(value) for value in request.query.get('filter[ids][]', [])}
+        with self._lock:
+            customers = [customer for customer_id, customer in sorted(self.customers.items())
+                         if not ids or customer_id in ids]
+        return self._page(customers, request, 'customers')
+
+    def _get_user(self, request: StandInRequest) -> StandInResponse:
+        user = self.users.get(int(request.match.group('user_id')))
+        if user is None:
+            return 404, {'success': False, 'errorMsg': 'Not found'}
+        return 200, {'success': True, 'user': user}
+
+    def _create_task(self, request: StandInRequest) -> StandInResponse:
+        task = json.loads(request.form().get('task') or '{}')
+        with self._lock:
+            task['id'] = next(self._task_ids)
+            self.tasks.append(task)
+        return 200, {'success': True, 'id': task['id']}
+
+    def _bots(self, request: StandInRequest) -> StandInResponse:
+        return 200, [{'id': 1, 'name': 'standin-bot', 'isActive': True}]
+
+
+class TelegramStandIn(StandInServer):
+    """Заглушка Telegram Bot API (POST /bot<token>/sendMessage). Адрес для config.TELEGRAM_API_URL — url."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.messages: List[Dict[str, str]] = []
+        self.route('POST', r'/bot(?P<token>[^/]+)/sendMessage', self._send_message)
+
+    def _send_message(self, request: StandInRequest) -> StandInResponse:
+        with self._lock:
+            self.messages.append(request.form())
+            message_id = len(self.messages)
+        return 200, {'ok': True, 'result': {'message_id': message_id}}
+
+
+def default_analysis_response(prompt: str) -> str:
+    """Правдоподобный ответ анализа в формате PROMPT_TEMPLATE: JSON с оценками и ---SUMMARY---."""
+    import config
+    scores = {criterion: random.choice((-1, 0, 1)) for criterion in config.ANALYSIS_CRITERIA}
+    scores['chat_category'] = random.choice(config.CATEGORIES)
+    return f"```json\n{json.dumps(scores, ensure_ascii=False)}\n```\n---SUMMARY---\nРезюме диалога (заглушка)."
+
+
+def default_structured_response(prompt: str) -> str:
+    """Ответ анализа в режиме Structured Outputs: один JSON-объект по схеме dialog_analysis."""
+    import config
+    data = {'chat_category': random.choice(config.CATEGORIES)}
+    data.update({criterion: random.choice((-1, 0, 1)) for criterion in config.ANALYSIS_CRITERIA})
+    data['summary'] = "Резюме диалога (заглушка)."
+    return json.dumps(data, ensure_ascii=False)
+
+
+class OpenAIStandIn(StandInServer):
+    """
+    Заглушка OpenAI API: /v1/chat/completions, загрузка файлов и Batch API
+    (/v1/files, /v1/batches). Пакет завершается через batch_delay секунд после создания.
+    max_concurrent — сколько запросов chat/completions обслуживается одновременно, остальные
+    получают 429 с retry-after-ms; в успешных ответах есть заголовки x-ratelimit-*.
+    completion_latency — время "генерации" ответа (в отличие от latency, учитывается в max_concurrent).
+    Запросы с response_format типа json_schema отвечает structured_responder.
+    Адрес для config.OPENAI_BASE_URL — свойство base_url.
+    """
+
+    def __init__(self, responder: Callable[[str], str] | None = None, batch_delay: float = 0.0,
+                 max_concurrent: int | None = None, completion_latency: float = 0.0,
+                 structured_responder: Callable[[str], str] | None = None, **kwargs):
+        super().__init__(**kwargs)
+        self.responder = responder or default_analysis_response
+        self.structured_responder = structured_responder or default_structured_response
+        self.batch_delay = batch_delay
+        self.max_concurrent = max_concurrent
+        self.completion_latency = completion_latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.rate_limited_calls = 0
+        self.files: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self.completion_calls = 0
+        self._seen_prefixes: set = set()
+        self._ids = itertools.count(1)
+        self.route('POST', r'/v1/chat/completions', self._chat_completions)
+        self.route('POST', r'/v1/files', self._upload_file)
+        self.route('GET', r'/v1/files/(?P<file_id>[^/]+)/content', self._file_content)
+        self.route('POST', r'/v1/batches', self._create_batch)
+        self.route('GET', r'/v1/batches/(?P<batch_id>[^/]+)', self._retrieve_batch)
+        self.route('POST', r'/v1/batches/(?P<batch_id>[^/]+)/cancel', self._cancel_batch)
+
+    @property
+    def base_url(self) -> str:
+        return f"{self.url}/v1"
+
+    def _next_id(self, prefix: str) -> str:
+        return f"{prefix}_standin_{next(self._ids)}"
+
+    def _completion(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        messages = body.get('messages', [])
+        prompt = "\n".join(str(message.get('content', '')) for message in messages)
+        structured = (body.get('response_format') or {}).get('type') == 'json_schema'
+        content = (self.structured_responder if structured else self.responder)(prompt)
+        prompt_tokens = len(prompt) // 4
+        # Как в OpenAI: повторяющееся начало запроса (системное сообщение) от 1024 токенов берется
+        # из кэша блоками по 128 токенов
+        prefix = str(messages[0].get('content', '')) if len(messages) > 1 else ''
+        cached_tokens = 0
+        with self._lock:
+            if prefix in self._seen_prefixes and len(prefix) // 4 >= 1024:
+                cached_tokens = (len(prefix) // 4) // 128 * 128
+            self._seen_prefixes.add(prefix)
+        return {
+            'id': self._next_id('chatcmpl'),
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', ''),
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': content}}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(content) // 4,
+                      'total_tokens': prompt_tokens + len(content) // 4,
+                      'prompt_tokens_details': {'cached_tokens': cached_tokens}},
+        }
+
+    def _chat_completions(self, request: StandInRequest) -> StandInResponse:
+        with self._lock:
+            if self.max_concurrent is not None and self.in_flight >= self.max_concurrent:
+                self.rate_limited_calls += 1
+                return 429, {'error': {'message': 'Rate limit reached', 'type': 'requests'}}, {'retry-after-ms': '200'}
+            self.completion_calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.completion_latency:
+                time.sleep(self.completion_latency)
+            completion = self._completion(request.json() or {})
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                remaining = (self.max_concurrent - self.in_flight) if self.max_concurrent is not None else 1000
+        return 200, completion, {'x-ratelimit-limit-requests': str(self.max_concurrent or 1000),
+                                 'x-ratelimit-remaining-requests': str(remaining)}
+
+    def _file_object(self, file_id: str, purpose: str) -> Dict[str, Any]:
+        return {'id': file_id, 'object': 'file', 'bytes': len(self.files[file_id]), 'created_at': int(time.time()),
+                'filename': f"{file_id}.jsonl", 'purpose': purpose, 'status': 'processed'}
+
+    def _upload_file(self, request: StandInRequest) -> StandInResponse:
+        fields = request.multipart()
+        file_id = self._next_id('file')
+        self.files[file_id] = fields.get('file', b'')
+        return 200, self._file_object(file_id, (fields.get('purpose') or b'').decode('utf-8'))
+
+    def _file_content(self, request: StandInRequest) -> StandInResponse:
+        content = self.files.get(request.match.group('file_id'))
+        if content is None:
+            return 404, {'error': {'message': 'File not found'}}
+        return 200, content.decode('utf-8')
+
+    def _create_batch(self, request: StandInRequest) -> StandInResponse:
+        body = request.json() or {}
+        batch_id = self._next_id('batch')
+        self.batches[batch_id] = {
+            'id': batch_id, 'object': 'batch', 'endpoint': body.get('endpoint'),
+            'input_file_id': body.get('input_file_id'), 'completion_window': body.get('completion_window'),
+            'status': 'in_progress', 'created_at': int(time.time()), 'output_file_id': None,
+            'error_file_id': None, 'request_counts': {'total': 0, 'completed': 0, 'failed': 0},
+        }
+        return 200, self.batches[batch_id]
+
+    def _run_batch(self, batch: Dict[str, Any]):
+        """Выполняет все запросы входного файла и сохраняет выходной JSONL."""
+        output = []
+        for line in self.files.get(batch['input_file_id'], b'').decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            output.append(json.dumps({
+                'id': self._next_id('batch_req'),
+                'custom_id': item['custom_id'],
+                'response': {'status_code': 200, 'body': self._completion(item.get('body') or {})},
+                'error': None,
+            }, ensure_ascii=False))
+        output_file_id = self._next_id('file')
+        self.files[output_file_id] = ("\n".join(output) + "\n").encode('utf-8')
+        batch.update(status='completed', output_file_id=output_file_id, completed_at=int(time.time()),
+                     request_counts={'total': len(output), 'completed': len(output), 'failed': 0})
+
+    def _retrieve_batch(self, request: StandInRequest) -> StandInResponse:
+        batch = self.batches.get(request.match.group('batch_id'))
+        if batch is None:
+            return 404, {'error': {'message': 'Batch not found'}}
+        with self._lock:
+            if batch['status'] == 'in_progress' and time.time() - batch['created_at'] >= self.batch_delay:
+                self._run_batch(batch)
+        return 200, batch
+
+    def _cancel_batch(self, request: StandInRequest) -> StandInResponse:
+        batch = self.batches.get(request.match.group('batch_id'))
+        if batch is None:
+            return 404, {'error': {'message': 'Batch not found'}}
+        batch['status'] = 'cancelled'
+        return 200, batch
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    google = GoogleStandIn().start()
+    openai_standin = OpenAIStandIn().start()
+    retailcrm = RetailCRMStandIn().start()
+    telegram = TelegramStandIn().start()
+    print(f"RETAILCRM_BASE_URL={retailcrm.url}")
+    print(f"RETAILCRM_API_URL={retailcrm.bot_api_url}")
+    print(f"TELEGRAM_API_URL={telegram.url}")
+    print(f"GOOGLE_FORMS_URL={google.forms_url('full')}")
+    print(f"GOOGLE_FORMS_URL_FREE={google.forms_url('free')}")
+    print(f"SHEETS_API_URL={google.sheets_api_url}")
+    print(f"OPENAI_BASE_URL={openai_standin.base_url}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for standin in (google, openai_standin, retailcrm, telegram):
+            standin.stop()
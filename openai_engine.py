@@ -0,0 +1,262 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, Any
+
+import config
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Асинхронный движок запросов к OpenAI.
+# Все запросы процесса идут через один AsyncOpenAI в отдельном потоке с event loop и общий
+# адаптивный ограничитель параллелизма: лимит снижается по заголовкам x-ratelimit-* и ответам 429
+# и плавно растет обратно после успешных запросов. Временные ошибки повторяются с
+# экспоненциальной задержкой и случайным разбросом, но не дольше дедлайна запроса.
+# Пакет openai импортируется при создании движка (первый запрос), а не при импорте модуля:
+# слушатель и отчет без анализа запускаются без него.
+
+
+class AnalysisUnavailableError(Exception):
+    """OpenAI не ответил за дедлайн / исчерпаны повторы. Анализ нужно повторить позже, а не терять."""
+
+
+@lru_cache(maxsize=1)
+def retryable_errors() -> tuple:
+    """Ошибки, после которых запрос имеет смысл повторить."""
+    import openai
+    return (
+        openai.RateLimitError,
+        openai.APIConnectionError,  # включает APITimeoutError
+        openai.InternalServerError,
+    )
+
+
+@lru_cache(maxsize=1)
+def openai_api_error() -> type:
+    """openai.APIError — базовый класс ошибок API (для except без импорта openai в модуле)."""
+    import openai
+    return openai.APIError
+
+
+def _parse_reset(value: str | None) -> float | None:
+    """Разбирает длительность из x-ratelimit-reset-* ('1s', '6m0s', '120ms') в секунды."""
+    if not value:
+        return None
+    total, number = 0.0, ''
+    units = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 0.001}
+    i = 0
+    while i < len(value):
+        char = value[i]
+        if char.isdigit() or char == '.':
+            number += char
+            i += 1
+            continue
+        unit = 'ms' if value[i:i + 2] == 'ms' else char
+        if unit not in units or not number:
+            return None
+        total += float(number) * units[unit]
+        number = ''
+        i += len(unit)
+    if number:
+        total += float(number)
+    return total
+
+
+def _header_int(headers, name: str) -> int | None:
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveLimiter:
+    """
+    Ограничитель параллелизма с изменяемым лимитом (работает внутри event loop движка).
+    Лимит уменьшается вдвое на 429 и прижимается к остатку x-ratelimit-remaining-requests,
+    после каждого успешного запроса растет на единицу до max_limit.
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = max_limit
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    # Пауза после 429: новые запросы ждут сброса окна лимита
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), timeout=pause)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.in_flight < self.limit:
+                    self.in_flight += 1
+                    return
+                await self._condition.wait()
+
+    async def release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    async def on_success(self, headers):
+        async with self._condition:
+            remaining = _header_int(headers, 'x-ratelimit-remaining-requests')
+            if remaining is not None and remaining < self.limit:
+                self.limit = max(self.min_limit, remaining)
+            elif self.limit < self.max_limit:
+                self.limit += 1
+            # Токены тоже кончаются: если их почти не осталось, ждем сброса окна
+            remaining_tokens = _header_int(headers, 'x-ratelimit-remaining-tokens')
+            if remaining_tokens is not None and remaining_tokens <= 0:
+                reset = _parse_reset(headers.get('x-ratelimit-reset-tokens'))
+                if reset:
+                    self.paused_until = max(self.paused_until, time.monotonic() + reset)
+            self._condition.notify_all()
+
+    async def on_rate_limited(self, retry_after: float | None):
+        async with self._condition:
+            self.limit = max(self.min_limit, self.limit // 2)
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            logger.warning(f"OpenAI: лимит запросов, параллелизм снижен до {self.limit}.")
+            self._condition.notify_all()
+
+
+def compute_backoff(attempt: int) -> float:
+    """Экспоненциальная задержка с полным случайным разбросом (full jitter)."""
+    cap = min(config.OPENAI_MAX_BACKOFF_SECONDS, config.OPENAI_BASE_BACKOFF_SECONDS * (2 ** attempt))
+    return random.uniform(0, cap)
+
+
+def _retry_after(error: Exception) -> float | None:
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return _parse_reset(headers.get('x-ratelimit-reset-requests'))
+
+
+# Счетчики движка с момента запуска процесса
+ENGINE_STATS: Dict[str, int] = {'requests': 0, 'succeeded': 0, 'retries': 0, 'rate_limited': 0, 'failed': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name: str):
+    with _stats_lock:
+        ENGINE_STATS[name] += 1
+
+
+def get_engine_stats() -> Dict[str, Any]:
+    with _stats_lock:
+        stats = dict(ENGINE_STATS)
+    if _engine is not None:
+        stats['concurrency_limit'] = _engine.limiter.limit
+        stats['in_flight'] = _engine.limiter.in_flight
+    return stats
+
+
+class OpenAIEngine:
+    """Event loop в фоновом потоке + AsyncOpenAI + AdaptiveLimiter."""
+
+    def __init__(self):
+        import openai
+
+        if not config.OPENAI_API_KEY:
+            raise AnalysisUnavailableError("Переменная OPENAI_API_KEY пуста. Пожалуйста, проверьте файл .env.")
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='openai-engine', daemon=True)
+        self._thread.start()
+        # Повторы делаем сами (с учетом дедлайна и общего лимита), встроенные повторы SDK отключены
+        self.client = openai.AsyncOpenAI(api_key=config.OPENAI_API_KEY, base_url=config.OPENAI_BASE_URL,
+                                         max_retries=0)
+        self.limiter = asyncio.run_coroutine_threadsafe(self._create_limiter(), self.loop).result()
+
+    async def _create_limiter(self) -> AdaptiveLimiter:
+        return AdaptiveLimiter(config.OPENAI_MAX_CONCURRENCY)
+
+    async def chat_completion(self, deadline_seconds: float | None = None, info: dict | None = None, **request):
+        """
+        chat.completions.create с повторами временных ошибок. Весь запрос (включая повторы и ожидание
+        слота) укладывается в deadline_seconds, иначе — AnalysisUnavailableError.
+        В info (если передан) записывается число повторов: info['retries'].
+        """
+        info = {} if info is None else info
+        deadline_seconds = deadline_seconds or config.OPENAI_REQUEST_DEADLINE_SECONDS
+        deadline = time.monotonic() + deadline_seconds
+        _count('requests')
+        attempt = 0
+        while True:
+            info['retries'] = attempt
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                _count('failed')
+                raise AnalysisUnavailableError(f"Дедлайн запроса {deadline_seconds:g} с исчерпан.")
+            try:
+                async with asyncio.timeout(remaining):
+                    await self.limiter.acquire()
+                    try:
+                        raw = await self.client.chat.completions.with_raw_response.create(**request)
+                        await self.limiter.on_success(raw.headers)
+                    finally:
+                        await self.limiter.release()
+                _count('succeeded')
+                return raw.parse()
+            except TimeoutError:
+                _count('failed')
+                raise AnalysisUnavailableError(f"Дедлайн запроса {deadline_seconds:g} с исчерпан.")
+            except retryable_errors() as e:
+                retry_after = _retry_after(e)
+                if isinstance(e, retryable_errors()[0]):  # openai.RateLimitError
+                    _count('rate_limited')
+                    await self.limiter.on_rate_limited(retry_after)
+                attempt += 1
+                if attempt >= config.OPENAI_MAX_ATTEMPTS:
+                    _count('failed')
+                    raise AnalysisUnavailableError(f"OpenAI недоступен после {attempt} попыток: {e}") from e
+                delay = max(retry_after or 0.0, compute_backoff(attempt))
+                if time.monotonic() + delay >= deadline:
+                    _count('failed')
+                    raise AnalysisUnavailableError(f"Повтор не укладывается в дедлайн запроса: {e}") from e
+                _count('retries')
+                logger.warning(f"OpenAI: {type(e).__name__}, повтор {attempt} через {delay:.1f} с.")
+                await asyncio.sleep(delay)
+
+    def run(self, coro):
+        """Выполняет корутину в event loop движка и ждет результат из обычного потока."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+_engine: OpenAIEngine | None = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> OpenAIEngine:
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = OpenAIEngine()
+        return _engine
+
+
+def chat_completion(info: dict | None = None, **request):
+    """Синхронная обертка для потоков конвейера: запрос через общий асинхронный движок."""
+    engine = get_engine()
+    return engine.run(engine.chat_completion(info=info, **request))
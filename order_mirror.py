@@ -0,0 +1,394 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, date, timedelta
+from typing import Dict, Any, List, Iterable
+
+import config
+from phone_utils import normalize_phone_digits
+from retailcrm_api import api_get, iter_pages, PAGE_LIMIT
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Локальное зеркало заказов RetailCRM.
+# Первичное наполнение — постраничная выгрузка /api/v5/orders за ORDER_MIRROR_DAYS дней,
+# дальше зеркало догоняет изменения через /api/v5/orders/history с filter[sinceId]:
+# изменившиеся заказы перечитываются целиком, а дни изменений складываются в order_modifications
+# (вместо запроса истории по каждому заказу в отчете).
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY,
+    external_id TEXT,
+    status TEXT,
+    order_type TEXT,
+    customer_id INTEGER,
+    phone TEXT,
+    total_summ REAL,
+    created_at TEXT,
+    status_updated_at TEXT,
+    last_modified_at TEXT,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status);
+CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at);
+CREATE INDEX IF NOT EXISTS idx_orders_status_updated ON orders(status_updated_at);
+CREATE INDEX IF NOT EXISTS idx_orders_phone ON orders(phone);
+CREATE INDEX IF NOT EXISTS idx_orders_customer ON orders(customer_id);
+CREATE INDEX IF NOT EXISTS idx_orders_last_modified ON orders(last_modified_at);
+CREATE TABLE IF NOT EXISTS order_modifications (
+    order_id INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    PRIMARY KEY (order_id, day)
+);
+CREATE INDEX IF NOT EXISTS idx_order_modifications_day ON order_modifications(day);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+_db_lock = threading.Lock()
+_sync_lock = threading.Lock()
+_initialized = False
+_sync_thread: threading.Thread | None = None
+
+
+# --------------------------------------- #
+#            Работа с базой
+# --------------------------------------- #
+
+def _connect() -> sqlite3.Connection:
+    db_dir = os.path.dirname(config.ORDER_MIRROR_DB_PATH)
+    if db_dir and not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+    conn = sqlite3.connect(config.ORDER_MIRROR_DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def init_mirror():
+    global _initialized
+    with _db_lock:
+        if _initialized:
+            return
+        conn = _connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            conn.commit()
+        finally:
+            conn.close()
+        _initialized = True
+
+
+def _get_state(key: str) -> str | None:
+    init_mirror()
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return row['value'] if row else None
+    finally:
+        conn.close()
+
+
+def _set_states(values: Dict[str, str]):
+    with _db_lock:
+        conn = _connect()
+        try:
+            conn.executemany("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", values.items())
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def is_ready() -> bool:
+    """Зеркало прошло первичное наполнение."""
+    return _get_state('bootstrapped_at') is not None
+
+
+def is_fresh() -> bool:
+    """Зеркало догоняло историю заказов не позже ORDER_MIRROR_MAX_STALENESS_SECONDS назад."""
+    synced_at = _get_state('synced_at')
+    if not synced_at or not is_ready():
+        return False
+    age = datetime.now() - datetime.strptime(synced_at, '%Y-%m-%d %H:%M:%S')
+    return age.total_seconds() <= config.ORDER_MIRROR_MAX_STALENESS_SECONDS
+
+
+# --------------------------------------- #
+#            Наполнение зеркала
+# --------------------------------------- #
+
+def _order_phone(order: Dict[str, Any]) -> str:
+    """Телефон заказа, а если он не заполнен — первый телефон клиента."""
+    phone = normalize_phone_digits(order.get('phone'))
+    if not phone:
+        customer_phones = (order.get('customer') or {}).get('phones') or [{}]
+        phone = normalize_phone_digits(customer_phones[0].get('number'))
+    return phone
+
+
+def upsert_orders(orders: Iterable[Dict[str, Any]], modified_at: Dict[int, str] | None = None) -> int:
+    """
+    Записывает заказы в зеркало целиком (заменяя прежнюю версию).
+    modified_at — время последнего изменения по истории; без него берется время создания.
+    """
+    init_mirror()
+    modified_at = modified_at or {}
+    count = 0
+    with _db_lock:
+        conn = _connect()
+        try:
+            for order in orders:
+                order_id = order.get('id')
+                if not order_id:
+                    continue
+                last_modified = modified_at.get(order_id)
+                if last_modified is None:
+                    row = conn.execute("SELECT last_modified_at FROM orders WHERE id = ?", (order_id,)).fetchone()
+                    last_modified = row['last_modified_at'] if row else order.get('createdAt')
+                conn.execute(
+                    "INSERT OR REPLACE INTO orders (id, external_id, status, order_type, customer_id, phone, "
+                    "total_summ, created_at, status_updated_at, last_modified_at, payload) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        order_id, order.get('externalId'), order.get('status'), order.get('orderType'),
+                        (order.get('customer') or {}).get('id'), _order_phone(order), order.get('totalSumm'),
+                        order.get('createdAt'), order.get('statusUpdatedAt'), last_modified,
+                        json.dumps(order, ensure_ascii=False)
+                    )
+                )
+                count += 1
+            conn.commit()
+        finally:
+            conn.close()
+    return count
+
+
+def _record_modifications(entries: Dict[int, set]):
+    with _db_lock:
+        conn = _connect()
+        try:
+            conn.executemany(
+                "INSERT OR IGNORE INTO order_modifications (order_id, day) VALUES (?, ?)",
+                [(order_id, day) for order_id, days in entries.items() for day in days]
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def _remove_orders(order_ids: Iterable[int]):
+    with _db_lock:
+        conn = _connect()
+        try:
+            conn.executemany("DELETE FROM orders WHERE id = ?", [(order_id,) for order_id in order_ids])
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def prune():
+    """Удаляет заказы и отметки изменений старше ORDER_MIRROR_DAYS дней."""
+    cutoff = (datetime.now() - timedelta(days=config.ORDER_MIRROR_DAYS)).strftime('%Y-%m-%d')
+    with _db_lock:
+        conn = _connect()
+        try:
+            orders = conn.execute(
+                "DELETE FROM orders WHERE COALESCE(last_modified_at, created_at) < ?", (cutoff,)
+            ).rowcount
+            conn.execute("DELETE FROM order_modifications WHERE day < ?", (cutoff,))
+            conn.commit()
+        finally:
+            conn.close()
+    if orders:
+        logger.info(f"Зеркало заказов: удалено {orders} устаревших заказов.")
+
+
+def bootstrap():
+    """
+    Первичное наполнение: заказы за последние ORDER_MIRROR_DAYS дней.
+    История затем читается с начала текущего дня, чтобы отметки изменений за сегодня были полными.
+    """
+    started_at = datetime.now()
+    logger.info("Зеркало заказов: начало первичной выгрузки заказов из RetailCRM.")
+
+    count = 0
+    orders_from = (started_at - timedelta(days=config.ORDER_MIRROR_DAYS)).strftime('%Y-%m-%d')
+    for orders in iter_pages('orders', 'orders', {'filter[createdAtFrom]': orders_from}):
+        count += upsert_orders(orders)
+
+    _set_states({
+        'history_start_date': f"{started_at.strftime('%Y-%m-%d')} 00:00:00",
+        'bootstrapped_at': started_at.isoformat(),
+    })
+    logger.info(f"Зеркало заказов: первичная выгрузка завершена ({count} заказов).")
+
+
+def sync_history() -> int:
+    """
+    Догоняет /api/v5/orders/history с filter[sinceId]. Возвращает количество обработанных записей истории.
+    """
+    since_id = _get_state('history_since_id')
+    processed = 0
+
+    while True:
+        params = {'limit': PAGE_LIMIT}
+        if since_id:
+            params['filter[sinceId]'] = since_id
+        else:
+            params['filter[startDate]'] = _get_state('history_start_date')
+        history = api_get('orders/history', params).get('history', [])
+        if not history:
+            break
+
+        changed_ids, deleted_ids = set(), set()
+        modified_at: Dict[int, str] = {}
+        modification_days: Dict[int, set] = {}
+        for entry in history:
+            order_id = (entry.get('order') or {}).get('id')
+            if not order_id:
+                continue
+            changed_at = entry.get('createdAt')
+            if changed_at:
+                modified_at[order_id] = max(modified_at.get(order_id, changed_at), changed_at)
+                modification_days.setdefault(order_id, set()).add(changed_at[:10])
+            if entry.get('deleted'):
+                deleted_ids.add(order_id)
+                changed_ids.discard(order_id)
+            else:
+                changed_ids.add(order_id)
+                deleted_ids.discard(order_id)
+
+        _record_modifications(modification_days)
+        if deleted_ids:
+            _remove_orders(deleted_ids)
+        changed = sorted(changed_ids)
+        for i in range(0, len(changed), PAGE_LIMIT):
+            chunk = changed[i:i + PAGE_LIMIT]
+            orders = api_get('orders', {'filter[ids][]': chunk, 'limit': PAGE_LIMIT}).get('orders', [])
+            upsert_orders(orders, modified_at)
+
+        since_id = str(history[-1]['id'])
+        _set_states({'history_since_id': since_id})
+        processed += len(history)
+        if len(history) < PAGE_LIMIT:
+            break
+
+    if processed:
+        logger.info(f"Зеркало заказов: обработано {processed} записей истории (sinceId={since_id}).")
+    return processed
+
+
+def sync():
+    """Один цикл синхронизации: первичная выгрузка при необходимости, затем история заказов."""
+    init_mirror()
+    with _sync_lock:
+        if not is_ready():
+            bootstrap()
+            prune()
+        started_at = datetime.now()
+        sync_history()
+        _set_states({'synced_at': started_at.strftime('%Y-%m-%d %H:%M:%S')})
+
+
+def _sync_loop():
+    logger.info("Поток синхронизации зеркала заказов запущен.")
+    last_prune_day = None
+    while True:
+        try:
+            sync()
+            if last_prune_day != date.today():
+                prune()
+                last_prune_day = date.today()
+        except Exception as e:
+            logger.error(f"❌ Ошибка синхронизации зеркала заказов: {e}", exc_info=True)
+        time.sleep(config.ORDER_MIRROR_SYNC_INTERVAL_SECONDS)
+
+
+def start_order_mirror_sync():
+    """Запускает фоновую синхронизацию зеркала. Повторный вызов ничего не делает."""
+    global _sync_thread
+    if _sync_thread is not None:
+        return
+    _sync_thread = threading.Thread(target=_sync_loop, name='order-mirror-sync', daemon=True)
+    _sync_thread.start()
+
+
+# --------------------------------------- #
+#            Запросы к зеркалу
+# --------------------------------------- #
+
+def _query_orders(where: str, params: tuple, limit: int | None = None) -> List[Dict[str, Any]]:
+    init_mirror()
+    sql = f"SELECT payload FROM orders WHERE {where} ORDER BY created_at DESC, id DESC"
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+    conn = _connect()
+    try:
+        return [json.loads(row['payload']) for row in conn.execute(sql, params).fetchall()]
+    finally:
+        conn.close()
+
+
+def find_client_orders(phone: str, customer_ids: Iterable[int] = (), limit: int | None = None) -> List[Dict[str, Any]]:
+    """
+    Заказы клиента по телефону (и ID клиентов из индекса клиентов), от самого нового к самому старому.
+    """
+    normalized = normalize_phone_digits(phone)
+    customer_ids = tuple(customer_ids)
+    conditions, params = [], []
+    if normalized:
+        conditions.append("phone = ?")
+        params.append(normalized)
+    if customer_ids:
+        conditions.append(f"customer_id IN ({', '.join('?' for _ in customer_ids)})")
+        params.extend(customer_ids)
+    if not conditions:
+        return []
+    return _query_orders(" OR ".join(conditions), tuple(params), limit)
+
+
+def find_orders(created_on: date | None = None, status_updated_on: date | None = None,
+                statuses: Iterable[str] | None = None) -> List[Dict[str, Any]]:
+    """Заказы по дню создания, дню смены статуса и набору статусов (аналог фильтров /api/v5/orders)."""
+    conditions, params = [], []
+    if created_on:
+        conditions.append("created_at >= ? AND created_at < ?")
+        params += [created_on.isoformat(), (created_on + timedelta(days=1)).isoformat()]
+    if status_updated_on:
+        conditions.append("status_updated_at >= ? AND status_updated_at < ?")
+        params += [status_updated_on.isoformat(), (status_updated_on + timedelta(days=1)).isoformat()]
+    if statuses is not None:
+        statuses = tuple(statuses)
+        conditions.append(f"status IN ({', '.join('?' for _ in statuses)})" if statuses else "0")
+        params.extend(statuses)
+    return _query_orders(" AND ".join(conditions) or "1", tuple(params))
+
+
+def was_modified_on(order_id: int, day: date) -> bool:
+    """Было ли изменение по заказу в этот день (по записям истории, прошедшим через зеркало)."""
+    init_mirror()
+    conn = _connect()
+    try:
+        row = conn.execute(
+            "SELECT 1 FROM order_modifications WHERE order_id = ? AND day = ?", (order_id, day.isoformat())
+        ).fetchone()
+        return row is not None
+    finally:
+        conn.close()
+
+
+def get_order(order_id: int) -> Dict[str, Any] | None:
+    orders = _query_orders("id = ?", (order_id,))
+    return orders[0] if orders else None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    sync()
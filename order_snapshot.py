@@ -0,0 +1,165 @@
+import logging
+from collections import defaultdict
+from datetime import date, timedelta
+from typing import Dict, Any, List, Iterable
+
+import config
+import customer_index
+from phone_utils import normalize_phone_digits
+from retailcrm_api import iter_pages, PAGE_LIMIT
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Снимок заказов RetailCRM в памяти для ежедневного отчета (используется, когда зеркало заказов несвежее).
+# Вместо запроса /api/v5/orders?filter[customer]=<телефон> на каждого клиента отчет делает несколько
+# постраничных запросов по диапазонам дат, а метрики 2 и 6 считаются соединением в памяти
+# по нормализованному телефону и ID клиента. Интерфейс поиска повторяет order_mirror.
+# Заказы, изменявшиеся в день отчета, берутся одним постраничным запросом /api/v5/orders/history
+# за весь день (вместо запроса истории по каждому заказу).
+
+
+def _order_phones(order: Dict[str, Any]) -> set:
+    """Нормализованные телефоны заказа: телефон в заказе и все телефоны клиента."""
+    customer = order.get('customer') or {}
+    numbers = [order.get('phone')] + [phone.get('number') for phone in customer.get('phones') or []]
+    phones = {normalize_phone_digits(number) for number in numbers if number}
+    phones.discard("")
+    return phones
+
+
+def _sort_key(order: Dict[str, Any]) -> tuple:
+    return order.get('createdAt') or '', order.get('id') or 0
+
+
+class OrderSnapshot:
+    """Заказы, проиндексированные по телефону и ID клиента."""
+
+    def __init__(self, orders: Iterable[Dict[str, Any]] = ()):
+        self.orders: Dict[int, Dict[str, Any]] = {}
+        self._by_phone: Dict[str, set] = defaultdict(set)
+        self._by_customer: Dict[int, set] = defaultdict(set)
+        # Телефоны, все заказы которых (или их отсутствие) известны снимку, хотя заказов в диапазоне нет
+        self._resolved_phones: set = set()
+        # ID заказов, по которым есть записи истории за modified_on
+        self.modified_on: date | None = None
+        self.modified_order_ids: set = set()
+        self.api_requests = 0
+        self.add_orders(orders)
+
+    def add_orders(self, orders: Iterable[Dict[str, Any]]):
+        for order in orders:
+            order_id = order.get('id')
+            if order_id is None:
+                continue
+            self.orders[order_id] = order
+            for phone in _order_phones(order):
+                self._by_phone[phone].add(order_id)
+            customer_id = (order.get('customer') or {}).get('id')
+            if customer_id:
+                self._by_customer[customer_id].add(order_id)
+
+    def mark_resolved(self, phone: str):
+        self._resolved_phones.add(normalize_phone_digits(phone))
+
+    def covers(self, phone: str) -> bool:
+        """Знает ли снимок самый свежий заказ клиента (или что заказов у него нет)."""
+        normalized = normalize_phone_digits(phone)
+        return bool(normalized) and (normalized in self._by_phone or normalized in self._resolved_phones)
+
+    def was_modified_on(self, order_id: int, day: date) -> bool | None:
+        """Было ли изменение по заказу в этот день. None — история за этот день в снимок не загружалась."""
+        if day != self.modified_on:
+            return None
+        return order_id in self.modified_order_ids
+
+    def find_client_orders(self, phone: str, customer_ids: Iterable[int] = (),
+                           limit: int | None = None) -> List[Dict[str, Any]]:
+        """Заказы клиента по телефону и ID клиентов, от самого нового к самому старому."""
+        order_ids = set(self._by_phone.get(normalize_phone_digits(phone), ()))
+        for customer_id in customer_ids:
+            order_ids |= self._by_customer.get(customer_id, set())
+        orders = sorted((self.orders[order_id] for order_id in order_ids), key=_sort_key, reverse=True)
+        return orders[:limit] if limit else orders
+
+    def find_orders(self, created_on: date | None = None, status_updated_on: date | None = None,
+                    statuses: Iterable[str] | None = None) -> List[Dict[str, Any]]:
+        """Заказы по дню создания, дню смены статуса и набору статусов (как order_mirror.find_orders)."""
+        statuses = set(statuses) if statuses is not None else None
+        created_prefix = created_on.isoformat() if created_on else None
+        status_prefix = status_updated_on.isoformat() if status_updated_on else None
+        return [
+            order for order in sorted(self.orders.values(), key=_sort_key)
+            if (created_prefix is None or (order.get('createdAt') or '').startswith(created_prefix))
+            and (status_prefix is None or (order.get('statusUpdatedAt') or '').startswith(status_prefix))
+            and (statuses is None or order.get('status') in statuses)
+        ]
+
+
+def _fetch_pages(snapshot: OrderSnapshot, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    orders = []
+    for page in iter_pages('orders', 'orders', params):
+        snapshot.api_requests += 1
+        orders += page
+    return orders
+
+
+def load_modified_order_ids(snapshot: OrderSnapshot, day: date):
+    """Один постраничный проход по истории заказов за день: множество ID измененных заказов."""
+    params = {
+        'filter[startDate]': f"{day.isoformat()} 00:00:00",
+        'filter[endDate]': f"{day.isoformat()} 23:59:59",
+    }
+    modified = set()
+    for entries in iter_pages('orders/history', 'history', params):
+        snapshot.api_requests += 1
+        modified.update(entry['order']['id'] for entry in entries if (entry.get('order') or {}).get('id'))
+    snapshot.modified_on = day
+    snapshot.modified_order_ids = modified
+
+
+def load_snapshot(report_date: date, lookback_days: int | None = None) -> OrderSnapshot:
+    """
+    Выгружает заказы, созданные за lookback_days дней до report_date, более старые заказы,
+    статус которых менялся в report_date, и ID заказов с историей изменений за report_date.
+    Ошибки HTTP пробрасываются вызывающему коду.
+    """
+    lookback_days = config.REPORT_ORDERS_LOOKBACK_DAYS if lookback_days is None else lookback_days
+    created_from = report_date - timedelta(days=lookback_days)
+    snapshot = OrderSnapshot()
+    snapshot.add_orders(_fetch_pages(snapshot, {'filter[createdAtFrom]': created_from.isoformat()}))
+    snapshot.add_orders(_fetch_pages(snapshot, {
+        'filter[statusUpdatedAtFrom]': report_date.isoformat(),
+        'filter[createdAtTo]': (created_from - timedelta(days=1)).isoformat(),
+    }))
+    load_modified_order_ids(snapshot, report_date)
+    logger.info(f"Снимок заказов с {created_from}: {len(snapshot.orders)} заказов, "
+                f"{len(snapshot.modified_order_ids)} изменены {report_date}, {snapshot.api_requests} запросов.")
+    return snapshot
+
+
+def complete_from_index(snapshot: OrderSnapshot, phones: Iterable[str]):
+    """
+    Для клиентов, у которых нет заказов в диапазоне снимка, находит самый свежий заказ по локальному
+    индексу клиентов и догружает такие заказы пачками по PAGE_LIMIT. Индекс хранит только последние
+    CUSTOMER_INDEX_ORDERS_DAYS, поэтому клиенты без заказов в нем (как и все клиенты при несвежем индексе,
+    где может не быть только что созданных заказов) проверяются отдельными запросами.
+    """
+    if not customer_index.is_fresh():
+        return
+    latest_ids = {}
+    for phone in phones:
+        if snapshot.covers(phone) or not normalize_phone_digits(phone):
+            continue
+        order_ids = customer_index.find_order_ids(phone)
+        if order_ids:
+            latest_ids[phone] = order_ids[0]
+    if not latest_ids:
+        return
+
+    order_ids = sorted(set(latest_ids.values()))
+    for i in range(0, len(order_ids), PAGE_LIMIT):
+        snapshot.api_requests += 1
+        snapshot.add_orders(customer_index.fetch_orders_by_ids(order_ids[i:i + PAGE_LIMIT]))
+    for phone in latest_ids:
+        snapshot.mark_resolved(phone)
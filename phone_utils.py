@@ -0,0 +1,20 @@
+import re
+
+_NON_DIGITS = re.compile(r'\D')
+
+
+def normalize_phone_digits(phone_str: str | None) -> str:
+    """
+    Приводит номер телефона к формату '7XXXXXXXXXX' (только цифры) без логирования.
+    Возвращает пустую строку, если номер не удалось нормализовать.
+    Используется в массовых операциях (индексы, отчеты), где логировать каждый номер слишком дорого.
+    """
+    if not phone_str:
+        return ""
+    digits_only = _NON_DIGITS.sub('', phone_str)
+    if len(digits_only) == 11 and digits_only[0] in '78':
+        return '7' + digits_only[1:]
+    # Дополнительная обработка для российских мобильных (без +7)
+    if len(digits_only) == 10 and digits_only.startswith('9'):
+        return '7' + digits_only
+    return ""
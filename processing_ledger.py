@@ -0,0 +1,171 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, Any
+
+import config
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# --- Статусы записей журнала ---
+STATUS_IN_PROGRESS = 'in_progress'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+# Идентификатор текущего процесса (для диагностики). Запись 'in_progress' перехватывается только после
+# LEDGER_STALE_SECONDS без обновлений: жив ли владелец, по PID надежно не определить (другой контейнер,
+# переиспользованный PID), а ручной запуск отчета при работающем слушателе не должен обрабатывать его диалоги
+OWNER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS processing_ledger (
+    dialog_id INTEGER NOT NULL,
+    content_hash TEXT NOT NULL,
+    status TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    outcome TEXT,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (dialog_id, content_hash)
+);
+CREATE INDEX IF NOT EXISTS idx_ledger_updated ON processing_ledger(updated_at);
+"""
+
+_db_lock = threading.Lock()
+_initialized = False
+
+
+def _connect() -> sqlite3.Connection:
+    db_dir = os.path.dirname(config.LEDGER_DB_PATH)
+    if db_dir and not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+    # isolation_level=None: транзакциями управляем сами (BEGIN IMMEDIATE)
+    conn = sqlite3.connect(config.LEDGER_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def init_ledger():
+    """Создает таблицу журнала и удаляет записи старше LEDGER_RETENTION_DAYS."""
+    global _initialized
+    with _db_lock:
+        if _initialized:
+            return
+        conn = _connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            cutoff = time.time() - config.LEDGER_RETENTION_DAYS * 86400
+            pruned = conn.execute("DELETE FROM processing_ledger WHERE updated_at < ?", (cutoff,)).rowcount
+        finally:
+            conn.close()
+        _initialized = True
+
+    if pruned:
+        logger.info(f"Журнал обработки: удалено {pruned} устаревших записей.")
+
+
+def content_hash(dialog_text: str) -> str:
+    """Хэш содержимого диалога: каждая версия текста обрабатывается ровно один раз."""
+    return hashlib.sha256(dialog_text.encode('utf-8')).hexdigest()
+
+
+def claim(dialog_id: int, dialog_hash: str) -> tuple[bool, str | None]:
+    """
+    Пытается захватить версию диалога (dialog_id, dialog_hash) для обработки.
+    Возвращает (захвачено ли, статус существующей записи или None).
+
+    Захват возможен, если записи еще нет, если прошлая попытка завершилась ошибкой
+    (и попытки не исчерпаны) или если запись 'in_progress' брошена — не обновлялась дольше
+    LEDGER_STALE_SECONDS.
+    """
+    init_ledger()
+    now = time.time()
+    with _db_lock:
+        conn = _connect()
+        try:
+            # BEGIN IMMEDIATE сразу берет блокировку на запись: проверка и захват атомарны между процессами
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT status, owner, attempts, updated_at FROM processing_ledger "
+                "WHERE dialog_id = ? AND content_hash = ?",
+                (dialog_id, dialog_hash)
+            ).fetchone()
+
+            if row is None:
+                conn.execute(
+                    "INSERT INTO processing_ledger (dialog_id, content_hash, status, owner, attempts, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, 1, ?, ?)",
+                    (dialog_id, dialog_hash, STATUS_IN_PROGRESS, OWNER_ID, now, now)
+                )
+                conn.execute("COMMIT")
+                return True, None
+
+            status = row['status']
+            can_take_over = False
+            if status == STATUS_FAILED:
+                can_take_over = row['attempts'] < config.LEDGER_MAX_ATTEMPTS
+            elif status == STATUS_IN_PROGRESS:
+                can_take_over = now - row['updated_at'] > config.LEDGER_STALE_SECONDS
+
+            if not can_take_over:
+                conn.execute("COMMIT")
+                return False, status
+
+            conn.execute(
+                "UPDATE processing_ledger SET status = ?, owner = ?, attempts = attempts + 1, updated_at = ? "
+                "WHERE dialog_id = ? AND content_hash = ?",
+                (STATUS_IN_PROGRESS, OWNER_ID, now, dialog_id, dialog_hash)
+            )
+            conn.execute("COMMIT")
+            logger.info(f"Журнал обработки: повторный захват диалога {dialog_id} (прошлый статус: {status}).")
+            return True, status
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+
+def _finish(dialog_id: int, dialog_hash: str, status: str, outcome: str | None = None, error: str | None = None):
+    init_ledger()
+    with _db_lock:
+        conn = _connect()
+        try:
+            conn.execute(
+                "UPDATE processing_ledger SET status = ?, outcome = ?, last_error = ?, updated_at = ? "
+                "WHERE dialog_id = ? AND content_hash = ? AND owner = ?",
+                (status, outcome, error, time.time(), dialog_id, dialog_hash, OWNER_ID)
+            )
+        finally:
+            conn.close()
+
+
+def mark_done(dialog_id: int, dialog_hash: str, outcome: str):
+    """Версия диалога проанализирована и поставлена в экспорт (outcome: 'full' или 'free')."""
+    _finish(dialog_id, dialog_hash, STATUS_DONE, outcome=outcome)
+
+
+def mark_failed(dialog_id: int, dialog_hash: str, error: str):
+    """Обработка версии диалога прервалась ошибкой; следующая попытка сможет ее перехватить."""
+    _finish(dialog_id, dialog_hash, STATUS_FAILED, error=error)
+
+
+def get_entry(dialog_id: int, dialog_hash: str) -> Dict[str, Any] | None:
+    init_ledger()
+    conn = _connect()
+    try:
+        row = conn.execute(
+            "SELECT * FROM processing_ledger WHERE dialog_id = ? AND content_hash = ?",
+            (dialog_id, dialog_hash)
+        ).fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
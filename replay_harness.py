@@ -0,0 +1,417 @@
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from datetime import datetime
+from typing import Dict, Any, List
+
+import config
+from local_standins import RetailCRMStandIn, OpenAIStandIn, GoogleStandIn, TelegramStandIn
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Офлайн-прогон слушателя от начала до конца без внешних сервисов.
+# RetailCRM (REST API и WebSocket бота), OpenAI, Google и Telegram заменяются заглушками из local_standins
+# с настраиваемой задержкой и долей ошибок, start_listener запускается против них как в проде, а поток
+# событий message_new / dialog_closed (синтетический или записанный в JSONL) отправляется в WebSocket
+# с заданной частотой. Итог: события в секунду, задержка от отправки события до его обработки
+# (сообщение записано в файл / закрытый диалог обработан конвейером) и число потоков процесса.
+#
+#   python replay_harness.py --dialogs 200 --messages 10 --rate 100
+#   python replay_harness.py --stream recorded.jsonl --rate 50 --openai-latency 2
+
+# Обработка события считается завершенной, когда отработала соответствующая функция слушателя
+KIND_MESSAGE = 'message_new'
+KIND_CLOSED = 'dialog_closed'
+
+CLIENT_PHRASES = [
+    "Здравствуйте, есть в наличии {item}?", "Сколько стоит {item}?", "А доставка до Казани сколько идет?",
+    "Можно оплатить картой при получении?", "Пришлите, пожалуйста, фото", "Хорошо, оформляйте",
+    "А есть аналог подешевле?", "Спасибо, подумаю", "Где мой заказ? Трек не обновляется",
+]
+MANAGER_PHRASES = [
+    "Добрый день! Да, {item} в наличии.", "Стоимость {item} — 12 900 руб.", "Доставка 2-3 дня.",
+    "Да, можно. Ссылка на оплату: https://yookassa.ru/pay/{n}", "Оформил заказ, номер {n}.",
+    "Подскажите, для каких целей выбираете?", "Отправил варианты на почту.",
+    "Вот каталог: https://example-shop.ru/catalog/{n}",
+]
+ITEMS = ["аквариум на 120 л", "фильтр внешний", "грунт 5 кг", "компрессор", "лампа LED 30 см"]
+
+
+# --- Поток событий ---
+
+def synthetic_stream(dialogs: int, messages_per_dialog: int, concurrent_dialogs: int = 50,
+                     avito_share: float = 0.05, seed: int = 1) -> List[Dict[str, Any]]:
+    """
+    Синтетический поток: dialogs диалогов по messages_per_dialog сообщений (клиент/менеджер, текст и
+    изображения) с событием dialog_closed в конце. Одновременно идут до concurrent_dialogs диалогов.
+    """
+    rng = random.Random(seed)
+    events = []
+    active = deque()
+    next_dialog = 0
+
+    def new_dialog():
+        nonlocal next_dialog
+        index = next_dialog
+        next_dialog += 1
+        avito = rng.random() < avito_share
+        return {
+            'id': 100000 + index,
+            'phone': 'Неизвестно' if avito else f"7900{index:07d}",
+            'channel': 'Avito Авито' if avito else 'WhatsApp',
+            'manager_id': str(rng.randint(1, 5)),
+            'sent': 0,
+        }
+
+    while next_dialog < dialogs or active:
+        while len(active) < concurrent_dialogs and next_dialog < dialogs:
+            active.append(new_dialog())
+        dialog = active[rng.randrange(len(active))]
+        if dialog['sent'] < messages_per_dialog:
+            events.append(_message_event(dialog, rng))
+            dialog['sent'] += 1
+        else:
+            events.append({
+                'type': KIND_CLOSED,
+                'data': {'dialog': {
+                    'id': dialog['id'],
+                    'chat': {'customer': {'phone': dialog['phone']}},
+                    'last_dialog': {'responsible': {'name': f"Менеджер {dialog['manager_id']}"}},
+                }},
+            })
+            active.remove(dialog)
+    return events
+
+
+def _message_event(dialog: Dict[str, Any], rng: random.Random) -> Dict[str, Any]:
+    from_customer = dialog['sent'] == 0 or rng.random() < 0.5
+    phrases = CLIENT_PHRASES if from_customer else MANAGER_PHRASES
+    image = rng.random() < 0.08
+    text = rng.choice(phrases).format(item=rng.choice(ITEMS), n=rng.randint(1000, 99999))
+    return {
+        'type': KIND_MESSAGE,
+        'data': {'message': {
+            'id': rng.randint(1, 10 ** 9),
+            'type': 'image' if image else 'text',
+            'content': '' if image else text,
+            'from': {'type': 'customer' if from_customer else 'user',
+                     'name': 'Клиент' if from_customer else f"Менеджер {dialog['manager_id']}"},
+            'dialog': {'id': dialog['id']},
+            'chat': {
+                'customer': {'phone': dialog['phone']},
+                'channel': {'name': dialog['channel']},
+                'last_dialog': {'responsible': {'external_id': dialog['manager_id']}},
+            },
+        }},
+    }
+
+
+def load_stream(path: str) -> List[Dict[str, Any]]:
+    """Записанный поток: JSONL, одно событие WebSocket (как его присылает RetailCRM) в строке."""
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_stream(path: str, events: List[Dict[str, Any]]):
+    with open(path, 'w', encoding='utf-8') as f:
+        for event in events:
+            f.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+
+def expected_completion(event: Dict[str, Any]) -> tuple[str, Any] | None:
+    """(вид, dialog_id), если слушатель должен обработать событие, иначе None (событие игнорируется)."""
+    if event.get('type') == KIND_MESSAGE:
+        message = event.get('data', {}).get('message', {})
+        if (message.get('dialog', {}).get('id') and message.get('from', {}).get('type') in ('user', 'customer')
+                and message.get('type') in ('text', 'image')):
+            return KIND_MESSAGE, message['dialog']['id']
+    elif event.get('type') == KIND_CLOSED:
+        dialog_id = event.get('data', {}).get('dialog', {}).get('id')
+        if dialog_id:
+            return KIND_CLOSED, dialog_id
+    return None
+
+
+# --- Данные RetailCRM ---
+
+def seed_retailcrm(retailcrm: RetailCRMStandIn, events: List[Dict[str, Any]], orders_share: float = 0.7,
+                   seed: int = 1):
+    """Менеджеры, клиенты по телефонам из потока и заказы для доли orders_share из них."""
+    rng = random.Random(seed)
+    for manager_id in range(1, 6):
+        retailcrm.add_user(manager_id, "Менеджер", str(manager_id))
+
+    phones = set()
+    for event in events:
+        message = event.get('data', {}).get('message') or event.get('data', {}).get('dialog') or {}
+        phone = message.get('chat', {}).get('customer', {}).get('phone')
+        if phone and phone != 'Неизвестно':
+            phones.add(phone)
+
+    for customer_id, phone in enumerate(sorted(phones), start=1):
+        retailcrm.add_customer(customer_id, phone)
+        if rng.random() < orders_share:
+            retailcrm.add_order(customer_id, customer_id, managerId=rng.randint(1, 5),
+                                totalSumm=rng.randint(5, 200) * 100)
+
+
+# --- Замеры ---
+
+class LagTracker:
+    """Время отправки каждого события и задержка до его обработки слушателем (по каждому виду событий)."""
+
+    def __init__(self):
+        self._pending: Dict[tuple, deque] = defaultdict(deque)
+        self._lock = threading.Lock()
+        self._all_done = threading.Event()
+        self.pending_count = 0
+        self.lags: Dict[str, List[float]] = defaultdict(list)
+        self.first_sent: float | None = None
+        self.last_completed: float | None = None
+
+    def sent(self, kind: str, dialog_id):
+        now = time.perf_counter()
+        with self._lock:
+            self._pending[(kind, dialog_id)].append(now)
+            self.pending_count += 1
+            self.first_sent = self.first_sent or now
+            self._all_done.clear()
+
+    def completed(self, kind: str, dialog_id):
+        now = time.perf_counter()
+        with self._lock:
+            queue = self._pending.get((kind, dialog_id))
+            if not queue:
+                return
+            # События одного диалога обрабатываются по порядку: первым завершается самое раннее
+            self.lags[kind].append(now - queue.popleft())
+            self.pending_count -= 1
+            self.last_completed = now
+            if not self.pending_count:
+                self._all_done.set()
+
+    def wait(self, timeout: float) -> bool:
+        return self._all_done.wait(timeout)
+
+
+class ThreadSampler(threading.Thread):
+    """Периодически считает потоки процесса без потоков самих заглушек."""
+
+    def __init__(self, interval: float = 0.1):
+        super().__init__(name='replay-thread-sampler', daemon=True)
+        self.interval = interval
+        self.samples: List[int] = []
+        self.peak = 0
+        self.peak_breakdown: Counter = Counter()
+        self._stop_event = threading.Event()
+
+    @staticmethod
+    def listener_threads() -> List[threading.Thread]:
+        return [thread for thread in threading.enumerate()
+                if 'process_request_thread' not in thread.name and not thread.name.endswith('StandIn')
+                and thread.name != 'replay-thread-sampler']
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            threads = self.listener_threads()
+            self.samples.append(len(threads))
+            if len(threads) > self.peak:
+                self.peak = len(threads)
+                # "Thread-12 (process_and_export_data)" -> "process_and_export_data"
+                self.peak_breakdown = Counter(re.sub(r'^Thread-\d+ \((.*)\)$', r'\1', thread.name)
+                                              for thread in threads)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def percentile(values: List[float], q: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# --- Прогон ---
+
+def configure(retailcrm, openai_standin, google, telegram):
+    """Направляет систему в заглушки. Вызывается до импорта dialog_listener: он читает config при импорте."""
+    config.RETAILCRM_BASE_URL = retailcrm.url
+    config.RETAILCRM_API_URL = retailcrm.bot_api_url
+    config.RETAILCRM_API_KEY = 'standin'
+    config.RETAIL_CRM_BOT_TOKEN = 'standin'
+    config.OPENAI_API_KEY = 'standin'
+    config.OPENAI_BASE_URL = openai_standin.base_url
+    config.GOOGLE_FORMS_URL = google.forms_url('full')
+    config.GOOGLE_FORMS_URL_FREE = google.forms_url('free')
+    config.EXPORT_SINK = 'forms'
+    config.TELEGRAM_API_URL = telegram.url
+    config.TELEGRAM_BOT_TOKEN = 'standin'
+    config.TELEGRAM_CHAT_ID = config.TELEGRAM_TOPIC_ID = config.TELEGRAM_WARNINGS_TOPIC_ID = '1'
+
+
+def run_replay(events: List[Dict[str, Any]], rate: float, drain_timeout: float,
+               retailcrm: RetailCRMStandIn) -> Dict[str, Any]:
+    """Запускает start_listener, отправляет события с частотой rate и ждет их обработки."""
+    import data_exporter
+    import dialog_listener
+
+    tracker = LagTracker()
+    original_save = dialog_listener.save_message_to_file
+    original_process = dialog_listener.process_and_export_data
+
+    def save_and_track(dialog_id, client_phone, sender_type, message_text, timestamp):
+        original_save(dialog_id, client_phone, sender_type, message_text, timestamp)
+        tracker.completed(KIND_MESSAGE, dialog_id)
+
+    def process_and_track(dialog_id, client_phone):
+        try:
+            return original_process(dialog_id, client_phone)
+        finally:
+            tracker.completed(KIND_CLOSED, dialog_id)
+
+    dialog_listener.save_message_to_file = save_and_track
+    dialog_listener.process_and_export_data = process_and_track
+    # Отчет в 23:00 не должен сработать посреди прогона
+    dialog_listener.LAST_REPORT_DATE = datetime.now(dialog_listener.MOSCOW_TZ).date()
+
+    sampler = ThreadSampler()
+    sampler.start()
+    threads_before = len(ThreadSampler.listener_threads())
+    threading.Thread(target=dialog_listener.start_listener, name='replay-listener', daemon=True).start()
+    if not retailcrm.wait_for_websocket(timeout=30):
+        raise RuntimeError("Слушатель не подключился к WebSocket заглушки RetailCRM.")
+
+    logger.info(f"Отправка {len(events)} событий с частотой {rate:g}/с.")
+    send_start = time.perf_counter()
+    for index, event in enumerate(events):
+        delay = send_start + index / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        completion = expected_completion(event)
+        if completion:
+            tracker.sent(*completion)
+        retailcrm.push_event(event)
+    send_seconds = time.perf_counter() - send_start
+
+    drained = tracker.wait(drain_timeout) if tracker.pending_count else True
+    # Потоки обработки завершаются сразу после отметки о готовности: даем им выйти до финального замера
+    time.sleep(1.0)
+    sampler.stop()
+    processed = sum(len(lags) for lags in tracker.lags.values())
+    busy_seconds = (tracker.last_completed - tracker.first_sent) if tracker.last_completed else 0.0
+
+    return {
+        'events_sent': len(events),
+        'events_processed': processed,
+        'events_pending': tracker.pending_count,
+        'drained': drained,
+        'send_rate': len(events) / send_seconds if send_seconds else None,
+        'throughput': processed / busy_seconds if busy_seconds else None,
+        'lag': {
+            kind: {'count': len(lags), 'p50': percentile(lags, 0.5), 'p95': percentile(lags, 0.95),
+                   'p99': percentile(lags, 0.99), 'max': max(lags)}
+            for kind, lags in tracker.lags.items()
+        },
+        'threads': {'before': threads_before, 'peak': sampler.peak, 'final': len(ThreadSampler.listener_threads()),
+                    'peak_breakdown': dict(sampler.peak_breakdown.most_common(8))},
+        'stage_stats': data_exporter.get_stage_stats(),
+    }
+
+
+def format_report(result: Dict[str, Any], standins: Dict[str, Any]) -> str:
+    def ms(value):
+        return f"{value * 1000:.1f} мс" if value is not None else "Н/Д"
+
+    lines = [
+        f"События: отправлено {result['events_sent']}, обработано {result['events_processed']}, "
+        f"не дождались {result['events_pending']}",
+        f"Частота отправки: {result['send_rate'] or 0:.1f}/с, пропускная способность: {result['throughput'] or 0:.1f}/с",
+    ]
+    for kind, lag in result['lag'].items():
+        lines.append(f"Задержка {kind:14} p50 {ms(lag['p50'])}, p95 {ms(lag['p95'])}, p99 {ms(lag['p99'])}, "
+                     f"max {ms(lag['max'])} ({lag['count']} шт.)")
+    threads = result['threads']
+    breakdown = ", ".join(f"{name}={count}" for name, count in threads['peak_breakdown'].items())
+    lines.append(f"Потоки: до запуска {threads['before']}, пик {threads['peak']}, в конце {threads['final']} (на пике: {breakdown})")
+    for stage, stats in result['stage_stats'].items():
+        lines.append(f"   этап {stage:12} {stats['count']:5} шт., среднее {ms(stats['avg_seconds'])}, "
+                     f"max {ms(stats['max_seconds'])}")
+    google = standins.get('google')
+    if google is not None:
+        lines.append("Строк в Google Forms: " + ", ".join(f"{name} {len(rows)}"
+                                                          for name, rows in google.form_responses.items()))
+    lines.append("Запросов к заглушкам: " + ", ".join(f"{name} {len(standin.requests)}"
+                                                    for name, standin in standins.items()))
+    return "\n".join(lines)
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Офлайн-прогон слушателя с локальными заглушками внешних сервисов.")
+    parser.add_argument('--stream', help="Записанный поток событий (JSONL). Без него — синтетический поток")
+    parser.add_argument('--save-stream', help="Сохранить синтетический поток в JSONL для повторных прогонов")
+    parser.add_argument('--dialogs', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=8, help="Сообщений в диалоге")
+    parser.add_argument('--concurrent-dialogs', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=50.0, help="Событий в секунду")
+    parser.add_argument('--orders-share', type=float, default=0.7, help="Доля клиентов с заказом в RetailCRM")
+    parser.add_argument('--retailcrm-latency', type=float, default=0.02)
+    parser.add_argument('--openai-latency', type=float, default=0.5)
+    parser.add_argument('--google-latency', type=float, default=0.05)
+    parser.add_argument('--telegram-latency', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Доля ответов 503 во всех заглушках")
+    parser.add_argument('--drain-timeout', type=float, default=300.0, help="Сколько ждать обработки событий")
+    parser.add_argument('--workdir', help="Рабочий каталог (dialogs/ и базы SQLite). По умолчанию временный")
+    parser.add_argument('--json', action='store_true', help="Итог в JSON")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    events = load_stream(args.stream) if args.stream else synthetic_stream(
+        args.dialogs, args.messages, args.concurrent_dialogs)
+    if args.save_stream:
+        save_stream(args.save_stream, events)
+
+    # Все пути данных относительные (dialogs/...): прогон идет в отдельном каталоге
+    workdir = args.workdir or tempfile.mkdtemp(prefix='replay-')
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+
+    standins = {
+        'retailcrm': RetailCRMStandIn(latency=args.retailcrm_latency, error_rate=args.error_rate),
+        'openai': OpenAIStandIn(completion_latency=args.openai_latency, error_rate=args.error_rate),
+        'google': GoogleStandIn(latency=args.google_latency, error_rate=args.error_rate),
+        'telegram': TelegramStandIn(latency=args.telegram_latency, error_rate=args.error_rate),
+    }
+    for standin in standins.values():
+        standin.start()
+    try:
+        seed_retailcrm(standins['retailcrm'], events, args.orders_share)
+        configure(standins['retailcrm'], standins['openai'], standins['google'], standins['telegram'])
+        import data_exporter
+        data_exporter.ANALYSIS_SHEET_CSV_URL = standins['google'].analysis_sheet_csv_url
+
+        result = run_replay(events, args.rate, args.drain_timeout, standins['retailcrm'])
+        result['workdir'] = workdir
+        if args.json:
+            print(json.dumps(result, ensure_ascii=False, indent=2))
+        else:
+            print(format_report(result, standins))
+        return 0 if result['drained'] else 1
+    finally:
+        for standin in standins.values():
+            standin.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,8 +5,12 @@ import re
 import requests
 from datetime import datetime, date, timedelta, time as dt_time
 from glob import glob
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator
+import itertools
+import threading
+import time
 import pytz # <-- ДОБАВЛЕНО: Для работы с часовыми поясами
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures, TimeoutError as FuturesTimeoutError
 
 # Добавляем корневую директорию проекта в sys.path
 # Это необходимо, чтобы импортировать config и data_exporter
@@ -16,7 +20,18 @@ sys.path.append(project_root)
 # Импортируем модули
 import config
 # Импортируем только необходимые функции из data_exporter
-from data_exporter import normalize_phone, process_and_export_data
+from data_exporter import normalize_phone, process_and_export_data, process_dialogs_batch
+from export_outbox import drain_once as drain_outbox
+import customer_index
+import order_mirror
+import order_snapshot
+import intraday_metrics
+import analysis_metrics
+import dialog_analyser
+import dialog_preclassifier
+from phone_utils import normalize_phone_digits
+from http_session import get_session
+from retailcrm_api import iter_items, iter_orders
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
@@ -60,7 +75,7 @@ def send_report_to_telegram(text: str, topic_id: str):
     """
     Отправляет уведомление в Telegram-группу с поддержкой тем.
     """
-    url = f"https://api.telegram.org/bot{config.TELEGRAM_BOT_TOKEN}/sendMessage"
+    url = f"{config.TELEGRAM_API_URL}/bot{config.TELEGRAM_BOT_TOKEN}/sendMessage"
     payload = {
         'chat_id': config.TELEGRAM_CHAT_ID,
         'message_thread_id': topic_id,
@@ -73,7 +88,7 @@ def send_report_to_telegram(text: str, topic_id: str):
     # которые могут нарушить формат.
 
     try:
-        response = requests.post(url, data=payload)
+        response = get_session().post(url, data=payload)
         response.raise_for_status()
         logger.info("Отчет успешно отправлен в Telegram.")
     except requests.exceptions.RequestException as e:
@@ -157,11 +172,126 @@ def get_dialog_file_details(file_path: str) -> dict | None:
         return None
 
 
-def manage_and_get_dialogs(report_date: date) -> List[Dict[str, Any]]:
+def format_analysis_footer(report_date: date) -> str:
+    """
+    Блоки отчета об анализе: итоги и стоимость OpenAI за день, счетчики анализа с момента запуска
+    и статистика предклассификатора.
+    """
+    return (analysis_metrics.format_daily_rollup(report_date) + dialog_analyser.format_process_stats()
+            + dialog_preclassifier.format_preclassifier_stats())
+
+
+# --- Фоновое принудительное закрытие активных диалогов ---
+
+_forced_close_thread: threading.Thread | None = None
+# Итог последнего фонового закрытия (для логов и ручной проверки)
+LAST_FORCED_CLOSE_SUMMARY: Dict[str, Any] = {}
+
+
+def run_forced_closes(dialogs: List[Dict[str, Any]], deadline_seconds: float | None = None,
+                      workers: int | None = None) -> Dict[str, Any]:
+    """
+    Анализирует, экспортирует и перемещает в 'closed' активные диалоги (как при событии dialog_closed)
+    пулом из workers потоков или одним пакетом Batch API (config.ANALYSIS_BATCH_MODE).
+    Через deadline_seconds не начатые диалоги отменяются и остаются в 'active', а уже запущенные
+    дорабатываются (пакет Batch API прервать нельзя — его дожидаемся целиком, он ограничен
+    ANALYSIS_BATCH_TIMEOUT_SECONDS), чтобы сводка описывала то, что произошло на самом деле.
+    Возвращает сводку.
+    """
+    deadline_seconds = config.FORCED_CLOSE_DEADLINE_SECONDS if deadline_seconds is None else deadline_seconds
+    workers = max(1, workers or config.FORCED_CLOSE_WORKERS)
+    summary = {'total': len(dialogs), 'succeeded': 0, 'failed': 0, 'not_finished': 0, 'seconds': 0.0}
+    started = time.monotonic()
+
+    if config.ANALYSIS_BATCH_MODE:
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='forced-close')
+        future = executor.submit(process_dialogs_batch, [(d['dialog_id'], d['client_phone']) for d in dialogs])
+        try:
+            try:
+                processed = future.result(timeout=deadline_seconds)
+            except FuturesTimeoutError:
+                logger.warning(f"Пакетное принудительное закрытие не уложилось в {deadline_seconds} с, ждем пакет.")
+                processed = future.result()
+            summary['succeeded'] = sum(1 for d in dialogs if d['dialog_id'] in processed)
+            summary['failed'] = summary['total'] - summary['succeeded']
+        except Exception as e:
+            logger.error(f"❌ Ошибка пакетного принудительного закрытия: {e}", exc_info=True)
+            summary['failed'] = summary['total']
+        executor.shutdown(wait=False)
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='forced-close')
+        futures = {executor.submit(process_and_export_data, d['dialog_id'], d['client_phone']): d['dialog_id']
+                   for d in dialogs}
+        _, not_done = wait_futures(futures, timeout=deadline_seconds)
+        if not_done:
+            logger.warning(f"Принудительное закрытие не уложилось в {deadline_seconds} с: не начатые диалоги "
+                           f"отменяются, запущенные дорабатываются.")
+        executor.shutdown(wait=True, cancel_futures=True)
+        for future, dialog_id in futures.items():
+            if future.cancelled():
+                summary['not_finished'] += 1
+            elif future.exception() is not None:
+                logger.error(f"❌ Ошибка при принудительном закрытии диалога {dialog_id}: {future.exception()}")
+                summary['failed'] += 1
+            else:
+                summary['succeeded'] += 1
+
+    summary['seconds'] = time.monotonic() - started
+    return summary
+
+
+def format_forced_close_summary(summary: Dict[str, Any], report_date: date) -> str:
+    text = (
+        f"<b>Принудительное закрытие диалогов за {report_date.strftime('%d.%m.%Y')}</b>\n"
+        f"Проанализировано и выгружено: {summary['succeeded']} из {summary['total']} "
+        f"за {format_timedelta(timedelta(seconds=summary['seconds']))}"
+    )
+    if summary['failed']:
+        text += f"\n❌ С ошибкой: {summary['failed']}"
+    if summary['not_finished']:
+        text += f"\n⏳ Не начаты к сроку (остались в active): {summary['not_finished']}"
+    return text
+
+
+def start_forced_closes(dialogs: List[Dict[str, Any]], report_date: date) -> threading.Thread | None:
+    """
+    Запускает run_forced_closes в фоновом потоке; по завершении итог пишется в лог и в Telegram
+    вместе с format_analysis_footer (ночные анализы — основная часть расходов OpenAI за день).
+    """
+    global _forced_close_thread
+    if not dialogs:
+        return None
+
+    def worker():
+        summary = run_forced_closes(dialogs)
+        LAST_FORCED_CLOSE_SUMMARY.clear()
+        LAST_FORCED_CLOSE_SUMMARY.update(summary, report_date=report_date.isoformat())
+        logger.info(f"Принудительное закрытие завершено: {summary}")
+        send_report_to_telegram(format_forced_close_summary(summary, report_date)
+                                + format_analysis_footer(report_date), config.TELEGRAM_TOPIC_ID)
+
+    logger.info(f"Принудительное закрытие {len(dialogs)} активных диалогов запущено в фоне.")
+    _forced_close_thread = threading.Thread(target=worker, name='forced-close-supervisor', daemon=True)
+    _forced_close_thread.start()
+    return _forced_close_thread
+
+
+def wait_forced_closes(timeout: float | None = None) -> bool:
+    """Ждет завершения фонового закрытия (для ручного запуска отчета). True — завершено."""
+    if _forced_close_thread is None:
+        return True
+    _forced_close_thread.join(timeout)
+    return not _forced_close_thread.is_alive()
+
+
+def manage_and_get_dialogs(report_date: date,
+                           forced_closes: List[Dict[str, Any]] | None = None) -> List[Dict[str, Any]]:
     """
     Реализует новую логику управления файлами:
     1. Удаляет диалоги, старше 3 дней (по дате последнего сообщения).
-    2. Перемещает диалоги, закрытые сегодня, из 'active' в 'closed' и добавляет их в отчет.
+    2. Активные диалоги с последним сообщением сегодня добавляет в отчет (по уже прочитанным сообщениям)
+       и в forced_closes — их анализ, экспорт и перемещение в 'closed' выполняются в фоне (start_forced_closes).
+       Без forced_closes диалоги закрываются сразу, последовательно.
     3. Собирает диалоги из 'closed', закрытые сегодня, для отчета.
     """
     # 3 дня назад (для удаления старых файлов)
@@ -171,6 +301,8 @@ def manage_and_get_dialogs(report_date: date) -> List[Dict[str, Any]]:
                           glob(os.path.join(DIALOG_DIR_CLOSED, 'dialog_*.txt'))
 
     today_dialogs_for_report = []
+    # Активные диалоги для пакетного анализа (config.ANALYSIS_BATCH_MODE): обрабатываются после обхода файлов
+    deferred_dialogs = []
 
     for file_path in all_files_for_check:
         file_name = os.path.basename(file_path)
@@ -199,6 +331,16 @@ def manage_and_get_dialogs(report_date: date) -> List[Dict[str, Any]]:
                 dialog_id = details['dialog_id']
                 client_phone = details['client_phone']
 
+                if forced_closes is not None:
+                    # Метрики считаются по сообщениям из details, закрытие не задерживает отчет
+                    forced_closes.append(details)
+                    today_dialogs_for_report.append(details)
+                    continue
+
+                if config.ANALYSIS_BATCH_MODE:
+                    deferred_dialogs.append(details)
+                    continue
+
                 logger.info(
                     f"Принудительное закрытие (анализ + перемещение) активного диалога {dialog_id} для отчета...")
 
@@ -219,6 +361,15 @@ def manage_and_get_dialogs(report_date: date) -> List[Dict[str, Any]]:
             elif file_path.startswith(DIALOG_DIR_CLOSED):
                 today_dialogs_for_report.append(details)
 
+    if deferred_dialogs:
+        logger.info(f"Принудительное закрытие {len(deferred_dialogs)} активных диалогов с пакетным анализом OpenAI...")
+        processed = process_dialogs_batch([(d['dialog_id'], d['client_phone']) for d in deferred_dialogs])
+        for details in deferred_dialogs:
+            if details['dialog_id'] in processed:
+                today_dialogs_for_report.append(details)
+            else:
+                logger.error(f"❌ Ошибка при принудительном закрытии диалога {details['dialog_id']} для отчета.")
+
     logger.info(f"Найдено {len(today_dialogs_for_report)} диалогов с последним сообщением за {report_date}.")
     return today_dialogs_for_report
 
@@ -235,10 +386,10 @@ def check_order_modification_today(order_id: int, target_date: date) -> bool:
     по заказу order_id в течение target_date.
     """
     logger.info(f"Проверяем историю изменений для заказа {order_id} за {target_date}.")
-    try:
-        url = f"{config.RETAILCRM_BASE_URL}/api/v5/orders/history"
-        headers = {'X-Api-Key': config.RETAILCRM_API_KEY}
+    if order_mirror.is_fresh():
+        return order_mirror.was_modified_on(order_id, target_date)
 
+    try:
         # Используем формат с пробелом (Y-m-d H:i:s), requests закодирует его правильно.
         start_dt_str = f"{target_date.strftime('%Y-%m-%d')} 00:00:00"
         end_dt_str = f"{target_date.strftime('%Y-%m-%d')} 23:59:59"
@@ -249,12 +400,8 @@ def check_order_modification_today(order_id: int, target_date: date) -> bool:
             'filter[endDate]': end_dt_str,
         }
 
-        response = requests.get(url, headers=headers, params=params, timeout=10)
-        response.raise_for_status()
-
-        data = response.json()
-
-        history_found = len(data.get('history', [])) > 0
+        # Достаточно первой записи истории: следующие страницы не загружаются
+        history_found = next(iter_items('orders/history', 'history', params, prefetch=0), None) is not None
 
         if history_found:
             logger.info(f"Заказ {order_id} был изменен {target_date}.")
@@ -282,10 +429,37 @@ def check_order_modification_today(order_id: int, target_date: date) -> bool:
         return False
 
 
-def get_relevant_orders_for_client(phone_number: str) -> Dict[str, Any]:
+def _iter_client_orders(normalized_phone: str,
+                        snapshot: order_snapshot.OrderSnapshot | None) -> Iterator[Dict[str, Any]]:
+    """Заказы клиента от самого свежего: из зеркала, снимка, по индексу клиентов или поиском в RetailCRM."""
+    # Индексу доверяем, только если он свежий: иначе в нем нет заказов и телефонов, появившихся после
+    # прошлой синхронизации, и клиента ищем в RetailCRM
+    index_fresh = customer_index.is_fresh()
+    customer_ids = customer_index.find_customer_ids(normalized_phone) if index_fresh else []
+    if order_mirror.is_fresh():
+        # Зеркало заказов: ни одного запроса к RetailCRM. Оно хранит только последние ORDER_MIRROR_DAYS,
+        # поэтому клиента без заказов в зеркале ищем дальше (его заказы могут быть старше)
+        orders = order_mirror.find_client_orders(normalized_phone, customer_ids)
+        if orders:
+            return iter(orders)
+    if snapshot is not None and snapshot.covers(normalized_phone):
+        return iter(snapshot.find_client_orders(normalized_phone, customer_ids))
+    # ID заказов клиента берем из свежего локального индекса: выборка по точным ID
+    # вместо нечеткого поиска filter[customer]
+    if index_fresh and (order_ids := customer_index.find_order_ids(normalized_phone)):
+        orders = customer_index.fetch_orders_by_ids(order_ids)
+        # Самый свежий заказ должен быть первым, как в ответе поиска RetailCRM
+        orders.sort(key=lambda order: order.get('createdAt') or '', reverse=True)
+        return iter(orders)
+    return iter_orders({'filter[customer]': normalized_phone})
+
+
+def get_relevant_orders_for_client(phone_number: str,
+                                   snapshot: order_snapshot.OrderSnapshot | None = None) -> Dict[str, Any]:
     """
     Ищет строго актуальный (НОВЫЙ) заказ для Метрики 2 И проверяет активность
     самого свежего заказа (для фильтрации ссылок).
+    snapshot — снимок заказов отчета: если он знает заказы клиента, запрос в RetailCRM не нужен.
 
     Возвращает: {
         'new_order': dict|None,
@@ -303,16 +477,11 @@ def get_relevant_orders_for_client(phone_number: str) -> Dict[str, Any]:
     result = {'new_order': None, 'latest_order': None, 'is_client_active': False}
     if not normalized_phone: return result
 
-    # --- Шаг 1: Получаем все заказы клиента (до 50 шт) ---
+    # --- Шаг 1: Получаем заказы клиента (от самого свежего; из API — потоком, страницы догружаются по мере обхода) ---
     try:
-        url = f"{config.RETAILCRM_BASE_URL}/api/v5/orders"
-        headers = {'X-Api-Key': config.RETAILCRM_API_KEY}
-        params = {'filter[customer]': normalized_phone, 'limit': 50}
-        response = requests.get(url, headers=headers, params=params, timeout=10)
-        response.raise_for_status()
-        all_client_orders = response.json().get('orders', [])
-
-        if not all_client_orders:
+        all_client_orders = _iter_client_orders(normalized_phone, snapshot)
+        latest_order = next(all_client_orders, None)  # Самый свежий заказ
+        if latest_order is None:
             logger.info(f"Найдено 0 заказов для клиента {normalized_phone}.")
             return result
 
@@ -320,40 +489,46 @@ def get_relevant_orders_for_client(phone_number: str) -> Dict[str, Any]:
         logger.error(f"❌ Ошибка при получении всех заказов клиента {normalized_phone}: {e}", exc_info=True)
         return result
 
-    latest_order = all_client_orders[0]  # Самый свежий заказ
     result['latest_order'] = latest_order
 
     # --- Шаг 2: Строгая проверка (НОВЫЕ заказы в целевом статусе) ---
     date_limit = datetime.now() - timedelta(days=MAX_ORDER_AGE_DAYS)
 
-    for order in all_client_orders:
-        created_at_str = order.get('createdAt')
-        if not created_at_str: continue
+    try:
+        for order in itertools.chain([latest_order], all_client_orders):
+            created_at_str = order.get('createdAt')
+            if not created_at_str: continue
 
-        try:
-            created_dt = datetime.fromisoformat(created_at_str.replace('Z', '+00:00'))
-        except ValueError:
             try:
-                created_dt = datetime.strptime(created_at_str.split('.')[0], '%Y-%m-%d %H:%M:%S')
+                created_dt = datetime.fromisoformat(created_at_str.replace('Z', '+00:00'))
             except ValueError:
-                continue
-
-        status = order.get('status')
-
-        # Если заказ молодой и в целевом статусе - он считается "НОВЫМ"
-        if created_dt >= date_limit and status in TARGET_STATUSES:
-            result['new_order'] = order
-            result['is_client_active'] = True  # Новый заказ всегда считается активным
-            logger.info(f"Заказ {order.get('id')} признан строго актуальным (НОВЫЙ).")
-            # Не прерываем цикл, чтобы убедиться, что latest_order - самый свежий
-            break
+                try:
+                    created_dt = datetime.strptime(created_at_str.split('.')[0], '%Y-%m-%d %H:%M:%S')
+                except ValueError:
+                    continue
+
+            status = order.get('status')
+
+            # Если заказ молодой и в целевом статусе - он считается "НОВЫМ"
+            if created_dt >= date_limit and status in TARGET_STATUSES:
+                result['new_order'] = order
+                result['is_client_active'] = True  # Новый заказ всегда считается активным
+                logger.info(f"Заказ {order.get('id')} признан строго актуальным (НОВЫЙ).")
+                # Остальные страницы заказов клиента не загружаются
+                break
+    except requests.exceptions.RequestException as e:
+        logger.error(f"❌ Ошибка при догрузке заказов клиента {normalized_phone}: {e}", exc_info=True)
 
             # --- Шаг 3: Проверка активности (старый заказ, измененный сегодня) ---
     # Этот шаг нужен ТОЛЬКО для фильтрации списка "Клиенты без актуального заказа".
 
     if not result['is_client_active'] and latest_order:
         latest_order_id = latest_order.get('id')
-        if latest_order_id and check_order_modification_today(latest_order_id, today):
+        # Снимок отчета уже знает все заказы, измененные за день: проверка без запроса к RetailCRM
+        modified_today = snapshot.was_modified_on(latest_order_id, today) if snapshot is not None else None
+        if modified_today is None:
+            modified_today = bool(latest_order_id) and check_order_modification_today(latest_order_id, today)
+        if latest_order_id and modified_today:
             result['is_client_active'] = True  # Активный, но не новый
             logger.info(
                 f"Клиент {normalized_phone} признан активным, т.к. последний заказ {latest_order_id} был изменен сегодня.")
@@ -369,13 +544,17 @@ def get_relevant_orders_for_client(phone_number: str) -> Dict[str, Any]:
 def get_day_in_day_paid_orders(target_date: date) -> List[Dict[str, Any]]:
     logger.info(f"Начинаем поиск заказов, созданных и оплаченных за {target_date}")
 
+    if order_mirror.is_fresh():
+        day_in_day_orders = order_mirror.find_orders(
+            created_on=target_date, status_updated_on=target_date, statuses=PAYMENT_STATUSES
+        )
+        logger.info(f"Найдено {len(day_in_day_orders)} заказов, созданных и оплаченных в этот день (зеркало заказов).")
+        return day_in_day_orders
+
     # Дата в формате Y-m-d
     target_date_str = target_date.strftime('%Y-%m-%d')
 
     try:
-        url = f"{config.RETAILCRM_BASE_URL}/api/v5/orders"
-        headers = {'X-Api-Key': config.RETAILCRM_API_KEY}
-
         # Параметры API для фильтрации день в день
         params = {
             'filter[createdAtFrom]': target_date_str,
@@ -383,15 +562,10 @@ def get_day_in_day_paid_orders(target_date: date) -> List[Dict[str, Any]]:
             'filter[extendedStatus][]': list(PAYMENT_STATUSES),
             'filter[statusUpdatedAtFrom]': target_date_str,
             'filter[statusUpdatedAtTo]': target_date_str,
-            'limit': 100
         }
 
-        response = requests.get(url, headers=headers, params=params, timeout=10)
-        response.raise_for_status()
-
-        data = response.json()
-
-        day_in_day_orders = data.get('orders', [])
+        # Все страницы выборки (раньше бралась только первая сотня заказов)
+        day_in_day_orders = list(iter_orders(params))
 
         logger.info(f"Найдено {len(day_in_day_orders)} заказов, созданных и оплаченных в этот день (через API).")
         return day_in_day_orders
@@ -448,20 +622,49 @@ def analyze_dialog_speed_and_status(dialog: dict) -> dict:
     }
 
 
-def process_new_dialogs(dialogs: list) -> dict:
+def _relevant_orders_or_empty(phone_number: str, snapshot: order_snapshot.OrderSnapshot | None = None) -> Dict[str, Any]:
+    """get_relevant_orders_for_client, в котором ошибка одного клиента не прерывает расчет всего отчета."""
+    try:
+        return get_relevant_orders_for_client(phone_number, snapshot)
+    except Exception as e:
+        logger.error(f"❌ Ошибка при поиске заказов клиента {phone_number}: {e}", exc_info=True)
+        return {'new_order': None, 'latest_order': None, 'is_client_active': False}
+
+
+def fetch_relevant_orders(phones: List[str],
+                          snapshot: order_snapshot.OrderSnapshot | None = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Параллельно (до config.REPORT_ENRICH_CONCURRENCY клиентов одновременно) выполняет
+    get_relevant_orders_for_client для уникальных телефонов. Общий темп запросов к RetailCRM
+    ограничен retailcrm_api.throttle. Возвращает {телефон: результат} в исходном порядке телефонов.
+    """
+    unique_phones = list(dict.fromkeys(phones))
+    if not unique_phones:
+        return {}
+    workers = max(1, min(config.REPORT_ENRICH_CONCURRENCY, len(unique_phones)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='report-enrich') as executor:
+        # map сохраняет порядок входных данных: результат не зависит от того, какой запрос ответил первым
+        results = executor.map(lambda phone: _relevant_orders_or_empty(phone, snapshot), unique_phones)
+        return dict(zip(unique_phones, results))
+
+
+def process_new_dialogs(dialogs: list, snapshot: order_snapshot.OrderSnapshot | None = None) -> dict:
     """
     Обновлено: считает только НОВЫЕ заказы (Метрика 2) и фильтрует
     клиентов без АКТИВНОГО (нового/измененного) заказа.
+    Заказы клиентов берутся из снимка заказов отчета (snapshot), остальные запрашиваются
+    параллельно (fetch_relevant_orders); подсчет идет в порядке диалогов.
     """
     total_new_inquiries = len(dialogs)
     fiz_count = 0
     yur_count = 0
     orders_created_count = 0
     clients_without_order_data = []  # Хранит {'phone', 'latest_order_id'}
+    orders_by_phone = fetch_relevant_orders([dialog['client_phone'] for dialog in dialogs], snapshot)
 
     for dialog in dialogs:
         phone = dialog['client_phone']
-        order_info = get_relevant_orders_for_client(phone)
+        order_info = orders_by_phone[phone]
 
         new_order = order_info['new_order']  # Для Метрики 2
         is_client_active = order_info['is_client_active']  # Для фильтрации ссылок
@@ -510,6 +713,49 @@ def process_new_dialogs(dialogs: list) -> dict:
 
 # --- Основная логика генерации отчета ---
 
+def refresh_order_mirror():
+    """
+    Одним проходом догоняет историю заказов перед расчетом метрик 2 и 6, чтобы отчет
+    читал заказы из зеркала, а не делал запросы в RetailCRM по каждому клиенту.
+    При ошибке отчет строится по прямым запросам (зеркало останется несвежим).
+    """
+    try:
+        order_mirror.sync()
+    except Exception as e:
+        logger.error(f"❌ Не удалось синхронизировать зеркало заказов, используем прямые запросы: {e}", exc_info=True)
+
+
+def refresh_customer_index():
+    """
+    Догоняет индекс клиентов перед расчетом метрик 2 и 6: отчет пользуется индексом, только если он свежий.
+    Первичное наполнение здесь не запускается — его делает фоновый поток dialog_listener.
+    При ошибке индекс останется несвежим, и отчет пойдет прямыми запросами.
+    """
+    if not customer_index.is_ready():
+        return
+    try:
+        customer_index.sync()
+    except Exception as e:
+        logger.error(f"❌ Не удалось синхронизировать индекс клиентов, используем прямые запросы: {e}", exc_info=True)
+
+
+def load_order_snapshot(report_date: date, phones: List[str]) -> order_snapshot.OrderSnapshot | None:
+    """
+    Снимок заказов для метрик 2 и 6, если зеркало заказов несвежее: несколько постраничных запросов
+    вместо запроса на каждого клиента. None — зеркало свежее или выгрузка не удалась
+    (тогда метрики считаются прежним способом).
+    """
+    if order_mirror.is_fresh():
+        return None
+    try:
+        snapshot = order_snapshot.load_snapshot(report_date)
+        order_snapshot.complete_from_index(snapshot, phones)
+        return snapshot
+    except Exception as e:
+        logger.error(f"❌ Не удалось выгрузить снимок заказов, используем запросы по клиентам: {e}", exc_info=True)
+        return None
+
+
 def generate_daily_report():
     # ИСПРАВЛЕНИЕ: Расчет даты
     # Используем Московское время для определения даты, за которую составляется отчет
@@ -518,53 +764,81 @@ def generate_daily_report():
 
     logger.info(f"=== Начало генерации ежедневного отчета за {report_date} ===")
 
-    # НОВЫЙ ШАГ: Управление файлами, удаление старых, закрытие активных и сбор диалогов для отчета
-    dialogs_for_today = manage_and_get_dialogs(report_date)
+    # НОВЫЙ ШАГ: Управление файлами, удаление старых и сбор диалогов для отчета.
+    # Активные диалоги закрываются (анализ + экспорт) в фоне, отчет их не ждет
+    forced_closes = []
+    dialogs_for_today = manage_and_get_dialogs(report_date, forced_closes)
+    forced_close_thread = start_forced_closes(forced_closes, report_date)
 
     if not dialogs_for_today:
         logger.info("Нет новых диалогов для анализа за выбранный день. Отправка отчета пропущена.")
         return
 
     # --- Агрегация результатов (Метрики 3, 4, 5) ---
-    all_response_times_td = []
-    slow_first_response_count = 0
-    unanswered_working_count = 0
-    unanswered_non_working_count = 0
+    # Слушатель ведет их по мере поступления сообщений (intraday_metrics): берем готовые суммы дня
+    intraday = intraday_metrics.get_day_metrics(report_date)
+    if intraday is not None and intraday['dialogs'] != len(dialogs_for_today):
+        # Разные наборы диалогов дали бы несогласованные метрики 1–2 и 3–5: считаем по файлам
+        logger.warning(f"Промежуточные метрики учитывают {intraday['dialogs']} диалогов, "
+                       f"в отчете {len(dialogs_for_today)}. Метрики 3–5 пересчитываются по файлам.")
+        intraday = None
+    if intraday is not None:
+        total_avg_response_time = intraday['avg_response_time']
+        slow_first_response_count = intraday['slow_first_response']
+        unanswered_working_count = intraday['unanswered_working']
+        unanswered_non_working_count = intraday['unanswered_non_working']
+    else:
+        all_response_times_td = []
+        slow_first_response_count = 0
+        unanswered_working_count = 0
+        unanswered_non_working_count = 0
 
-    for dialog in dialogs_for_today:
-        # Диалоги, которые были в 'active' и принудительно 'закрыты' выше, уже содержат
-        # результат анализа (который происходит внутри process_and_export_data).
-        # Однако, для расчета метрик 3, 4, 5 нам нужны сообщения.
-        speed_and_status = analyze_dialog_speed_and_status(dialog)
+        for dialog in dialogs_for_today:
+            # Диалоги, которые были в 'active' и принудительно 'закрыты' выше, уже содержат
+            # результат анализа (который происходит внутри process_and_export_data).
+            # Однако, для расчета метрик 3, 4, 5 нам нужны сообщения.
+            speed_and_status = analyze_dialog_speed_and_status(dialog)
 
-        all_response_times_td.extend(speed_and_status['response_times'])
+            all_response_times_td.extend(speed_and_status['response_times'])
 
-        if speed_and_status['first_response_too_slow']:
-            slow_first_response_count += 1
+            if speed_and_status['first_response_too_slow']:
+                slow_first_response_count += 1
 
-        if speed_and_status['is_unanswered_working']:
-            unanswered_working_count += 1
+            if speed_and_status['is_unanswered_working']:
+                unanswered_working_count += 1
 
-        if speed_and_status['is_unanswered_non_working']:
-            unanswered_non_working_count += 1
+            if speed_and_status['is_unanswered_non_working']:
+                unanswered_non_working_count += 1
 
-    # Шаг 2: Расчет метрик 1 и 2
-    report_data_1_2 = process_new_dialogs(dialogs_for_today)
+        # Финальный расчет среднего времени (Метрика 3)
+        # Используем len() == 0, чтобы избежать ошибки деления на ноль, если all_response_times_td пуст
+        if all_response_times_td:
+            total_avg_response_time = sum(all_response_times_td, timedelta()) / len(all_response_times_td)
+        else:
+            total_avg_response_time = None
 
-    # Шаг 3: Финальный расчет среднего времени (Метрика 3)
-    # Используем len() == 0, чтобы избежать ошибки деления на ноль, если all_response_times_td пуст
-    if all_response_times_td:
-        total_avg_response_time = sum(all_response_times_td, timedelta()) / len(all_response_times_td)
-    else:
-        total_avg_response_time = None
+    # Шаг 2: Расчет метрик 1 и 2
+    refresh_order_mirror()
+    refresh_customer_index()
+    snapshot = load_order_snapshot(report_date, [d['client_phone'] for d in dialogs_for_today])
+    report_data_1_2 = process_new_dialogs(dialogs_for_today, snapshot)
 
     # Шаг 4: Расчет метрики 6: Закрытие день в день
 
     # 4.1. Получаем уникальные телефоны клиентов, которые обратились сегодня (по последнему сообщению)
     today_appeal_phones = {normalize_phone(d['client_phone']) for d in dialogs_for_today}
-
-    # 4.2. Получаем заказы, созданные И оплаченные сегодня
-    day_in_day_orders = get_day_in_day_paid_orders(report_date)
+    # и ID этих клиентов из локального индекса: заказ совпадает с обращением, даже если
+    # телефон в заказе записан иначе, чем в чате
+    today_appeal_customer_ids = customer_index.find_customer_ids_for_phones(today_appeal_phones) \
+        if customer_index.is_fresh() else set()
+
+    # 4.2. Получаем заказы, созданные И оплаченные сегодня (из снимка — без отдельного запроса и лимита в 100)
+    if snapshot is not None:
+        day_in_day_orders = snapshot.find_orders(
+            created_on=report_date, status_updated_on=report_date, statuses=PAYMENT_STATUSES
+        )
+    else:
+        day_in_day_orders = get_day_in_day_paid_orders(report_date)
 
     day_in_day_count = 0
     day_in_day_sum = 0
@@ -572,8 +846,10 @@ def generate_daily_report():
     for order in day_in_day_orders:
         # Извлекаем телефон клиента из заказа
         customer_phone_number = order.get('customer', {}).get('phones', [{}])[0].get('number')
+        customer_id = order.get('customer', {}).get('id')
 
-        if customer_phone_number and normalize_phone(customer_phone_number) in today_appeal_phones:
+        if (customer_id and customer_id in today_appeal_customer_ids) or \
+                (customer_phone_number and normalize_phone_digits(customer_phone_number) in today_appeal_phones):
             # Все 3 условия совпали: день обращения = день создания = день оплаты
             day_in_day_count += 1
             day_in_day_sum += order.get('totalSumm', 0)
@@ -620,6 +896,11 @@ def generate_daily_report():
         f"6. Закрытие день в день (шт/сумма): <b>{day_in_day_count} шт. / {day_in_day_sum:,.0f} руб.</b>"
     )
 
+    # Итоги и стоимость анализа OpenAI за день и статистика предклассификатора (пусто, если данных нет).
+    # При фоновом закрытии диалогов они отправляются вместе с его итогом, иначе в отчет не попали бы ночные анализы
+    if forced_close_thread is None:
+        report_summary += format_analysis_footer(report_date)
+
     # ИСПРАВЛЕНИЕ #3: Используем новую функцию, которая корректно обрабатывает токен и тему
     send_report_to_telegram(report_summary, config.TELEGRAM_TOPIC_ID)
     print("\n--- Сгенерированный Отчет ---\n" + report_summary)
@@ -629,5 +910,11 @@ def generate_daily_report():
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    # Слушатель ведет метрики 3–5 в своей памяти; при ручном запуске восстанавливаем их до переноса файлов
+    if config.INTRADAY_METRICS_ENABLED:
+        intraday_metrics.load_state()
     generate_daily_report()
-    pass
+    # При ручном запуске процесс не должен завершиться раньше фонового закрытия диалогов
+    wait_forced_closes()
+    # При ручном запуске воркеры слушателя не работают, поэтому отправляем очередь экспорта сами
+    drain_outbox()
@@ -1,8 +1,12 @@
 import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, List, Iterator
 
 # Импортируем конфиг для доступа к ключам API
 try:
@@ -11,13 +15,108 @@ except ImportError:
     logging.error("Не удалось импортировать файл config.py.")
     exit(1)
 
+from http_session import get_session
+
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
 # URL для задач: /api/v5/tasks/create
-API_URL = config.RETAILCRM_BASE_URL + "/api/v5/tasks/create"
+API_URL = f"{config.RETAILCRM_BASE_URL}/api/v5/tasks/create"
 API_KEY = config.RETAILCRM_API_KEY
 
+# Максимальный размер страницы списков RetailCRM (допустимы 20, 50 и 100)
+PAGE_LIMIT = 100
+
+
+class RateLimiter:
+    """
+    Общий для всех потоков лимит запросов в секунду: запросы равномерно разносятся по времени,
+    каждый вызов acquire() занимает следующий свободный слот и ждет его.
+    """
+
+    def __init__(self, max_per_second: float):
+        self.interval = 1.0 / max_per_second if max_per_second > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+_rate_limiter = RateLimiter(config.RETAILCRM_MAX_RPS)
+
+
+def throttle():
+    """Ждет слот общего лимита запросов к RetailCRM. Вызывается перед каждым запросом к /api/v5."""
+    _rate_limiter.acquire()
+
+
+def api_get(path: str, params: Dict[str, Any] | None = None, timeout: int = 30) -> Dict[str, Any]:
+    """GET-запрос к /api/v5/<path>. Ошибки HTTP пробрасываются вызывающему коду."""
+    url = f"{config.RETAILCRM_BASE_URL}/api/v5/{path}"
+    throttle()
+    response = get_session().get(url, headers={'X-Api-Key': config.RETAILCRM_API_KEY}, params=params, timeout=timeout)
+    response.raise_for_status()
+    return response.json()
+
+
+def iter_pages(path: str, key: str, params: Dict[str, Any] | None = None,
+               prefetch: int | None = None) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Постранично обходит список RetailCRM (page/limit), отдавая элементы каждой страницы по порядку.
+    После первой страницы (из нее известно число страниц) до prefetch следующих страниц
+    (по умолчанию config.RETAILCRM_PREFETCH_PAGES) загружаются параллельно, пока вызывающий код
+    обрабатывает текущую. В памяти одновременно не больше prefetch + 1 страниц; если обход
+    прекращен досрочно, еще не начатые загрузки отменяются.
+    """
+    params = params or {}
+    prefetch = config.RETAILCRM_PREFETCH_PAGES if prefetch is None else prefetch
+
+    def fetch(page: int) -> Dict[str, Any]:
+        return api_get(path, {**params, 'limit': PAGE_LIMIT, 'page': page})
+
+    data = fetch(1)
+    total_pages = data.get('pagination', {}).get('totalPageCount', 1)
+    yield data.get(key, [])
+    if total_pages <= 1:
+        return
+
+    if prefetch <= 0:
+        for page in range(2, total_pages + 1):
+            yield fetch(page).get(key, [])
+        return
+
+    executor = ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix='retailcrm-prefetch')
+    try:
+        pending = deque()
+        next_page = 2
+        while pending or next_page <= total_pages:
+            while next_page <= total_pages and len(pending) < prefetch:
+                pending.append(executor.submit(fetch, next_page))
+                next_page += 1
+            yield pending.popleft().result().get(key, [])
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_items(path: str, key: str, params: Dict[str, Any] | None = None,
+               prefetch: int | None = None) -> Iterator[Dict[str, Any]]:
+    """Элементы списка RetailCRM потоком (см. iter_pages): память не растет с размером выборки."""
+    for items in iter_pages(path, key, params, prefetch):
+        yield from items
+
+
+def iter_orders(filters: Dict[str, Any], prefetch: int | None = None) -> Iterator[Dict[str, Any]]:
+    """Заказы /api/v5/orders по фильтрам (ключи вида 'filter[...]') потоком, со всех страниц."""
+    return iter_items('orders', 'orders', filters, prefetch)
+
 
 def create_task(task_data: Dict[str, Any]) -> Dict[str, Any]:
     """
@@ -45,7 +144,8 @@ def create_task(task_data: Dict[str, Any]) -> Dict[str, Any]:
 
     try:
         # Для RetailCRM часто проще передать данные в виде form-data
-        response = requests.post(
+        throttle()
+        response = get_session().post(
             API_URL,
             data={'task': json.dumps(task_data)},
             headers={'X-Api-Key': API_KEY},
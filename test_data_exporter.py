@@ -0,0 +1,135 @@
+import os
+
+import pytest
+
+import config
+import customer_index
+import data_exporter
+import order_mirror
+import processing_ledger
+from local_standins import RetailCRMStandIn, GoogleStandIn
+from openai_engine import AnalysisUnavailableError
+
+# Конвейер закрытого диалога на заглушках RetailCRM и Google: заказ, менеджер и проверка таблицы анализа
+# идут настоящими HTTP-запросами, анализ OpenAI, экспорт и уведомление подменяются через зависимости этапов.
+
+DIALOG_ID = 101
+CLIENT_PHONE = '79001112233'
+ALL_STAGES = [stage for stage, _ in data_exporter.PIPELINE_STAGES]
+
+
+@pytest.fixture(scope='module')
+def retailcrm():
+    server = RetailCRMStandIn().start()
+    server.add_user(5, 'Анна', 'Петрова')
+    server.add_customer(1, f"+{CLIENT_PHONE}")
+    server.add_order(10, 1, managerId=5)
+    yield server
+    server.stop()
+
+
+@pytest.fixture(scope='module')
+def google():
+    server = GoogleStandIn().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch, retailcrm, google):
+    """Рабочий каталог с файлом диалога в 'active' и отдельными базами журнала, индекса и зеркала."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(config, 'RETAILCRM_BASE_URL', retailcrm.url)
+    monkeypatch.setattr(config, 'RETAILCRM_API_KEY', 'standin')
+    monkeypatch.setattr(config, 'PRECLASSIFIER_MODE', 'off')
+    monkeypatch.setattr(config, 'LEDGER_DB_PATH', str(tmp_path / 'ledger.sqlite3'))
+    monkeypatch.setattr(config, 'CUSTOMER_INDEX_DB_PATH', str(tmp_path / 'customer_index.sqlite3'))
+    monkeypatch.setattr(config, 'ORDER_MIRROR_DB_PATH', str(tmp_path / 'order_mirror.sqlite3'))
+    monkeypatch.setattr(data_exporter, 'ANALYSIS_SHEET_CSV_URL', google.analysis_sheet_csv_url)
+    for module in (processing_ledger, customer_index, order_mirror):
+        monkeypatch.setattr(module, '_initialized', False)
+
+    os.makedirs(os.path.join('dialogs', 'active'))
+    with open(_dialog_path('active'), 'w', encoding='utf-8') as f:
+        f.write("[01.10.2026 10:00:00] Клиент: Здравствуйте, нужен диван\n"
+                "[01.10.2026 10:01:00] Менеджер: Добрый день! Подберем\n")
+
+    exported = {'full': [], 'free': [], 'notify': []}
+    deps = {
+        'export': {
+            'export_full': exported['full'].append,
+            'export_free': exported['free'].append,
+            'notify': exported['notify'].append,
+        },
+    }
+    return deps, exported
+
+
+def _dialog_path(folder: str) -> str:
+    return os.path.join('dialogs', folder, f"dialog_{DIALOG_ID}_{CLIENT_PHONE}.txt")
+
+
+def _run(deps: dict, analyze) -> dict:
+    ctx = data_exporter.new_dialog_context(DIALOG_ID, CLIENT_PHONE)
+    data_exporter._run_stages(ctx, ALL_STAGES, {**deps, 'analyze': {'analyze': analyze}})
+    return ctx
+
+
+def _analysis(text, categories):
+    scores = {criterion: 1 for criterion in config.ANALYSIS_CRITERIA}
+    scores['chat_category'] = categories[0]
+    return scores, "Клиент выбрал диван."
+
+
+def _unavailable(text, categories):
+    raise AnalysisUnavailableError("OpenAI не ответил за дедлайн")
+
+
+def test_full_analysis_is_exported_and_archived(pipeline):
+    deps, exported = pipeline
+
+    ctx = _run(deps, _analysis)
+
+    assert ctx['claimed'] and ctx['attempt'] == 1
+    assert ctx['manager_name'] == 'Анна Петрова'
+    assert len(exported['full']) == 1 and not exported['free']
+    row = exported['full'][0]
+    assert row['dialog_id'] == DIALOG_ID
+    assert row['content_hash'] == ctx['content_hash']
+    assert row['order_link'].endswith('/orders/10/edit')
+    assert len(exported['notify']) == 1
+    assert os.path.exists(_dialog_path('closed')) and not os.path.exists(_dialog_path('active'))
+
+
+def test_unavailable_analysis_is_retried_later(pipeline):
+    deps, exported = pipeline
+
+    with pytest.raises(AnalysisUnavailableError):
+        _run(deps, _unavailable)
+
+    with open(_dialog_path('active'), encoding='utf-8') as f:
+        entry = processing_ledger.get_entry(DIALOG_ID, processing_ledger.content_hash(f.read()))
+    assert entry['status'] == processing_ledger.STATUS_FAILED and entry['attempts'] == 1
+    assert not exported['full'] and not exported['free']
+    # Файл остается в 'active': следующая попытка возьмет ту же версию диалога
+    assert os.path.exists(_dialog_path('active'))
+
+    ctx = _run(deps, _analysis)
+    assert ctx['attempt'] == 2
+    assert len(exported['full']) == 1
+    assert os.path.exists(_dialog_path('closed'))
+
+
+def test_last_attempt_falls_back_to_free_export(pipeline):
+    deps, exported = pipeline
+
+    for _ in range(config.LEDGER_MAX_ATTEMPTS - 1):
+        with pytest.raises(AnalysisUnavailableError):
+            _run(deps, _unavailable)
+    ctx = _run(deps, _unavailable)
+
+    assert ctx['attempt'] == config.LEDGER_MAX_ATTEMPTS
+    assert not ctx['should_analyze']
+    assert not exported['full'] and len(exported['free']) == 1
+    assert not exported['notify']
+    assert os.path.exists(_dialog_path('closed')) and not os.path.exists(_dialog_path('active'))